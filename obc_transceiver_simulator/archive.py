@@ -0,0 +1,189 @@
+"""
+Append-only binary archive of the raw blocks received for one section, which
+is the record of what was downloaded (the section CSV files can be made again
+from it with export.py).
+The data file (<file>.blk) has every block exactly as it was received (the 10
+byte header and the fields or command log data) back to back, so every record
+is the same size and the file can be read with common.unpack_blocks(). The
+index file (<file>.blk.idx) has the expected block number of each record as a
+little-endian uint32, in the same order.
+The files are memory-mapped for reading, so looking up a block or scanning a
+range of blocks doesn't copy the data.
+"""
+
+import array
+import bisect
+import mmap
+import os
+import sys
+
+from common import *
+
+
+# Size of each entry of the index file
+ARCHIVE_INDEX_ITEM_LEN = 4
+
+
+class BlockArchive(object):
+    def __init__(self, path, record_len):
+        self.path = path
+        self.index_path = path + ".idx"
+        self.record_len = record_len
+
+        self.data_file = None
+        self.index_file = None
+        # Expected block number of each record
+        self.index = array.array(UINT32_TYPECODE)
+        # Maps block numbers to the number of their last record
+        self.records = {}
+        # Sorted block numbers, for range scans (None if it needs to be sorted
+        # again)
+        self.sorted_nums = None
+        # Number of records that have been flushed to the data file
+        self.flushed = 0
+        self.map = None
+
+    def __str__(self):
+        return "%s: records = %d, blocks = %d" % (os.path.basename(self.path),
+            len(self.index), len(self.records))
+
+    def __len__(self):
+        return len(self.index)
+
+    # Opens the files, or creates them
+    # Records that are only partly written (or don't have an index entry) are
+    # removed
+    # If read_only is True, the files are not changed (and records can't be
+    # added), so any number of processes can read the archive at once
+    def open(self, read_only=False):
+        self.close()
+        data_size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        index_size = os.path.getsize(self.index_path) if os.path.exists(self.index_path) else 0
+        count = min(data_size // self.record_len, index_size // ARCHIVE_INDEX_ITEM_LEN)
+
+        for (path, size, item_len) in [(self.path, data_size, self.record_len),
+                (self.index_path, index_size, ARCHIVE_INDEX_ITEM_LEN)]:
+            if size > count * item_len and not read_only:
+                print("Removing %d bytes of incomplete records from %s" % (size - count * item_len, path))
+                with open(path, 'r+b') as f:
+                    f.truncate(count * item_len)
+
+        self.index = array.array(UINT32_TYPECODE)
+        if count > 0:
+            with open(self.index_path, 'rb') as f:
+                self.index.frombytes(f.read(count * ARCHIVE_INDEX_ITEM_LEN))
+            if sys.byteorder != "little":
+                self.index.byteswap()
+        self.records = dict((num, i) for (i, num) in enumerate(self.index))
+        self.sorted_nums = None
+        self.flushed = count
+
+        if read_only:
+            return
+        self.data_file = open(self.path, 'ab')
+        self.index_file = open(self.index_path, 'ab')
+
+    # Adds a record for a block
+    # data is the raw block (header and data), record_len bytes
+    # If the block is already in the archive, the record is only added if
+    # the data is different and policy (one of DUPLICATE_POLICIES in
+    # sections.py) is "latest"
+    # Returns True if the record was added
+    def append(self, block_num, data, policy="latest"):
+        assert len(data) == self.record_len
+        i = self.records.get(block_num)
+        if i is not None and (policy != "latest" or self.record(i) == data):
+            return False
+
+        self.data_file.write(data)
+        entry = array.array(UINT32_TYPECODE, [block_num])
+        if sys.byteorder != "little":
+            entry.byteswap()
+        self.index_file.write(entry.tobytes())
+
+        if block_num not in self.records and self.sorted_nums is not None:
+            bisect.insort(self.sorted_nums, block_num)
+        self.records[block_num] = len(self.index)
+        self.index.append(block_num)
+        return True
+
+    # Writes the new records to the files (without waiting for the disk)
+    def flush(self):
+        if self.data_file is None:
+            return
+        # The data first, so an index entry never points past the data
+        self.data_file.flush()
+        self.index_file.flush()
+        self.flushed = len(self.index)
+
+    # Writes the new records and waits for the files to be on disk
+    def sync(self):
+        if self.data_file is None:
+            return
+        self.flush()
+        os.fsync(self.data_file.fileno())
+        os.fsync(self.index_file.fileno())
+
+    def close(self):
+        # Records that are still used keep the map open until they are
+        # released
+        self.map = None
+        if self.data_file is None:
+            return
+        self.sync()
+        self.data_file.close()
+        self.index_file.close()
+        self.data_file = None
+        self.index_file = None
+
+    # Returns a memoryview of the data file with at least count records
+    def view(self, count=None):
+        if count is None:
+            count = len(self.index)
+        if count > self.flushed:
+            self.flush()
+        if count == 0:
+            return memoryview(b"")
+        if self.map is None or len(self.map) < count * self.record_len:
+            # The file grew, map it again (the old map stays open until the
+            # records from it are released)
+            with open(self.path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self.map)[0 : count * self.record_len]
+
+    # Returns record number i (a memoryview of the data file)
+    def record(self, i):
+        return self.view(i + 1)[i * self.record_len : (i + 1) * self.record_len]
+
+    # Returns the records with the numbers in indices, without opening the
+    # archive or loading its index (e.g. in another process that was given the
+    # numbers by one that did)
+    def read_records(self, indices):
+        if len(indices) == 0:
+            return []
+        view = self.view(max(indices) + 1)
+        return [view[i * self.record_len : (i + 1) * self.record_len] for i in indices]
+
+    # Returns the last record for the block, or None if it isn't in the archive
+    def get(self, block_num):
+        i = self.records.get(block_num)
+        if i is None:
+            return None
+        return self.record(i)
+
+    # Returns the block numbers in the archive, in order
+    def block_nums(self):
+        if self.sorted_nums is None:
+            self.sorted_nums = sorted(self.records.keys())
+        return self.sorted_nums
+
+    # Yields (block number, last record) for every block from start to end (not
+    # including end) in the archive, in order of block number
+    def scan(self, start=0, end=None):
+        nums = self.block_nums()
+        lo = bisect.bisect_left(nums, start)
+        hi = len(nums) if end is None else bisect.bisect_left(nums, end)
+        view = self.view()
+        for num in nums[lo:hi]:
+            i = self.records[num]
+            yield (num, view[i * self.record_len : (i + 1) * self.record_len])
@@ -0,0 +1,261 @@
+# Microbenchmarks for the codec, parsing and conversion functions that every
+# received packet goes through
+# Each benchmark reports:
+# ops_per_s - calls per second (best of several repeats)
+# alloc_bytes_per_op - peak bytes allocated during one call (from tracemalloc)
+# retained_blocks_per_op - memory blocks still allocated after each call
+#     (should be 0, anything else is a leak or a growing cache)
+#
+# Save a baseline before a change and compare against it afterwards, e.g.:
+#     $ python benchmark_micro.py --save baseline.json
+#     $ python benchmark_micro.py --compare baseline.json
+# With --compare, benchmarks that are more than --threshold percent slower are
+# reported as regressions and the exit code is 1
+
+import argparse
+import contextlib
+import gc
+import inspect
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+import conversions
+from command_utilities import *
+from common import *
+from conversions import *
+from encoding import *
+from obc_emulator import *
+from packets import *
+from sections import *
+
+
+# Version of the JSON format, increase it when fields change meaning
+RESULTS_VERSION = 1
+
+# Number of times each benchmark is timed (the best one is used)
+NUM_REPEATS = 5
+
+# Sample arguments for every function in conversions.py
+# A function without an entry here is reported as missing, so new conversions
+# don't go unbenchmarked
+CONVERSION_ARGS = {
+    "adc_raw_to_ch_vol":                (0x800,),
+    "adc_ch_vol_to_raw":                (2.5,),
+    "adc_ch_vol_to_circ_vol":           (2.5, EPS_ADC_VOL_SENSE_LOW_RES, EPS_ADC_VOL_SENSE_HIGH_RES),
+    "adc_ch_vol_to_circ_cur":           (2.5, EPS_ADC_BAT_CUR_SENSE_RES, EPS_ADC_BAT_CUR_SENSE_VREF),
+    "adc_circ_cur_to_ch_vol":           (1.0, EPS_ADC_BAT_CUR_SENSE_RES, EPS_ADC_BAT_CUR_SENSE_VREF),
+    "adc_ch_vol_to_efuse_cur":          (2.5, EFUSE_IMON_SENSE_RES),
+    "adc_raw_to_circ_vol":              (0x800, EPS_ADC_VOL_SENSE_LOW_RES, EPS_ADC_VOL_SENSE_HIGH_RES),
+    "adc_raw_to_circ_cur":              (0x800, EPS_ADC_BAT_CUR_SENSE_RES, EPS_ADC_BAT_CUR_SENSE_VREF),
+    "adc_circ_cur_to_raw":              (1.0, EPS_ADC_BAT_CUR_SENSE_RES, EPS_ADC_BAT_CUR_SENSE_VREF),
+    "adc_raw_to_efuse_cur":             (0x800, EFUSE_IMON_SENSE_RES),
+    "adc_raw_to_therm_temp":            (0x800,),
+    "adc_therm_temp_to_raw":            (25.0,),
+    "dac_raw_data_to_vol":              (0x800,),
+    "dac_vol_to_raw_data":              (2.5,),
+    "dac_raw_data_to_heater_setpoint":  (0x800,),
+    "heater_setpoint_to_dac_raw_data":  (25.0,),
+    "hum_raw_data_to_humidity":         (0x2000,),
+    "pres_raw_data_to_pressure":        (10000000,),
+    "opt_adc_raw_to_ch_vol":            (0x200,),
+    "opt_power_raw_to_conv":            (0x200200,),
+    "opt_gain_raw_to_conv":             (0b10,),
+    "opt_int_time_raw_to_conv":         (3,),
+    "opt_raw_to_light_intensity":       (0x931234,),
+    "therm_res_to_temp":                (10.0,),
+    "therm_temp_to_res":                (25.0,),
+    "therm_res_to_vol":                 (10.0,),
+    "therm_vol_to_res":                 (1.25,),
+    "imu_raw_data_to_double":           (0xFF00, IMU_GYRO_Q),
+    "imu_raw_data_to_gyro":             (0xFF00,),
+}
+
+# Block types that process_data_block() handles
+DATA_BLOCK_TYPES = [
+    BlockType.OBC_HK,
+    BlockType.EPS_HK,
+    BlockType.PAY_HK,
+    BlockType.PAY_OPT_OD,
+    BlockType.PAY_OPT_FL,
+]
+
+
+# Returns the functions defined in conversions.py (not the ones it imports)
+def conversion_functions():
+    return [(name, func) for (name, func) in inspect.getmembers(conversions, inspect.isfunction)
+        if func.__module__ == conversions.__name__]
+
+# Returns the (TXPacket, RXPacket) of a READ_DATA_BLOCK command for the block
+def make_data_block_packets(flash, block_type, block_num, cmd_id):
+    tx_packet = TXPacket(cmd_id, CommandOpcode.READ_DATA_BLOCK, block_type, block_num)
+    data = flash.read_data_block(block_type, block_num)
+    rx_packet = RXPacket(encode_resp(cmd_id, PacketRespStatus.OK, data))
+    return (tx_packet, rx_packet)
+
+# Returns a list of (name, function with no arguments)
+def make_benchmarks():
+    flash = SyntheticFlash(dict((section, 1000) for section in COL_SECTIONS))
+    benchmarks = []
+
+    tx_packet = TXPacket(1, CommandOpcode.READ_DATA_BLOCK, BlockType.PAY_OPT_OD, 123)
+    enc_msg = tx_packet.enc_pkt
+    dec_msg = tx_packet.dec_pkt
+    benchmarks.append(("crc32", lambda: crc32(dec_msg, len(dec_msg))))
+    benchmarks.append(("encode_packet", lambda: encode_packet(dec_msg)))
+    benchmarks.append(("decode_packet", lambda: decode_packet(enc_msg)))
+    benchmarks.append(("TXPacket", lambda: TXPacket(1, CommandOpcode.READ_DATA_BLOCK, BlockType.PAY_OPT_OD, 123)))
+
+    # The largest response, and the one read the most
+    (opt_tx_packet, opt_rx_packet) = make_data_block_packets(flash, BlockType.PAY_OPT_OD, 123, 1)
+    resp_enc_msg = opt_rx_packet.enc_msg
+    benchmarks.append(("RXPacket", lambda: RXPacket(resp_enc_msg)))
+
+    for block_type in DATA_BLOCK_TYPES:
+        (tx_packet, rx_packet) = make_data_block_packets(flash, block_type, 123, block_type)
+        data = rx_packet.data
+        benchmarks.append(("parse_data[%s]" % block_type.name, lambda data=data: parse_data(data)))
+
+        Global.sent_packets.add(tx_packet)
+        benchmarks.append(("process_data_block[%s]" % block_type.name,
+            lambda rx_packet=rx_packet: process_data_block(rx_packet)))
+
+    for (name, func) in conversion_functions():
+        if name not in CONVERSION_ARGS:
+            print("No sample arguments for conversions.%s, add them to CONVERSION_ARGS" % name)
+            continue
+        args = CONVERSION_ARGS[name]
+        benchmarks.append(("conversions.%s" % name, lambda func=func, args=args: func(*args)))
+
+    return benchmarks
+
+
+# Times func, returns its dict of results
+# Output from func (e.g. process_data_block() printing every field) is
+# discarded
+def measure(func, min_time):
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            timer = timeit.Timer(func)
+            # Number of calls that take at least min_time
+            number = 1
+            while True:
+                if timer.timeit(number) >= min_time:
+                    break
+                number *= 2
+
+            best = min(timer.repeat(NUM_REPEATS, number))
+
+            # Warm up (e.g. caches) before counting memory
+            func()
+            tracemalloc.start()
+            start_bytes = tracemalloc.get_traced_memory()[0]
+            func()
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            gc.collect()
+            start_blocks = sys.getallocatedblocks()
+            for i in range(number):
+                func()
+            gc.collect()
+            retained_blocks = sys.getallocatedblocks() - start_blocks
+
+    return {
+        "ops_per_s": number / best,
+        "alloc_bytes_per_op": peak_bytes - start_bytes,
+        "retained_blocks_per_op": retained_blocks / number,
+    }
+
+
+def print_result(name, result, baseline=None):
+    line = "%-45s %12.0f ops/s %8d B/op %6.2f blocks/op" % (name,
+        result["ops_per_s"], result["alloc_bytes_per_op"], result["retained_blocks_per_op"])
+    if baseline is not None:
+        line += "  %+6.1f%%" % ((result["ops_per_s"] / baseline["ops_per_s"] - 1.0) * 100.0)
+    print(line)
+
+
+if __name__ == "__main__":
+    check_python3()
+
+    parser = argparse.ArgumentParser(description=("Codec, parsing and conversion microbenchmarks"))
+    parser.add_argument('-f', '--filter', required=False, default=None,
+            metavar=('filter'), help='Only run benchmarks with this in their name')
+    parser.add_argument('-t', '--min-time', required=False, default=0.05,
+            metavar=('min_time'), help='Minimum seconds for each timing repeat')
+    parser.add_argument('-s', '--save', required=False, default=None,
+            metavar=('file'), help='Save the results as a JSON baseline')
+    parser.add_argument('-c', '--compare', required=False, default=None,
+            metavar=('file'), help='Compare the results to a saved baseline')
+    parser.add_argument('--threshold', required=False, default=10.0,
+            metavar=('percent'), help='Slowdown (in %%) reported as a regression with --compare')
+
+    args = parser.parse_args()
+    min_time = float(args.min_time)
+    threshold = float(args.threshold)
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)["results"]
+
+    # process_data_block() writes every block to its section file
+    cwd = os.getcwd()
+    work_dir = tempfile.TemporaryDirectory()
+    os.chdir(work_dir.name)
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            for section in g_all_sections:
+                section.load_file()
+
+    results = {}
+    errors = {}
+    regressions = []
+    try:
+        for (name, func) in make_benchmarks():
+            if args.filter is not None and args.filter not in name:
+                continue
+
+            try:
+                result = measure(func, min_time)
+            except Exception as e:
+                # Report it and keep going with the rest
+                errors[name] = "%s: %s" % (type(e).__name__, e)
+                print("%-45s ERROR %s" % (name, errors[name]))
+                continue
+
+            results[name] = result
+            base = None if baseline is None else baseline.get(name)
+            print_result(name, result, base)
+            if base is not None and result["ops_per_s"] < base["ops_per_s"] * (1.0 - threshold / 100.0):
+                regressions.append(name)
+    finally:
+        close_all_sections()
+        os.chdir(cwd)
+        work_dir.cleanup()
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump({
+                "version": RESULTS_VERSION,
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "results": results,
+                "errors": errors,
+            }, f, indent=4)
+        print("Saved results to %s" % args.save)
+
+    if baseline is not None:
+        if len(regressions) > 0:
+            print("%d regressions (more than %.1f%% slower):" % (len(regressions), threshold))
+            for name in regressions:
+                print("    " + name)
+            sys.exit(1)
+        print("No regressions")
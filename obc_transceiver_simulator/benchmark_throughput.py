@@ -0,0 +1,268 @@
+# End-to-end download throughput benchmark
+# Runs the simulator's own download functions (read_missing_blocks(),
+# read_missing_sec_cmd_log_blocks()) and single command round trips against
+# an in-process OBC emulator, over simulated links with every combination of
+# the given baud rates and loss profiles
+# Results are printed as a table and written to a JSON file, e.g.:
+#     $ python benchmark_throughput.py -b 9600,115200 -p ideal,lossy -o results.json
+#
+# Metrics for each run:
+# blocks_per_s - data and command log blocks saved per second
+# goodput_bytes_per_s - bytes of block data saved per second
+# raw_bytes_per_s - bytes sent over the air in both directions per second
+#     (including lost packets and protocol overhead)
+# goodput_ratio - goodput / raw bytes
+# retransmission_ratio - TX packets that were sent again / all TX packets
+# latency_p50_s, latency_p99_s - command round trip time (ping runs only)
+# complete - whether every block was saved or every ping succeeded
+# missing_blocks - blocks that were never saved (a command counts as successful
+#     once it is ACKed, so a lost response leaves its block missing even
+#     though the download reports success)
+# A run that isn't complete is a failure, the benchmark exits with status 1
+# after writing the results if there were any
+
+import argparse
+import contextlib
+import json
+import math
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from channel import *
+from command_utilities import *
+from common import *
+from obc_emulator import *
+from packets import *
+from rtt import *
+from sections import *
+from transport import *
+
+
+# Version of the JSON format, increase it when fields change meaning
+RESULTS_VERSION = 1
+
+# Channel descriptions (see parse_channel()) for each loss profile, as
+# (uplink, downlink)
+# The baud rate of the run is added as the rate of both channels
+LOSS_PROFILES = {
+    "ideal":    ("", ""),
+    "lossy":    ("loss=0.05", "loss=0.05"),
+    "bursty":   ("loss=0.05,burst_len=5", "loss=0.05,burst_len=5"),
+    "noisy":    ("ber=1e-4", "ber=1e-4"),
+    "pass":     ("loss=0.02,burst_len=3,ber=1e-5,latency=0.05,jitter=0.02",
+                 "loss=0.1,burst_len=4,ber=5e-5,latency=0.05,jitter=0.02"),
+}
+
+SCENARIOS = ["missing_blocks", "sec_cmd_log", "ping"]
+
+
+# Returns the value at percentile pct (0-100) of values, by nearest rank
+def percentile(values, pct):
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    rank = max(int(math.ceil(pct / 100.0 * len(ordered))) - 1, 0)
+    return ordered[rank]
+
+# Bytes of data in one block of the section
+def section_block_size(section):
+    if section in g_all_cmd_log_sections:
+        return CMD_BLOCK_LEN
+    return data_block_len(section.mapping)
+
+# Number of blocks from 0 to num_blocks that weren't saved in the section
+def num_missing_blocks(section, num_blocks):
+    return sum(end - start for (start, end) in section.blocks.missing(0, num_blocks))
+
+# Resets the simulator's state so every run starts from scratch
+def reset_state():
+    Global.cmd_id = 1
+    Global.sent_packets = SentPacketTable()
+    Global.rtt = RTTTable()
+    Global.deframer = Deframer()
+    Global.pending = PendingPackets()
+    Global.tx_packets = 0
+    Global.retransmissions = 0
+
+    for section in g_all_sections:
+        section.file_block_num = 0
+        section.sat_block_num = 0
+        section.load_file()
+
+
+# Runs one scenario, returns its dict of results
+def run(scenario, baud, profile, window_size, num_blocks, num_pings, seed):
+    (uplink_spec, downlink_spec) = LOSS_PROFILES[profile]
+    rate = "rate=%d" % baud
+    uplink = parse_channel(",".join(filter(None, [uplink_spec, rate])), seed)
+    downlink = parse_channel(",".join(filter(None, [downlink_spec, rate])), seed + 1)
+
+    (ground, obc) = make_loopback_pair()
+    channel = ChannelTransport(ground, uplink, downlink)
+    emulator = OBCEmulator(obc, parse_block_counts("", num_blocks))
+
+    Global.transport = channel
+    Global.channel = channel
+    Global.window_size = window_size
+    reset_state()
+
+    emulator.start()
+    Global.reader = SerialReader(channel, Global.deframer)
+    Global.reader.start()
+
+    latencies = []
+    missing_blocks = 0
+    start_time = time.time()
+    if scenario == "missing_blocks":
+        read_missing_blocks()
+        missing_blocks = sum(num_missing_blocks(section, num_blocks)
+            for section in g_all_read_data_sections + [prim_cmd_log_section])
+        complete = missing_blocks == 0
+    elif scenario == "sec_cmd_log":
+        read_missing_sec_cmd_log_blocks()
+        missing_blocks = num_missing_blocks(sec_cmd_log_section, num_blocks)
+        complete = missing_blocks == 0
+    else:
+        complete = True
+        for i in range(num_pings):
+            send_time = time.time()
+            if send_and_receive_packet(CommandOpcode.PING_OBC):
+                latencies.append(time.time() - send_time)
+            else:
+                complete = False
+    elapsed = time.time() - start_time
+
+    Global.reader.stop()
+    Global.reader = None
+    emulator.stop()
+    channel.close()
+    close_all_sections()
+
+    blocks = 0
+    goodput_bytes = 0
+    for section in g_all_read_sections:
+        blocks += len(section.blocks)
+        goodput_bytes += len(section.blocks) * section_block_size(section)
+    raw_bytes = uplink.num_bytes + downlink.num_bytes
+
+    return {
+        "scenario": scenario,
+        "baud": baud,
+        "profile": profile,
+        "window_size": window_size,
+        "complete": complete,
+        "missing_blocks": missing_blocks,
+        "seconds": elapsed,
+        "blocks": blocks,
+        "blocks_per_s": blocks / elapsed,
+        "goodput_bytes": goodput_bytes,
+        "raw_bytes": raw_bytes,
+        "goodput_bytes_per_s": goodput_bytes / elapsed,
+        "raw_bytes_per_s": raw_bytes / elapsed,
+        "goodput_ratio": 0.0 if raw_bytes == 0 else goodput_bytes / raw_bytes,
+        "tx_packets": Global.tx_packets,
+        "retransmissions": Global.retransmissions,
+        "retransmission_ratio": 0.0 if Global.tx_packets == 0 else Global.retransmissions / Global.tx_packets,
+        "latency_p50_s": percentile(latencies, 50),
+        "latency_p99_s": percentile(latencies, 99),
+        "uplink": str(uplink),
+        "downlink": str(downlink),
+    }
+
+
+def print_result(result):
+    latency = ""
+    if result["latency_p50_s"] is not None:
+        latency = "p50 %.3fs p99 %.3fs" % (result["latency_p50_s"], result["latency_p99_s"])
+    missing = ""
+    if result["missing_blocks"] > 0:
+        missing = "%d blocks missing" % result["missing_blocks"]
+    print("%-15s %7d %-8s %3d %-4s %8.2fs %8.2f blk/s %9.1f B/s %5.1f%% goodput %5.1f%% retx %s%s" % (
+        result["scenario"], result["baud"], result["profile"], result["window_size"],
+        "done" if result["complete"] else "FAIL", result["seconds"], result["blocks_per_s"],
+        result["goodput_bytes_per_s"], result["goodput_ratio"] * 100.0,
+        result["retransmission_ratio"] * 100.0, latency, missing))
+
+
+if __name__ == "__main__":
+    check_python3()
+
+    parser = argparse.ArgumentParser(description=("End-to-end download throughput benchmark"))
+    parser.add_argument('-b', '--bauds', required=False, default="9600,115200",
+            metavar=('bauds'), help='Comma-separated baud rates')
+    parser.add_argument('-p', '--profiles', required=False, default=",".join(LOSS_PROFILES.keys()),
+            metavar=('profiles'), help='Comma-separated loss profiles (%s)' % ", ".join(LOSS_PROFILES.keys()))
+    parser.add_argument('-s', '--scenarios', required=False, default=",".join(SCENARIOS),
+            metavar=('scenarios'), help='Comma-separated scenarios (%s)' % ", ".join(SCENARIOS))
+    parser.add_argument('-w', '--windows', required=False, default="1,4",
+            metavar=('windows'), help='Comma-separated command window sizes')
+    parser.add_argument('-n', '--num-blocks', required=False, default=20,
+            metavar=('num_blocks'), help='Number of blocks in every section of the emulated OBC')
+    parser.add_argument('-r', '--num-pings', required=False, default=50,
+            metavar=('num_pings'), help='Number of round trips for the ping scenario')
+    parser.add_argument('--seed', required=False, default=1,
+            metavar=('seed'), help='Random seed for the simulated channels')
+    parser.add_argument('-o', '--output', required=False, default="benchmark_results.json",
+            metavar=('output'), help='JSON file to write the results to')
+
+    args = parser.parse_args()
+    bauds = [int(baud) for baud in args.bauds.split(",")]
+    profiles = args.profiles.split(",")
+    scenarios = args.scenarios.split(",")
+    windows = [int(window) for window in args.windows.split(",")]
+    output = os.path.abspath(args.output)
+
+    for profile in profiles:
+        if profile not in LOSS_PROFILES:
+            print("Unknown loss profile %s" % profile)
+            sys.exit(1)
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            print("Unknown scenario %s" % scenario)
+            sys.exit(1)
+
+    # Section files and serial logs go in a temporary folder
+    cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp()
+    os.chdir(work_dir)
+
+    results = []
+    try:
+        for scenario in scenarios:
+            for baud in bauds:
+                for profile in profiles:
+                    # The window size doesn't matter for single round trips
+                    for window_size in (windows if scenario != "ping" else [1]):
+                        # Hide the simulator's output for every packet
+                        with open(os.devnull, 'w') as devnull:
+                            with contextlib.redirect_stdout(devnull):
+                                result = run(scenario, baud, profile, window_size,
+                                    int(args.num_blocks), int(args.num_pings), int(args.seed))
+                            shutil.rmtree(OUT_FOLDER)
+                        print_result(result)
+                        results.append(result)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir)
+
+    with open(output, 'w') as f:
+        json.dump({
+            "version": RESULTS_VERSION,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "num_blocks": int(args.num_blocks),
+            "num_pings": int(args.num_pings),
+            "seed": int(args.seed),
+            "results": results,
+        }, f, indent=4)
+    print("Wrote results to %s" % output)
+
+    failed = [result for result in results if not result["complete"]]
+    if len(failed) > 0:
+        print("%d/%d runs FAILED (blocks missing or pings failed)" % (len(failed), len(results)))
+        sys.exit(1)
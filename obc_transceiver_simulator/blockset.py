@@ -0,0 +1,152 @@
+"""
+Sets of block numbers, stored as sorted ranges, used to track which blocks of
+each section have been received so read_missing_blocks() can fill holes
+anywhere in a section file instead of only reading past its last row.
+Each section's set is saved next to its file (<file>.blocks) with the length
+of the file it was built from, so it only has to be rebuilt from the rows
+added since (or from the whole file if that doesn't match).
+"""
+
+import bisect
+import json
+import os
+
+
+# Version of the file format, increase it when it changes
+BLOCK_SET_FILE_VERSION = 1
+
+
+# Set of non-negative block numbers
+# ranges is a sorted list of [start, end) pairs that don't touch or overlap, so
+# consecutive blocks (the usual case) take up one range
+class BlockSet(object):
+    def __init__(self, ranges=None):
+        self.ranges = []
+        if ranges is not None:
+            for (start, end) in ranges:
+                self.add_range(start, end)
+
+    def __str__(self):
+        return "blocks = %d, ranges = %s" % (len(self), ", ".join(
+            "%d-%d" % (start, end - 1) for (start, end) in self.ranges[:8]) +
+            (", ..." if len(self.ranges) > 8 else ""))
+
+    def __len__(self):
+        return sum(end - start for (start, end) in self.ranges)
+
+    def __contains__(self, num):
+        i = bisect.bisect_right(self.ranges, [num, float("inf")]) - 1
+        return i >= 0 and num < self.ranges[i][1]
+
+    # Returns the smallest block number, or None if the set is empty
+    def first(self):
+        if len(self.ranges) == 0:
+            return None
+        return self.ranges[0][0]
+
+    def add(self, num):
+        # Blocks are usually received in order, so check the last range first
+        if len(self.ranges) > 0 and self.ranges[-1][0] <= num:
+            last = self.ranges[-1]
+            if num < last[1]:
+                return
+            if num == last[1]:
+                last[1] += 1
+                return
+            self.ranges.append([num, num + 1])
+            return
+        self.add_range(num, num + 1)
+
+    # Adds the blocks from start to end (not including end)
+    def add_range(self, start, end):
+        if start >= end:
+            return
+        # Merge every range that overlaps or touches [start, end)
+        lo = bisect.bisect_left(self.ranges, [start, start])
+        if lo > 0 and self.ranges[lo - 1][1] >= start:
+            lo -= 1
+        hi = lo
+        while hi < len(self.ranges) and self.ranges[hi][0] <= end:
+            hi += 1
+        if lo < hi:
+            start = min(start, self.ranges[lo][0])
+            end = max(end, self.ranges[hi - 1][1])
+        self.ranges[lo:hi] = [[start, end]]
+
+    # Returns the list of [start, end) ranges from start to end that are not in
+    # the set
+    def missing(self, start, end):
+        missing = []
+        for (range_start, range_end) in self.ranges:
+            if range_end <= start:
+                continue
+            if range_start >= end:
+                break
+            if range_start > start:
+                missing.append([start, range_start])
+            start = max(start, range_end)
+        if start < end:
+            missing.append([start, end])
+        return missing
+
+
+# Returns the block number of a row of a section file (as bytes), or None if it
+# isn't a block (the header, a block number from Section.set_file_block_num(),
+# or a corrupted row)
+def row_block_num(line):
+    fields = line.split(b",", 1)
+    if len(fields) < 2:
+        return None
+    try:
+        return int(fields[0].strip())
+    except ValueError:
+        return None
+
+# Adds the blocks in the rows of the file at path from offset to the end
+def add_file_blocks(blocks, path, offset=0):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            num = row_block_num(line)
+            if num is not None and num >= 0:
+                blocks.add(num)
+
+# Returns the BlockSet of the section file at data_path, using the set saved
+# at set_path if it is up to date
+def load_block_set(set_path, data_path):
+    size = os.path.getsize(data_path) if os.path.exists(data_path) else 0
+
+    saved = None
+    if os.path.exists(set_path):
+        try:
+            with open(set_path, 'r') as f:
+                saved = json.load(f)
+        except ValueError:
+            # Not completely written
+            saved = None
+    if saved is not None and saved.get("version") != BLOCK_SET_FILE_VERSION:
+        saved = None
+
+    # Rows are only ever added to the end of a section file, so if it is
+    # longer only the new rows need to be read
+    if saved is not None and saved["size"] <= size:
+        blocks = BlockSet(saved["ranges"])
+        offset = saved["size"]
+    else:
+        blocks = BlockSet()
+        offset = 0
+    if size > offset:
+        add_file_blocks(blocks, data_path, offset)
+    return blocks
+
+# Saves blocks, built from a section file of size bytes
+def save_block_set(blocks, set_path, size):
+    # Write a new file and replace the old one, so it is never half written
+    tmp_path = set_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({
+            "version": BLOCK_SET_FILE_VERSION,
+            "size": size,
+            "ranges": blocks.ranges,
+        }, f)
+    os.replace(tmp_path, set_path)
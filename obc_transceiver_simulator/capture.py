@@ -0,0 +1,260 @@
+"""
+Binary capture of the bytes sent and received on the link to OBC, in place of
+the old serial_write.log and serial_read.log text files.
+The file (out/serial.cap) starts with CAPTURE_MAGIC and the format version,
+then has one record for every write to the transport and every read from it:
+- timestamp (int64, time.monotonic_ns() when the bytes were written or read)
+- direction (uint8, CAPTURE_TX, CAPTURE_RX, or CAPTURE_SESSION)
+- length (uint32)
+- the bytes, exactly as they were sent or received
+Every time the simulator starts it adds a CAPTURE_SESSION record, whose data
+is the wall clock time (int64, time.time_ns()) at the same moment as its
+timestamp, since monotonic timestamps from different sessions can't be
+compared.
+Records are added to a buffer and written by a background thread, so logging
+doesn't wait for the disk.
+Run this file to convert a capture to the old text files, or to follow it
+live, e.g.:
+    $ python capture.py out/serial.cap
+    $ python capture.py -f out/serial.cap
+"""
+
+import argparse
+import os
+import struct
+import sys
+import threading
+import time
+
+from common import *
+from sections import OUT_FOLDER
+
+
+CAPTURE_MAGIC = b"OBCCAP"
+CAPTURE_VERSION = 1
+CAPTURE_FILE_HEADER = struct.Struct("<6sH")
+# Timestamp, direction, length
+CAPTURE_RECORD_HEADER = struct.Struct("<qBI")
+
+# Bytes sent to OBC
+CAPTURE_TX = 0
+# Bytes received from OBC
+CAPTURE_RX = 1
+# Start of a session
+CAPTURE_SESSION = 2
+
+# Longest time (in ms) a record waits in the buffer before it is written
+CAPTURE_FLUSH_MS = 200
+# Size of the buffer that makes it be written right away
+CAPTURE_BUFFER_SIZE = 1 << 16
+
+
+# Returns (end, count): the offset after the last complete record in the file
+# f (positioned after the file header) and the number of records
+def capture_end(f):
+    end = f.tell()
+    count = 0
+    while True:
+        header = f.read(CAPTURE_RECORD_HEADER.size)
+        if len(header) < CAPTURE_RECORD_HEADER.size:
+            return (end, count)
+        (timestamp, direction, length) = CAPTURE_RECORD_HEADER.unpack(header)
+        f.seek(length, os.SEEK_CUR)
+        if f.tell() > os.fstat(f.fileno()).st_size:
+            return (end, count)
+        end = f.tell()
+        count += 1
+
+# Reads the file header of the capture file f
+# Raises ValueError if it isn't a capture file
+def read_capture_header(f):
+    header = f.read(CAPTURE_FILE_HEADER.size)
+    if len(header) < CAPTURE_FILE_HEADER.size:
+        raise ValueError("Capture file is too short")
+    (magic, version) = CAPTURE_FILE_HEADER.unpack(header)
+    if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+        raise ValueError("Not a version %d capture file" % CAPTURE_VERSION)
+
+
+class CaptureWriter(object):
+    def __init__(self, path, flush_ms=CAPTURE_FLUSH_MS, buffer_size=CAPTURE_BUFFER_SIZE):
+        self.path = path
+        self.flush_ms = flush_ms
+        self.buffer_size = buffer_size
+
+        self.file = None
+        # Records that haven't been written to the file yet
+        self.buffer = bytearray()
+        # Protects buffer, notified when it is full or the writer is closed
+        self.cond = threading.Condition()
+        # Protects file
+        self.file_lock = threading.Lock()
+        self.running = False
+        self.thread = None
+
+        self.num_records = 0
+        self.num_bytes = 0
+
+    def __str__(self):
+        return "Capture: records = %d, bytes = %d, buffered bytes = %d" % (self.num_records,
+            self.num_bytes, len(self.buffer))
+
+    # Opens the file (adding to it if it exists) and starts a new session
+    # A record that is only partly written (e.g. if the simulator was killed)
+    # is removed
+    # Raises ValueError if the file exists and isn't a capture file
+    def open(self):
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            with open(self.path, 'r+b') as f:
+                read_capture_header(f)
+                (end, count) = capture_end(f)
+                if os.path.getsize(self.path) > end:
+                    print("Removing %d bytes of an incomplete record from %s" % (
+                        os.path.getsize(self.path) - end, self.path))
+                    f.truncate(end)
+            self.file = open(self.path, 'ab')
+        else:
+            self.file = open(self.path, 'wb')
+            self.file.write(CAPTURE_FILE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION))
+
+        self.add(CAPTURE_SESSION, struct.pack("<q", time.time_ns()))
+        self.running = True
+        # Daemon thread so it never stops the simulator from quitting
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+    # Adds a record for data (bytes) to the buffer
+    def add(self, direction, data):
+        with self.cond:
+            self.buffer += CAPTURE_RECORD_HEADER.pack(time.monotonic_ns(), direction, len(data))
+            self.buffer += data
+            self.num_records += 1
+            self.num_bytes += len(data)
+            if len(self.buffer) >= self.buffer_size:
+                self.cond.notify()
+
+    def write_tx(self, data):
+        self.add(CAPTURE_TX, data)
+
+    def write_rx(self, data):
+        # The background reader and read_serial() call this with nothing
+        # when nothing was received
+        if len(data) > 0:
+            self.add(CAPTURE_RX, data)
+
+    # Writes the buffered records to the file
+    def flush(self):
+        with self.file_lock:
+            with self.cond:
+                (data, self.buffer) = (self.buffer, bytearray())
+            if self.file is not None and len(data) > 0:
+                self.file.write(data)
+                self.file.flush()
+
+    def write_loop(self):
+        while self.running:
+            with self.cond:
+                if self.running and len(self.buffer) < self.buffer_size:
+                    self.cond.wait(self.flush_ms / 1000)
+            self.flush()
+
+    def close(self):
+        if self.thread is not None:
+            with self.cond:
+                self.running = False
+                self.cond.notify()
+            self.thread.join()
+            self.thread = None
+        self.flush()
+        with self.file_lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+# Yields (timestamp, direction, data) for every record in the capture file at
+# path
+# If follow is True, waits for more records at the end of the file instead of
+# stopping (until interrupted)
+def read_capture(path, follow=False):
+    with open(path, 'rb') as f:
+        read_capture_header(f)
+        while True:
+            offset = f.tell()
+            header = f.read(CAPTURE_RECORD_HEADER.size)
+            if len(header) == CAPTURE_RECORD_HEADER.size:
+                (timestamp, direction, length) = CAPTURE_RECORD_HEADER.unpack(header)
+                data = f.read(length)
+                if len(data) == length:
+                    yield (timestamp, direction, data)
+                    continue
+
+            # End of the file, or a record that is still being written
+            if not follow:
+                return
+            f.seek(offset)
+            time.sleep(0.1)
+
+# Returns bytes as text in the format of the old log files
+def capture_data_to_str(data):
+    # Calling str(data) will give a string like: "b'U\\x0fU\\x00'"
+    # Remove b' at the beginning and ' at the end
+    return str(data)[2:-1]
+
+# Yields a line of text for each record, e.g.
+# 2026-01-01 12:00:00.123456 TX U\x0fU...
+def capture_lines(records):
+    # Wall clock time (ns) minus monotonic time in the current session
+    offset = 0
+    for (timestamp, direction, data) in records:
+        if direction == CAPTURE_SESSION:
+            offset = struct.unpack("<q", data)[0] - timestamp
+            line_data = "Session started"
+        else:
+            line_data = capture_data_to_str(data)
+
+        wall_time = timestamp + offset
+        yield "%s.%06d %s %s" % (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(wall_time // 10 ** 9)),
+            (wall_time % 10 ** 9) // 1000, ["TX", "RX", "--"][direction], line_data)
+
+# Writes the capture file at path as the old serial_write.log and
+# serial_read.log files (the sent and received bytes as escaped text, with no
+# timestamps)
+# Returns the number of records
+def capture_to_text(path, write_path, read_path):
+    count = 0
+    with open(write_path, 'w') as write_file, open(read_path, 'w') as read_file:
+        for (timestamp, direction, data) in read_capture(path):
+            if direction == CAPTURE_TX:
+                write_file.write(capture_data_to_str(data))
+            elif direction == CAPTURE_RX:
+                read_file.write(capture_data_to_str(data))
+            count += 1
+    return count
+
+
+if __name__ == "__main__":
+    check_python3()
+
+    parser = argparse.ArgumentParser(description=("Convert a serial capture file to text"))
+    parser.add_argument('file', nargs='?', default=os.path.join(OUT_FOLDER, "serial.cap"),
+            help='Capture file (default: %s)' % os.path.join(OUT_FOLDER, "serial.cap"))
+    parser.add_argument('-o', '--output', required=False, default=OUT_FOLDER,
+            metavar=('folder'), help='Folder to write serial_write.log and serial_read.log to')
+    parser.add_argument('-f', '--follow', required=False, action='store_true',
+            help='Print every record with its time and direction as it is captured instead')
+
+    args = parser.parse_args()
+
+    if args.follow:
+        try:
+            for line in capture_lines(read_capture(args.file, follow=True)):
+                print(line, flush=True)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    write_path = os.path.join(args.output, "serial_write.log")
+    read_path = os.path.join(args.output, "serial_read.log")
+    count = capture_to_text(args.file, write_path, read_path)
+    print("Converted %d records to %s and %s" % (count, write_path, read_path))
@@ -0,0 +1,281 @@
+"""
+Model of the radio link between the ground station and the satellite, so the
+simulator sees the losses, bit errors, delays and limited bitrate of a real
+pass instead of an infinitely fast link.
+A ChannelTransport wraps any transport (transport.py) and runs every packet in
+each direction through a ChannelModel. The models use their own seeded random
+number generators, so the same seed and the same packets give the same
+impairments every run.
+"""
+
+import collections
+import math
+import random
+import threading
+import time
+
+from common import *
+from packets import *
+from transport import *
+
+
+# One Gilbert-Elliott channel (two-state Markov chain of good and bad link
+# conditions) with bit errors, latency and a bitrate cap for one direction
+# Every packet is one transmission over the air:
+# - The channel first moves between the good and bad states (p is the
+#   probability of going from good to bad, r from bad to good)
+# - The packet is lost with probability loss_good or loss_bad for that state
+# - Every bit of a packet that gets through is flipped with probability ber
+#   (so the receiver sees a checksum error)
+# - The packet arrives latency + uniform(0, jitter) seconds after it is sent,
+#   in the order it was sent, and after the packets before it have been sent
+#   at rate bits/s (None for no limit) with up to burst bytes sent at once
+class ChannelModel(object):
+    def __init__(self, p=0.0, r=1.0, loss_good=0.0, loss_bad=1.0, ber=0.0,
+            latency=0.0, jitter=0.0, rate=None, burst=0, seed=None):
+        self.p = p
+        self.r = r
+        self.loss_good = loss_good
+        self.loss_bad = loss_bad
+        self.ber = ber
+        self.latency = latency
+        self.jitter = jitter
+        self.rate = rate
+        self.burst = burst
+
+        self.random = random.Random(seed)
+        self.bad = False
+        # Token bucket (in bytes) for the bitrate cap, full at the start
+        self.tokens = burst
+        self.tokens_time = None
+        # Time the last packet arrives, so packets are never reordered
+        self.last_arrival = 0.0
+
+        self.num_packets = 0
+        self.num_bytes = 0
+        self.lost_packets = 0
+        self.corrupted_packets = 0
+        self.bit_errors = 0
+
+    def __str__(self):
+        return "packets = %d, bytes = %d, lost packets = %d, corrupted packets = %d, bit errors = %d" \
+            % (self.num_packets, self.num_bytes, self.lost_packets, self.corrupted_packets, self.bit_errors)
+
+    # Returns True if the channel doesn't change anything that is sent
+    def is_ideal(self):
+        return (self.p == 0.0 and self.loss_good == 0.0 and self.ber == 0.0 and
+            self.latency == 0.0 and self.jitter == 0.0 and self.rate is None)
+
+    # Moves the Markov chain one step, returns True if the packet is lost
+    def lose_packet(self):
+        if self.bad:
+            if self.random.random() < self.r:
+                self.bad = False
+        else:
+            if self.random.random() < self.p:
+                self.bad = True
+
+        loss = self.loss_bad if self.bad else self.loss_good
+        return self.random.random() < loss
+
+    # Flips random bits in data (a bytearray)
+    # Skips straight to the next error with a geometric distribution instead
+    # of drawing a random number for every bit
+    def add_bit_errors(self, data):
+        if self.ber <= 0.0:
+            return 0
+
+        num_bits = len(data) * 8
+        if self.ber >= 1.0:
+            for i in range(len(data)):
+                data[i] ^= 0xFF
+            return num_bits
+
+        log_no_error = math.log(1.0 - self.ber)
+        count = 0
+        bit = -1
+        while True:
+            # 1 - random() is in (0, 1], so the log is defined
+            bit += 1 + int(math.log(1.0 - self.random.random()) / log_no_error)
+            if bit >= num_bits:
+                break
+            data[bit // 8] ^= 0x80 >> (bit % 8)
+            count += 1
+        return count
+
+    # Returns the time (from time.time()) the last byte of a packet of size
+    # bytes finishes being sent if it is sent at now
+    def send_finish_time(self, size, now):
+        if self.rate is None:
+            return now
+
+        byte_rate = self.rate / 8.0
+        if self.tokens_time is None:
+            self.tokens_time = now
+        start = max(now, self.tokens_time)
+        self.tokens = min(self.burst, self.tokens + (start - self.tokens_time) * byte_rate)
+
+        if self.tokens >= size:
+            self.tokens -= size
+            self.tokens_time = start
+        else:
+            # Wait for the missing tokens, which are then all used
+            self.tokens_time = start + (size - self.tokens) / byte_rate
+            self.tokens = 0
+        return self.tokens_time
+
+    # Sends one packet at time now
+    # Returns (arrival time, bytes received), or None if the packet is lost
+    def transmit(self, data, now):
+        self.num_packets += 1
+        self.num_bytes += len(data)
+
+        # The packet takes up the link whether or not it arrives
+        finish = self.send_finish_time(len(data), now)
+
+        if self.lose_packet():
+            self.lost_packets += 1
+            return None
+
+        data = bytearray(data)
+        errors = self.add_bit_errors(data)
+        if errors > 0:
+            self.corrupted_packets += 1
+            self.bit_errors += errors
+
+        arrival = finish + self.latency
+        if self.jitter > 0.0:
+            arrival += self.random.uniform(0, self.jitter)
+        arrival = max(arrival, self.last_arrival)
+        self.last_arrival = arrival
+        return (arrival, bytes(data))
+
+
+# Parses a channel description like "loss=0.1,burst_len=4,ber=1e-5,rate=9600"
+# into a ChannelModel
+# Keys are the ChannelModel arguments, plus:
+# loss - average packet loss ratio
+# burst_len - average number of packets lost in a row (default 1 for
+#     independent losses)
+# These set p and r for a channel that loses every packet in the bad state
+def parse_channel(string, seed=None):
+    args = {}
+    if string is not None and len(string) > 0:
+        for item in string.split(","):
+            (key, value) = item.split("=")
+            args[key.strip()] = float(value)
+
+    loss = args.pop("loss", None)
+    burst_len = args.pop("burst_len", 1.0)
+    if loss is not None:
+        if loss >= 1.0:
+            (args["p"], args["r"]) = (1.0, 0.0)
+        else:
+            args["r"] = 1.0 / burst_len
+            args["p"] = min(loss * args["r"] / (1.0 - loss), 1.0)
+        args["loss_good"] = 0.0
+        args["loss_bad"] = 1.0
+
+    if "burst" in args:
+        args["burst"] = int(args["burst"])
+    return ChannelModel(seed=seed, **args)
+
+
+# Packets waiting to arrive, in order of arrival time
+class DelayLine(object):
+    def __init__(self):
+        self.packets = collections.deque()
+
+    def __len__(self):
+        return len(self.packets)
+
+    def add(self, arrival, data):
+        self.packets.append((arrival, data))
+
+    # Returns the arrival time of the next packet, or None
+    def next_arrival(self):
+        if len(self.packets) == 0:
+            return None
+        return self.packets[0][0]
+
+    # Removes and returns the bytes of all packets that have arrived by now
+    def take(self, now):
+        data = bytearray()
+        while len(self.packets) > 0 and self.packets[0][0] <= now:
+            data += self.packets.popleft()[1]
+        return bytes(data)
+
+
+# Runs a transport through an uplink (written) and downlink (read) channel
+# Each write() is one packet, as the simulator and the OBC emulator write one
+# encoded packet at a time. Received bytes are split back into packets with a
+# Deframer before going through the downlink channel, so bytes that are not
+# part of a valid packet never reach the simulator (in simulation, all such
+# bytes come from the channel model anyway).
+class ChannelTransport(Transport):
+    def __init__(self, transport, uplink, downlink):
+        super().__init__(transport.timeout)
+        self.transport = transport
+        self.uplink = uplink
+        self.downlink = downlink
+
+        # Encoded packets are yielded as bytes
+        self.rx_deframer = Deframer(bytes)
+        self.rx_line = DelayLine()
+
+        # Delayed uplink packets are sent by a background thread
+        self.tx_line = DelayLine()
+        self.tx_cond = threading.Condition()
+        self.running = True
+        self.tx_thread = threading.Thread(target=self.tx_loop, daemon=True)
+        self.tx_thread.start()
+
+    def __str__(self):
+        return "Uplink channel: %s\nDownlink channel: %s" % (self.uplink, self.downlink)
+
+    def tx_loop(self):
+        with self.tx_cond:
+            while self.running:
+                arrival = self.tx_line.next_arrival()
+                if arrival is None:
+                    self.tx_cond.wait()
+                elif arrival > time.time():
+                    self.tx_cond.wait(arrival - time.time())
+                else:
+                    self.transport.write(self.tx_line.take(time.time()))
+
+    def send(self, data):
+        with self.tx_cond:
+            result = self.uplink.transmit(data, time.time())
+            if result is not None:
+                self.tx_line.add(*result)
+                self.tx_cond.notify()
+
+    def recv(self, timeout):
+        end_time = time.time() + timeout
+        while True:
+            now = time.time()
+            data = self.rx_line.take(now)
+            if len(data) > 0:
+                return data
+
+            # Wait for more bytes, but not past the next arrival
+            wait = end_time - now
+            arrival = self.rx_line.next_arrival()
+            if arrival is not None:
+                wait = min(wait, arrival - now)
+            for packet in self.rx_deframer.feed(self.transport.recv(max(wait, 0))):
+                result = self.downlink.transmit(packet, time.time())
+                if result is not None:
+                    self.rx_line.add(*result)
+
+            if time.time() >= end_time and (self.rx_line.next_arrival() is None or
+                    self.rx_line.next_arrival() > time.time()):
+                return b''
+
+    def close(self):
+        with self.tx_cond:
+            self.running = False
+            self.tx_cond.notify()
+        self.tx_thread.join()
+        self.transport.close()
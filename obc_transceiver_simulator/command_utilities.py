@@ -1,7 +1,11 @@
+import collections
+import time
+
 from common import *
 from conversions import *
 from encoding import *
 from packets import *
+from rtt import *
 from sections import *
 
 
@@ -74,127 +78,46 @@ def process_data_block(rx_packet):
 
     # Each "converted" value is allowable as either a float, int, or string
     # If float, log with constant number of decimal places
+    # The conversion of each field is in the section's mapping (sections.py),
+    # see pipeline.py
+    matched_sections = [section for section in g_all_read_data_sections if section.number == block_type]
+    if len(matched_sections) == 0:
+        return
+    section = matched_sections[0]
+    converted = section.pipeline.convert(fields)
 
-    if block_type == BlockType.OBC_HK:
-        num_fields = len(OBC_HK_MAPPING)
-        converted = [0 for i in range(num_fields)]
-
-        converted[0x00] = fields[0x00]
-        converted[0x01] = fields[0x01]
-        converted[0x02] = restart_reason_to_str(fields[0x02]) # Represent as string
-        converted[0x03] = date_time_to_str(uint24_to_bytes(fields[0x03]))
-        converted[0x04] = date_time_to_str(uint24_to_bytes(fields[0x04]))
-
-        # Print to screen
-        obc_hk_section.print_fields(fields, converted)
-        # Write to file
-        obc_hk_section.write_block_to_file(block_num, header, fields, converted)
-
-    elif block_type == BlockType.EPS_HK:
-        num_fields = len(EPS_HK_MAPPING)
-        converted = [0 for i in range(num_fields)]
-
-        converted[0x00] = fields[0x00]
-        converted[0x01] = fields[0x01]
-        converted[0x02] = restart_reason_to_str(fields[0x02]) # Represent as string
-        converted[0x03] = adc_raw_to_circ_vol(fields[0x03], EPS_ADC_VOL_SENSE_LOW_RES, EPS_ADC_VOL_SENSE_HIGH_RES)
-        converted[0x04] = adc_raw_to_circ_cur(fields[0x04], EPS_ADC_BAT_CUR_SENSE_RES, EPS_ADC_BAT_CUR_SENSE_VREF)
-        converted[0x05] = adc_raw_to_circ_cur(fields[0x05], EPS_ADC_DEF_CUR_SENSE_RES, EPS_ADC_DEF_CUR_SENSE_VREF)
-        converted[0x06] = adc_raw_to_circ_cur(fields[0x06], EPS_ADC_DEF_CUR_SENSE_RES, EPS_ADC_DEF_CUR_SENSE_VREF)
-        converted[0x07] = adc_raw_to_circ_cur(fields[0x07], EPS_ADC_DEF_CUR_SENSE_RES, EPS_ADC_DEF_CUR_SENSE_VREF)
-        converted[0x08] = adc_raw_to_circ_cur(fields[0x08], EPS_ADC_DEF_CUR_SENSE_RES, EPS_ADC_DEF_CUR_SENSE_VREF)
-        converted[0x09] = adc_raw_to_circ_vol(fields[0x09], EPS_ADC_VOL_SENSE_LOW_RES, EPS_ADC_VOL_SENSE_HIGH_RES)
-        converted[0x0A] = adc_raw_to_circ_cur(fields[0x0A], EPS_ADC_DEF_CUR_SENSE_RES, EPS_ADC_DEF_CUR_SENSE_VREF)
-        converted[0x0B] = adc_raw_to_circ_vol(fields[0x0B], EPS_ADC_VOL_SENSE_LOW_RES, EPS_ADC_VOL_SENSE_HIGH_RES)
-        converted[0x0C] = adc_raw_to_circ_cur(fields[0x0C], EPS_ADC_DEF_CUR_SENSE_RES, EPS_ADC_DEF_CUR_SENSE_VREF)
-        converted[0x0D] = adc_raw_to_efuse_cur(fields[0x0D], EFUSE_IMON_SENSE_RES)
-        converted[0x0E] = adc_raw_to_therm_temp(fields[0x0E])
-        converted[0x0F] = adc_raw_to_therm_temp(fields[0x0F])
-        converted[0x10] = adc_raw_to_therm_temp(fields[0x10])
-        converted[0x11] = adc_raw_to_therm_temp(fields[0x11])
-        converted[0x12] = adc_raw_to_therm_temp(fields[0x12])
-        converted[0x13] = dac_raw_data_to_heater_setpoint(fields[0x13])
-        converted[0x14] = dac_raw_data_to_heater_setpoint(fields[0x14])
-        converted[0x15] = imu_raw_data_to_gyro(fields[0x15])
-        converted[0x16] = imu_raw_data_to_gyro(fields[0x16])
-        converted[0x17] = imu_raw_data_to_gyro(fields[0x17])
-        converted[0x18] = imu_raw_data_to_gyro(fields[0x18])
-        converted[0x19] = imu_raw_data_to_gyro(fields[0x19])
-        converted[0x1A] = imu_raw_data_to_gyro(fields[0x1A])
-
-        # Print to screen
-        eps_hk_section.print_fields(fields, converted)
-        # Write to file
-        eps_hk_section.write_block_to_file(block_num, header, fields, converted)
-        
-    elif block_type == BlockType.PAY_HK:
-        num_fields = len(PAY_HK_MAPPING)
-        converted = [0 for i in range(num_fields)]
-
-        converted[0x00] = fields[0x00]
-        converted[0x01] = fields[0x01]
-        converted[0x02] = restart_reason_to_str(fields[0x02]) # Represent as string
-        converted[0x03] = hum_raw_data_to_humidity(fields[0x03])
-        converted[0x04] = pres_raw_data_to_pressure(fields[0x04])
-        converted[0x05] = adc_raw_to_therm_temp(fields[0x05])
-        converted[0x06] = adc_raw_to_therm_temp(fields[0x06])
-        converted[0x07] = adc_raw_to_therm_temp(fields[0x07])
-        converted[0x08] = adc_raw_to_therm_temp(fields[0x08])
-        converted[0x09] = adc_raw_to_therm_temp(fields[0x09])
-        converted[0x0A] = adc_raw_to_therm_temp(fields[0x0A])
-        converted[0x0B] = adc_raw_to_therm_temp(fields[0x0B])
-        converted[0x0C] = adc_raw_to_therm_temp(fields[0x0C])
-        converted[0x0D] = adc_raw_to_therm_temp(fields[0x0D])
-        converted[0x0E] = adc_raw_to_therm_temp(fields[0x0E])
-        converted[0x0F] = adc_raw_to_therm_temp(fields[0x0F])
-        converted[0x10] = adc_raw_to_therm_temp(fields[0x10])
-        converted[0x11] = adc_raw_to_therm_temp(fields[0x11])
-        converted[0x12] = adc_raw_to_therm_temp(fields[0x12])
-        converted[0x13] = adc_raw_to_therm_temp(fields[0x13])
-        converted[0x14] = adc_raw_to_therm_temp(fields[0x14])
-        converted[0x15] = adc_raw_to_therm_temp(fields[0x15])
-        converted[0x16] = dac_raw_data_to_heater_setpoint(fields[0x16])
-        converted[0x17] = adc_raw_to_therm_temp(fields[0x17])
-        converted[0x18] = enable_states_to_str(fields[0x18], 12)
-        converted[0x19] = enable_states_to_str(fields[0x19], 5)
-        converted[0x1A] = adc_raw_to_circ_vol(fields[0x1A], PAY_ADC1_BATT_LOW_RES, PAY_ADC1_BATT_HIGH_RES)
-        converted[0x1B] = adc_raw_to_circ_vol(fields[0x1B], PAY_ADC1_BOOST6_LOW_RES, PAY_ADC1_BOOST6_HIGH_RES)
-        converted[0x1C] = adc_raw_to_circ_cur(fields[0x1C], PAY_ADC1_BOOST6_SENSE_RES, PAY_ADC1_BOOST6_REF_VOL)
-        converted[0x1D] = adc_raw_to_circ_vol(fields[0x1D], PAY_ADC1_BOOST10_LOW_RES, PAY_ADC1_BOOST10_HIGH_RES)
-        converted[0x1E] = adc_raw_to_circ_cur(fields[0x1E], PAY_ADC1_BOOST10_SENSE_RES, PAY_ADC1_BOOST10_REF_VOL)
-
-        # Print to screen
-        pay_hk_section.print_fields(fields, converted)
-        # Write to file
-        pay_hk_section.write_block_to_file(block_num, header, fields, converted)
-
-    elif block_type == BlockType.PAY_OPT_OD:
-        num_fields = len(PAY_OPT_MAPPING)
-        converted = [0 for i in range(num_fields)]
-        for i in range(num_fields):
-            converted[i] = opt_raw_to_light_intensity(fields[i])
-
-        # Print to screen
-        pay_opt_od_section.print_fields(fields, converted)
-        # Write to file
-        pay_opt_od_section.write_block_to_file(block_num, header, fields, converted)
+    # Print to screen
+    section.print_fields(fields, converted)
+    # Save the raw block, then write to file
+    section.archive_block(block_num, rx_packet.data)
+    written = section.write_block_to_file(block_num, header, fields, converted)
 
+    if written and (block_type == BlockType.PAY_OPT_OD or block_type == BlockType.PAY_OPT_FL):
         # Keep latest block number consistent
-        pay_opt_section.write_block_to_file(block_num, header, fields, converted)
-
-    elif block_type == BlockType.PAY_OPT_FL:
-        num_fields = len(PAY_OPT_MAPPING)
-        converted = [0 for i in range(num_fields)]
-        for i in range(num_fields):
-            converted[i] = opt_raw_to_light_intensity(fields[i])
-
-        # Print to screen
-        pay_opt_fl_section.print_fields(fields, converted)
-        # Write to file
-        pay_opt_fl_section.write_block_to_file(block_num, header, fields, converted)
+        # PAY_OPT has rows for both types with the same block numbers, so it
+        # gets a row exactly when the PAY_OPT_OD or PAY_OPT_FL file does
+        pay_opt_section.write_block_to_file(block_num, header, fields, converted, upsert=False)
+
+# Returns (header, command ID, fields, converted) of a command log block
+def parse_cmd_block(block_data):
+    from commands import g_all_commands
+
+    header = block_data[0:10]
+    cmd_id = bytes_to_uint16(block_data[10:12])
+    opcode = block_data[12]
+    arg1 = bytes_to_uint32(block_data[13:17])
+    arg2 = bytes_to_uint32(block_data[17:21])
+
+    # Get command name string for opcode
+    matches = [command for command in g_all_commands if command.opcode == opcode]
+    if len(matches) > 0:
+        opcode_str = matches[0].name
+    else:
+        opcode_str = "UNKNOWN"
 
-        # Keep latest block number consistent
-        pay_opt_section.write_block_to_file(block_num, header, fields, converted)
+    fields = [opcode, arg1, arg2]
+    converted = [opcode_str, arg1, arg2]
+    return (header, cmd_id, fields, converted)
 
 def process_cmd_block(rx_packet):
     tx_packet = tx_packet_for_rx_packet(rx_packet)
@@ -202,29 +125,14 @@ def process_cmd_block(rx_packet):
     print("Expected starting block number:", tx_packet.arg1)
     print("Expected block count:", tx_packet.arg2)
 
-    CMD_BLOCK_LEN = 21  # 10 byte header + 11 byte data
     assert len(rx_packet.data) % CMD_BLOCK_LEN == 0
 
     count = len(rx_packet.data) // CMD_BLOCK_LEN
     print("%d blocks" % count)
     for i in range(count):
         block_data = rx_packet.data[i * CMD_BLOCK_LEN : (i + 1) * CMD_BLOCK_LEN]
-
-        header = block_data[0:10]
-        cmd_id = bytes_to_uint16(block_data[10:12])
-        opcode = block_data[12]
-        arg1 = bytes_to_uint32(block_data[13:17])
-        arg2 = bytes_to_uint32(block_data[17:21])
-
-        # Get command name string for opcode
-        matches = [command for command in g_all_commands if command.opcode == opcode]
-        if len(matches) > 0:
-            opcode_str = matches[0].name
-        else:
-            opcode_str = "UNKNOWN"
-        
-        fields = [opcode, arg1, arg2]
-        converted = [opcode_str, arg1, arg2]
+        (header, cmd_id, fields, converted) = parse_cmd_block(block_data)
+        (opcode, arg1, arg2) = fields
 
         print_div()
         print_header(header)
@@ -234,8 +142,10 @@ def process_cmd_block(rx_packet):
         print("Argument 2 = 0x%x (%d)" % (arg2, arg2))
 
         if tx_packet.opcode == CommandOpcode.READ_PRIM_CMD_BLOCKS:
+            prim_cmd_log_section.archive_block(tx_packet.arg1 + i, block_data)
             prim_cmd_log_section.write_block_to_file(tx_packet.arg1 + i, header, fields, converted)
         elif tx_packet.opcode == CommandOpcode.READ_SEC_CMD_BLOCKS:
+            sec_cmd_log_section.archive_block(tx_packet.arg1 + i, block_data)
             sec_cmd_log_section.write_block_to_file(tx_packet.arg1 + i, header, fields, converted)
         else:
             sys.exit(1)
@@ -267,43 +177,82 @@ def read_missing_blocks():
 
     print("Reading all missing blocks...")
 
-    # Subtract 1 from the block number to start at so we re-collect the last
-    # block we saved, just in case the last time we collected the data block it
-    # was incomplete
-    for i, section in enumerate(g_all_col_data_sections):
+    cmds = []
+
+    # Read every block missing from the files (including holes left by
+    # earlier failed reads), and re-collect the last block we saved, just in
+    # case the last time we collected the data block it was incomplete
+    for section in g_all_col_data_sections:
         if section == pay_opt_section:
-            for block_num in range(min(pay_opt_od_section.file_block_num, pay_opt_fl_section.file_block_num) - 1, pay_opt_section.sat_block_num):
-                if block_num < 0:
-                    print("Negative block num, skipping")
-                    continue
-
-                if pay_opt_od_section.file_block_num - 1 <= block_num:
-                    if not send_and_receive_packet(CommandOpcode.READ_DATA_BLOCK, pay_opt_od_section.number, block_num, attempts=10):
-                        return
-                if pay_opt_fl_section.file_block_num - 1 <= block_num:
-                    if not send_and_receive_packet(CommandOpcode.READ_DATA_BLOCK, pay_opt_fl_section.number, block_num, attempts=10):
-                        return
+            # PAY_OPT_OD and PAY_OPT_FL are read from the PAY_OPT section
+            for read_section in [pay_opt_od_section, pay_opt_fl_section]:
+                for (start, end) in read_section.download_plan(pay_opt_section.sat_block_num):
+                    for block_num in range(start, end):
+                        cmds.append((CommandOpcode.READ_DATA_BLOCK, read_section.number, block_num))
         else:
-            for block_num in range(section.file_block_num - 1, section.sat_block_num):
-                if not send_and_receive_packet(CommandOpcode.READ_DATA_BLOCK, section.number, block_num, attempts=10):
-                    return
+            for (start, end) in section.download_plan(section.sat_block_num):
+                for block_num in range(start, end):
+                    cmds.append((CommandOpcode.READ_DATA_BLOCK, section.number, block_num))
 
     # Can read up to 5 at a time for command log blocks
-    for block_num in range(prim_cmd_log_section.file_block_num - 1, prim_cmd_log_section.sat_block_num, 5):
-        if not send_and_receive_packet(CommandOpcode.READ_PRIM_CMD_BLOCKS, block_num,
-                min(prim_cmd_log_section.sat_block_num - prim_cmd_log_section.file_block_num, 5), attempts=10):
-            return
+    for (start, end) in prim_cmd_log_section.download_plan(prim_cmd_log_section.sat_block_num):
+        for block_num in range(start, end, 5):
+            cmds.append((CommandOpcode.READ_PRIM_CMD_BLOCKS, block_num, min(end - block_num, 5)))
+
+    print("%d commands to send" % len(cmds))
+    send_and_receive_packets(cmds, attempts=10)
     
 
 def read_missing_sec_cmd_log_blocks():
     get_sat_block_nums()
     print_sections()
 
+    cmds = []
+
     # Can read up to 5 at a time
-    for block_num in range(sec_cmd_log_section.file_block_num, sec_cmd_log_section.sat_block_num, 5):
-        if not send_and_receive_packet(CommandOpcode.READ_SEC_CMD_BLOCKS, block_num,
-                min(sec_cmd_log_section.sat_block_num - sec_cmd_log_section.file_block_num, 5)):
-            return
+    for (start, end) in sec_cmd_log_section.download_plan(sec_cmd_log_section.sat_block_num, reread_last=False):
+        for block_num in range(start, end, 5):
+            cmds.append((CommandOpcode.READ_SEC_CMD_BLOCKS, block_num, min(end - block_num, 5)))
+
+    send_and_receive_packets(cmds)
+
+# Waits up to wait_time seconds for the ACK (is_resp=False) or response
+# (is_resp=True) with the given command ID
+# A packet already pending from an earlier wait is returned first
+# Packets for the same command ID but the other type are kept as pending, and
+# packets for other command IDs (which we stopped waiting for) are processed
+# right away so their data isn't lost
+# Every packet that has already arrived is checked before giving up (so with
+# wait_time=0 it checks them all without waiting)
+# Returns the RXPacket, or None if it did not arrive
+def receive_rx_packet_for(cmd_id, is_resp, wait_time=5):
+    rx_packet = Global.pending.take(cmd_id, is_resp)
+    if rx_packet is not None:
+        return rx_packet
+
+    # Received packets only have the 15 bit command ID
+    cmd_id &= CMD_ID_MASK
+
+    end_time = time.time() + wait_time
+    while True:
+        rx_packet = poll_rx_packet(max(min(end_time - time.time(), Global.transport.timeout), 0))
+
+        if rx_packet is None:
+            pass
+        elif rx_packet.command_id == cmd_id and rx_packet.is_resp == is_resp:
+            return rx_packet
+        elif rx_packet.command_id == cmd_id:
+            Global.pending.add(rx_packet)
+        else:
+            print("Late packet")
+            Global.pending.late_packets += 1
+            process_rx_packet(rx_packet)
+
+        # Once the time is up, keep taking packets that already arrived (the
+        # polls don't wait any more) until there are none left, so one
+        # unrelated late packet doesn't hide the one we are waiting for
+        if rx_packet is None and time.time() >= end_time:
+            return None
 
 # Can't use cmd_id=Global.cmd_id directly in the function signature, because the
 # default value is bound when the method is created
@@ -312,18 +261,49 @@ def read_missing_sec_cmd_log_blocks():
 def send_and_receive_packet(opcode, arg1=0, arg2=0, cmd_id=None, wait_time=5, attempts=3):
     if cmd_id is None:
         cmd_id = Global.cmd_id
-    for i in range(attempts):
-        # Read any missed input to flush the buffer
-        read_serial()
-
-        send_tx_packet(TXPacket(cmd_id, opcode, arg1, arg2))
+    # Don't match anything left over from an earlier use of this command ID
+    Global.pending.remove(cmd_id)
 
-        ack_packet = receive_rx_packet(wait_time)
+    success = False
+    for i in range(attempts):
+        ack_packet = None
+        if i > 0:
+            # The ACK or response from the last attempt might have arrived just
+            # after we stopped waiting for it, in which case there is no need
+            # to send the command again
+            ack_packet = receive_rx_packet_for(cmd_id, False, 0)
+            # Unless it has a failed status code, in which case OBC still
+            # needs the command
+            if ack_packet is not None and ack_packet.status > PacketACKStatus.RESET_CMD_ID:
+                print("Received late failed ACK")
+                Global.pending.late_packets += 1
+                process_rx_packet(ack_packet)
+                ack_packet = None
+        if ack_packet is not None or Global.pending.contains(cmd_id, True):
+            print("Received late packet, not sending again")
+            Global.pending.late_packets += 1
+            Global.pending.avoided_retransmissions += 1
+        else:
+            if i > 0:
+                Global.retransmissions += 1
+            send_time = time.time()
+            send_tx_packet(TXPacket(cmd_id, opcode, arg1, arg2))
+            ack_packet = receive_rx_packet_for(cmd_id, False, Global.rtt.ack_timeout(opcode, wait_time, i))
+            if ack_packet is not None and i == 0:
+                Global.rtt.add_ack_sample(opcode, time.time() - send_time)
     
         # If we didn't receive an ACK packet, send the request again
         if ack_packet is None:
+            # Unless the ACK was lost but the response made it, which means OBC
+            # did get the command
+            resp_packet = Global.pending.take(cmd_id, True)
+            if resp_packet is not None:
+                process_rx_packet(resp_packet)
+                success = True
+                break
             continue
         
+        ack_time = time.time()
         # Still make sure to process/print it first to see the result
         process_rx_packet(ack_packet)
         # If the ACK packet has a failed status code, it might be because
@@ -335,26 +315,186 @@ def send_and_receive_packet(opcode, arg1=0, arg2=0, cmd_id=None, wait_time=5, at
         # response packet
         if cmd_id > 0:
             # Try to receive the response packet if we can, but this might fail
-            resp_packet = receive_rx_packet(wait_time)
+            resp_packet = receive_rx_packet_for(cmd_id, True, Global.rtt.resp_timeout(opcode, wait_time))
             if resp_packet is not None:
+                Global.rtt.add_resp_sample(opcode, time.time() - ack_time)
                 process_rx_packet(resp_packet)
 
         # At least got a successful ACK, so consider that a success
-        Global.cmd_id += 1
-
-        # When viewing the serial files with `tail`, it doesn't show the most
-        # recent block from serial_read.log unless something is added to the
-        # serial_write.log file
-        # Write dummy data to force it to display the rest of serial_read.log
-        Global.serial_write_file.write("\n")
-        Global.serial_write_file.flush()
-
-        return True
-
-    Global.cmd_id += 1
-
-    # Write dummy data to force it to display the rest of serial_read.log
-    Global.serial_write_file.write("\n")
-    Global.serial_write_file.flush()
-
-    return False
+        success = True
+        break
+
+    Global.pending.remove(cmd_id)
+    Global.sent_packets.set_done(cmd_id)
+    increment_cmd_id()
+
+    return success
+
+
+# One command sent by send_and_receive_packets() that has not finished yet
+class OutstandingCommand(object):
+    def __init__(self, index, opcode, arg1, arg2):
+        self.index = index      # Position in the list of commands
+        self.opcode = opcode
+        self.arg1 = arg1
+        self.arg2 = arg2
+        self.cmd_id = None      # Command ID of the latest attempt
+        self.done = False
+        self.attempts = 0
+        self.send_time = 0      # Time of the latest attempt
+        self.ack_time = None    # Time the ACK was received, None if not ACKed
+        # Time OBC last replied that its command queue was full, and the
+        # number of commands that had finished then
+        self.held_time = None
+        self.held_finished = 0
+
+# Sends a list of commands with up to window_size of them outstanding at once,
+# instead of waiting for the ACK and response of each one before sending the
+# next (the link latency is then only paid once per window instead of once per
+# command)
+# cmds is a list of (opcode, arg1, arg2) tuples
+# A command that doesn't get an ACK in time (or gets a failed ACK) is sent
+# again on its own with a new command ID, up to attempts times
+# A FULL_CMD_QUEUE ACK means the window is bigger than OBC's command queue, so
+# the window is made smaller (the number of commands OBC still has) and the
+# command is held until another command finishes or its ACK timeout passes,
+# then sent again (this doesn't count as an attempt)
+# The window grows back by one for every response after that, up to
+# window_size, so one full queue doesn't slow down the rest of the commands
+# wait_time is only used as the timeout for opcodes with no RTT estimate yet
+# As in send_and_receive_packet(), a successful ACK counts as success even if
+# the response never arrives
+# After a command fails all its attempts, no new commands are sent
+# wait_time is in seconds
+# Returns True if all commands succeeded
+def send_and_receive_packets(cmds, window_size=None, wait_time=5, attempts=3):
+    if window_size is None:
+        window_size = Global.window_size
+    # Current window, smaller than window_size after a FULL_CMD_QUEUE ACK
+    window = window_size
+
+    # Maps 15 bit command ID of the latest attempt to OutstandingCommand
+    outstanding = {}
+    # Maps 15 bit command ID of every attempt to OutstandingCommand, so a late
+    # packet for an earlier attempt still counts for its command
+    attempt_cmds = {}
+    # Commands OBC didn't have room for, oldest first
+    held = collections.deque()
+    # Number of commands that have finished
+    num_finished = 0
+    next_index = 0
+    failed = False
+
+    def send(cmd):
+        # Every attempt uses a new command ID, since OBC won't accept a command
+        # ID lower than one it has already seen
+        cmd.cmd_id = Global.cmd_id
+        increment_cmd_id()
+        cmd.attempts += 1
+        cmd.send_time = time.time()
+        cmd.ack_time = None
+        outstanding[cmd.cmd_id & CMD_ID_MASK] = cmd
+        attempt_cmds[cmd.cmd_id & CMD_ID_MASK] = cmd
+        Global.pending.remove(cmd.cmd_id)
+        send_tx_packet(TXPacket(cmd.cmd_id, cmd.opcode, cmd.arg1, cmd.arg2))
+
+    def retry(cmd):
+        if outstanding.pop(cmd.cmd_id & CMD_ID_MASK, None) is None:
+            # Already held (e.g. a duplicate ACK), it will be sent again anyway
+            return True
+        Global.sent_packets.set_done(cmd.cmd_id)
+        if cmd.attempts < attempts:
+            Global.retransmissions += 1
+            send(cmd)
+            return True
+        cmd.done = True
+        print("Command %d failed after %d attempts" % (cmd.index, cmd.attempts))
+        return False
+
+    def finish(cmd):
+        nonlocal num_finished
+        # A late response can finish a command that is held instead of
+        # outstanding, which must then not be sent again
+        outstanding.pop(cmd.cmd_id & CMD_ID_MASK, None)
+        if cmd in held:
+            held.remove(cmd)
+        Global.sent_packets.set_done(cmd.cmd_id)
+        cmd.done = True
+        num_finished += 1
+
+    def hold(cmd):
+        nonlocal window
+        if outstanding.pop(cmd.cmd_id & CMD_ID_MASK, None) is None:
+            # Already held, e.g. a duplicate FULL_CMD_QUEUE ACK
+            return
+        Global.sent_packets.set_done(cmd.cmd_id)
+        # Only the commands still outstanding fit in OBC's queue
+        window = max(min(window, len(outstanding)), 1)
+        cmd.attempts -= 1
+        cmd.held_time = time.time()
+        cmd.held_finished = num_finished
+        held.append(cmd)
+
+    # Returns True if a held command can be sent again
+    def can_send_held(cmd):
+        return num_finished > cmd.held_finished or \
+            time.time() - cmd.held_time > Global.rtt.ack_timeout(cmd.opcode, wait_time, cmd.attempts)
+
+    while (next_index < len(cmds) and not failed) or len(outstanding) > 0 or len(held) > 0:
+        # Send held commands again first, in order
+        while len(held) > 0 and len(outstanding) < window and can_send_held(held[0]):
+            send(held.popleft())
+
+        # Fill the window
+        while not failed and len(held) == 0 and next_index < len(cmds) and len(outstanding) < window:
+            (opcode, arg1, arg2) = cmds[next_index]
+            send(OutstandingCommand(next_index, opcode, arg1, arg2))
+            next_index += 1
+
+        rx_packet = poll_rx_packet()
+        if rx_packet is not None:
+            process_rx_packet(rx_packet)
+
+            cmd = attempt_cmds.get(rx_packet.command_id)
+            if cmd is None or cmd.done:
+                # Not for any command we are still waiting on
+                pass
+            elif rx_packet.command_id != cmd.cmd_id & CMD_ID_MASK:
+                # Late packet for an earlier attempt, which means that attempt
+                # did reach OBC
+                Global.pending.late_packets += 1
+                if rx_packet.is_resp:
+                    finish(cmd)
+                elif rx_packet.status <= PacketACKStatus.RESET_CMD_ID and cmd.ack_time is None:
+                    cmd.ack_time = time.time()
+            elif not rx_packet.is_resp:
+                if rx_packet.status == PacketACKStatus.FULL_CMD_QUEUE:
+                    hold(cmd)
+                # If the ACK packet has a failed status code, it might be
+                # because OBC did not receive all the UART properly
+                elif rx_packet.status > PacketACKStatus.RESET_CMD_ID:
+                    if not retry(cmd):
+                        failed = True
+                else:
+                    cmd.ack_time = time.time()
+                    Global.rtt.add_ack_sample(cmd.opcode, cmd.ack_time - cmd.send_time)
+            else:
+                # Also covers a response whose ACK was lost
+                if cmd.ack_time is not None:
+                    Global.rtt.add_resp_sample(cmd.opcode, time.time() - cmd.ack_time)
+                finish(cmd)
+                window = min(window + 1, window_size)
+
+        # Check the timer of every outstanding command
+        now = time.time()
+        for cmd in list(outstanding.values()):
+            if cmd.ack_time is None:
+                if now - cmd.send_time > Global.rtt.ack_timeout(cmd.opcode, wait_time, cmd.attempts - 1):
+                    if not retry(cmd):
+                        failed = True
+            elif now - cmd.ack_time > Global.rtt.resp_timeout(cmd.opcode, wait_time):
+                # At least got a successful ACK, so consider that a success
+                finish(cmd)
+
+    print("Sent %d/%d commands%s" % (next_index, len(cmds), " (FAILED)" if failed else ""))
+    return not failed
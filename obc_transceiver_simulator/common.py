@@ -1,29 +1,146 @@
+import array
 import codecs
+import collections
 import sys
 
 from constants import *
 
+# Only needed for unpacking many blocks at once, array.array is used without it
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Command IDs are sent as 15 bits, so they wrap around after this many
+CMD_ID_COUNT = 1 << 15
+CMD_ID_MASK = CMD_ID_COUNT - 1
+
+
+# Record of one sent TXPacket
+class SentPacket(object):
+    def __init__(self, packet):
+        self.packet = packet
+        # Full (not wrapped) command ID, tells which generation of the 15 bit
+        # command ID this packet is from
+        self.full_cmd_id = packet.cmd_id
+        self.done = False
+
+# History of sent TXPackets, looked up by the 15 bit command ID in received
+# packets
+# Uses a fixed array with one slot per 15 bit command ID, so memory stays the
+# same no matter how long the session is. When the command ID wraps around, a
+# reused ID replaces the old packet in its slot. Each entry keeps the full
+# command ID it was sent with, so an entry from an older generation is never
+# returned for a newer packet.
+# Once more than keep_done packets have finished, the oldest finished ones are
+# evicted (late packets for them are then unrecognized)
+class SentPacketTable(object):
+    def __init__(self, keep_done=1024):
+        self.slots = [None] * CMD_ID_COUNT
+        self.keep_done = keep_done
+        # Full command IDs of finished packets, oldest first
+        self.done_ids = collections.deque()
+        # Full command ID of the most recently sent packet
+        self.latest_cmd_id = 0
+        self.num_packets = 0
+
+    def __len__(self):
+        return self.num_packets
+
+    def __str__(self):
+        return "Sent packets: %d stored, latest command ID = %d" % (self.num_packets, self.latest_cmd_id)
+
+    def add(self, packet):
+        slot = packet.cmd_id & CMD_ID_MASK
+        if self.slots[slot] is None:
+            self.num_packets += 1
+        self.slots[slot] = SentPacket(packet)
+        self.latest_cmd_id = packet.cmd_id
+
+    # Returns the SentPacket for the 15 bit command ID, or None if there isn't
+    # one from the current generation
+    def get_entry(self, cmd_id):
+        entry = self.slots[cmd_id & CMD_ID_MASK]
+        if entry is None:
+            return None
+        # The most recent full command ID that wraps to cmd_id
+        full_cmd_id = self.latest_cmd_id - ((self.latest_cmd_id - cmd_id) & CMD_ID_MASK)
+        if entry.full_cmd_id != full_cmd_id:
+            return None
+        return entry
+
+    # Returns the TXPacket for the 15 bit command ID, or None
+    def get(self, cmd_id):
+        entry = self.get_entry(cmd_id)
+        if entry is None:
+            return None
+        return entry.packet
+
+    # Marks the command as finished so it can be evicted later
+    def set_done(self, cmd_id):
+        entry = self.get_entry(cmd_id)
+        if entry is None or entry.done:
+            return
+        entry.done = True
+        self.done_ids.append(entry.full_cmd_id)
+
+        while len(self.done_ids) > self.keep_done:
+            full_cmd_id = self.done_ids.popleft()
+            slot = full_cmd_id & CMD_ID_MASK
+            # Only if the slot wasn't reused since
+            if self.slots[slot] is not None and self.slots[slot].full_cmd_id == full_cmd_id:
+                self.slots[slot] = None
+                self.num_packets -= 1
+
 
 # Global Variables
 class Global(object):
-    serial = None       # UART serial port, one port is used
+    transport = None    # Link to OBC (transport.py), usually a serial port
     password = str.encode("UTAT")   # To send to OBC, store as bytes
-    uplink_drop = 0     # Ratio of packets to drop from ground to satellite
-    downlink_drop = 0   # Ratio of packets to drop from satellite to ground
+    # Simulated radio link (ChannelTransport from channel.py) wrapping the
+    # transport, None if the link is not simulated
+    channel = None
 
-    dropped_uplink_packets = 0
-    total_uplink_packets = 0
-    
-    dropped_downlink_packets = 0
-    total_downlink_packets = 0
+    tx_packets = 0      # Number of TXPackets sent
+    retransmissions = 0 # Number of TXPackets that were sent again
 
-    serial_write_file = None
-    serial_read_file = None
+    # Capture of the bytes sent and received (CaptureWriter from capture.py),
+    # None to not save them
+    capture = None
 
     cmd_id = 1 # Note that id will be incremented after it is sent
 
-    # Maps command ID to TXPacket
-    sent_packets = {}
+    # Sent TXPackets by command ID
+    sent_packets = SentPacketTable()
+
+    # Base timeouts on the measured round trip time of each opcode (RTTTable
+    # from rtt.py) instead of the fixed wait_time
+    adaptive_timeouts = True
+    rtt = None
+
+    # Maximum number of commands sent without waiting for their responses
+    # (1 to wait for each command before sending the next)
+    window_size = 1
+
+    # Finds RX packets in the received bytes (Deframer from packets.py)
+    deframer = None
+    # Received packets not matched to a command yet (PendingPackets from
+    # packets.py)
+    pending = None
+    # Lookup tables for 12 bit conversions (LUTCache from lut.py)
+    luts = None
+    # Section files (sections.py) are written every flush_rows rows, or
+    # flush_ms ms after the first row that hasn't been written (0 to write
+    # every row right away)
+    flush_rows = 32
+    flush_ms = 1000
+    # What to do with blocks that are already in a section file with different
+    # data (one of DUPLICATE_POLICIES in sections.py)
+    duplicates = "latest"
+    # Background serial reader (SerialReader from transport.py), None to poll
+    # the serial port with read_serial() instead
+    reader = None
 
 def check_python3():
     # Detects if correct python version is being run
@@ -74,6 +191,10 @@ def bytes_to_uint15(bytes):
 def date_time_to_str(data):
     return "%02d.%02d.%02d" % (data[0], data[1], data[2])
 
+# Date or time packed in a 24 bit field
+def uint24_to_date_time_str(num):
+    return date_time_to_str(uint24_to_bytes(num))
+
 def conv_value_to_str(value):    
     if type(value) == float:
         return "%.6f" % value
@@ -323,13 +444,100 @@ def enable_states_to_str(states, num_bits):
     # Can't use comma separators for CSV
     return " ".join(str_list)
 
-def parse_data(data):
-    header = data[0:10]
-    
-    fields = []
-    for i in range(10, len(data), 3):
-        fields.append(bytes_to_uint24(data[i : i+3]))
+# Data blocks are a 10 byte header followed by 3 byte (24 bit) fields
+BLOCK_HEADER_LEN = 10
+BLOCK_FIELD_LEN = 3
+# Command log blocks are a 10 byte header followed by the command ID (2 bytes),
+# opcode (1 byte), argument 1 (4 bytes) and argument 2 (4 bytes)
+CMD_BLOCK_LEN = 21
+# Values in a block header, in order (the block number is 3 bytes, the date,
+# time and status are 1 byte each)
+BLOCK_HEADER_COLUMNS = ["block_num", "year", "month", "day", "hour", "minute", "second", "status"]
+
+# array.array type code for unsigned 32 bit numbers
+UINT32_TYPECODE = 'I' if array.array('I').itemsize == 4 else 'L'
+
+if numpy is not None:
+    BLOCK_HEADER_DTYPE = numpy.dtype([("block_num", numpy.uint32)] +
+        [(name, numpy.uint8) for name in BLOCK_HEADER_COLUMNS[1:]])
+
+# Converts big-endian 24 bit numbers to an array.array of uint32 without a
+# Python loop over the numbers (each byte of the numbers is copied at once with
+# extended slices into the low 3 bytes of 4 byte big-endian numbers)
+# Extra bytes at the end that aren't a whole number are ignored
+def unpack_uint24s_array(data):
+    count = len(data) // 3
+    data = bytes(data[0 : count * 3])
+
+    buf = bytearray(count * 4)
+    buf[1::4] = data[0::3]
+    buf[2::4] = data[1::3]
+    buf[3::4] = data[2::3]
+
+    nums = array.array(UINT32_TYPECODE)
+    nums.frombytes(buf)
+    if sys.byteorder == "little":
+        nums.byteswap()
+    return nums
+
+# Same as unpack_uint24s_array(), but returns a numpy uint32 array if numpy is
+# installed
+def unpack_uint24s(data):
+    if numpy is None:
+        return unpack_uint24s_array(data)
+
+    count = len(data) // 3
+    nums = numpy.frombuffer(data, dtype=numpy.uint8, count=count * 3).reshape(count, 3)
+    return ((nums[:, 0].astype(numpy.uint32) << 16) |
+        (nums[:, 1].astype(numpy.uint32) << 8) | nums[:, 2])
+
+# Unpacks data, which has any number of data blocks with num_fields fields each
+# back to back (e.g. an archive of received blocks)
+# Returns (headers, fields)
+# With numpy, headers is a structured array (BLOCK_HEADER_DTYPE) with one row
+# per block and fields is a uint32 array with one row per block and one column
+# per field
+# Without numpy, headers is a dict mapping each of BLOCK_HEADER_COLUMNS to an
+# array.array with one item per block, and fields is a list with an
+# array.array of fields for each block
+# Either way, headers["block_num"][i] and fields[i][j] work the same
+def unpack_blocks(data, num_fields):
+    block_len = BLOCK_HEADER_LEN + num_fields * BLOCK_FIELD_LEN
+    count = len(data) // block_len
+
+    if numpy is not None:
+        blocks = numpy.frombuffer(data, dtype=numpy.uint8, count=count * block_len).reshape(count, block_len)
+
+        headers = numpy.empty(count, dtype=BLOCK_HEADER_DTYPE)
+        headers["block_num"] = ((blocks[:, 0].astype(numpy.uint32) << 16) |
+            (blocks[:, 1].astype(numpy.uint32) << 8) | blocks[:, 2])
+        for i, name in enumerate(BLOCK_HEADER_COLUMNS[1:]):
+            headers[name] = blocks[:, 3 + i]
+
+        body = blocks[:, BLOCK_HEADER_LEN:].reshape(count, num_fields, BLOCK_FIELD_LEN)
+        fields = ((body[:, :, 0].astype(numpy.uint32) << 16) |
+            (body[:, :, 1].astype(numpy.uint32) << 8) | body[:, :, 2])
+        return (headers, fields)
+
+    data = bytes(data[0 : count * block_len])
+
+    # Column i of the headers is every block_len'th byte starting at i
+    block_nums = bytearray(count * 3)
+    for i in range(3):
+        block_nums[i::3] = data[i::block_len]
+    headers = {"block_num": unpack_uint24s_array(block_nums)}
+    for i, name in enumerate(BLOCK_HEADER_COLUMNS[1:]):
+        headers[name] = array.array('B', data[3 + i::block_len])
+
+    body = b"".join(data[i + BLOCK_HEADER_LEN : i + block_len] for i in range(0, len(data), block_len))
+    all_fields = unpack_uint24s_array(body)
+    fields = [all_fields[i : i + num_fields] for i in range(0, len(all_fields), num_fields)]
+    return (headers, fields)
 
+def parse_data(data):
+    header = data[0:BLOCK_HEADER_LEN]
+    # A single block is too small for numpy to be worth it
+    fields = unpack_uint24s_array(data[BLOCK_HEADER_LEN:]).tolist()
     return (header, fields)
 
 
@@ -338,26 +546,27 @@ def print_div():
 
 
 def write_serial(data):
-    Global.serial.write(data)
+    Global.transport.write(data)
+    if Global.capture is not None:
+        Global.capture.write_tx(data)
 
-    # Calling str(data) will give a string like: "b'U\\x0fU\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00UTATUB\\xbd\\xf2\\x1cU'"
-    # Want to remove b' at the beginning and ' at the end so they don't appear in the output
-    # Can't decode to utf-8 because bytes > 127 will give an error
-    data_str = str(data)[2:-1]
-    Global.serial_write_file.write(data_str)
-    Global.serial_write_file.flush()
+def log_serial_read(data):
+    if Global.capture is not None:
+        Global.capture.write_rx(data)
 
 def read_serial():
-    data = Global.serial.read(2 ** 16)
-
-    data_str = str(data)[2:-1]
-    Global.serial_read_file.write(data_str)
-    Global.serial_read_file.flush()
+    data = Global.transport.read(2 ** 16)
+    log_serial_read(data)
     return data
 
 
 def tx_packet_for_rx_packet(rx_packet):
-    if rx_packet.command_id in Global.sent_packets.keys():
-        return Global.sent_packets[rx_packet.command_id]
-    else:
-        return None
+    return Global.sent_packets.get(rx_packet.command_id)
+
+# Moves on to the next command ID
+# 0 is skipped when the 15 bit command ID wraps around, since sending it would
+# reset OBC's command ID
+def increment_cmd_id():
+    Global.cmd_id += 1
+    if Global.cmd_id & CMD_ID_MASK == 0:
+        Global.cmd_id += 1
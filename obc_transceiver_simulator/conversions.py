@@ -132,6 +132,14 @@ def adc_ch_vol_to_circ_cur(ch_vol, sense_res, ref_vol):
     circ_cur = before_gain_voltage / sense_res
     return circ_cur
 
+# Inverse of adc_ch_vol_to_circ_cur(), used by adc_circ_cur_to_raw()
+def adc_circ_cur_to_ch_vol(circ_cur, sense_res, ref_vol):
+    # Ohm's law (V = I * R)
+    before_gain_voltage = circ_cur * sense_res
+    # Add the amplifier gain and reference voltage back
+    ch_vol = (before_gain_voltage * ADC_CUR_SENSE_AMP_GAIN) + ref_vol
+    return ch_vol
+
 def adc_ch_vol_to_efuse_cur(ch_vol, sense_res):
     iout = ch_vol / (EFUSE_IMON_CUR_GAIN * sense_res)
     return iout
@@ -0,0 +1,320 @@
+'''
+Array versions of every conversion in conversions.py, for converting whole
+columns of data (e.g. fields from common.unpack_blocks()) at once.
+
+Each function takes a numpy array (or anything numpy.asarray() accepts) and
+returns an array with the same result for every element as the scalar function
+of the same name without the _vec suffix, bit for bit.
+
+Arithmetic is done in the same order as the scalar functions, which gives
+identical results. numpy's log() and exp() can differ from math.log() and
+math.exp() in the last bit though, so by default the conversions that use them
+run the scalar function once for each distinct input value and look the
+results up for every element (12 bit raw data uses the shared tables from
+lut.py). With exact=False they use numpy's log() and exp() instead, which is
+faster for inputs that aren't raw data (e.g. every distinct resistance) but
+only accurate to about 1e-15 relative.
+'''
+
+import sys
+
+try:
+    import numpy
+except ImportError:
+    print("Error: conversions_vec requires the numpy module. To install " +
+        "numpy,\nvisit https://pypi.org/project/numpy/ or run\n" +
+        "    $ pip install numpy\n" +
+        "in the command line.")
+    raise
+
+import conversions
+from common import *
+from conversions import *
+from lut import *
+
+
+# Largest integer input that is looked up in a table with one entry for every
+# value up to it instead of with numpy.unique() (which sorts)
+MAP_TABLE_MAX = 1 << 24
+# Only if it has at most this many entries for each input value, so a few
+# large values don't need a huge table
+MAP_TABLE_DENSITY = 64
+
+
+# Applies the scalar function func to every element of values
+# func is only called once for each distinct value
+def map_exact(func, values):
+    values = numpy.asarray(values)
+    result = numpy.empty(values.shape, dtype=numpy.float64)
+    if values.size == 0:
+        return result
+
+    if (values.dtype.kind in "ui" and values.min() >= 0 and values.max() < MAP_TABLE_MAX and
+            values.max() < MAP_TABLE_DENSITY * values.size):
+        # Raw data, index a table by value
+        present = numpy.zeros(int(values.max()) + 1, dtype=bool)
+        present[values] = True
+        table = numpy.zeros(len(present), dtype=numpy.float64)
+        for value in numpy.flatnonzero(present):
+            table[value] = func(int(value))
+        result[...] = table[values]
+    else:
+        (unique, inverse) = numpy.unique(values, return_inverse=True)
+        table = numpy.array([func(value.item()) for value in unique], dtype=numpy.float64)
+        result[...] = table[inverse].reshape(values.shape)
+
+    return result
+
+# Same as map_exact(), but raw 12 bit data is looked up in the table for func
+# from the LUT cache (lut.py), which is shared with process_data_block()
+# Values that aren't 12 bit data (e.g. corrupted fields) go through map_exact()
+def lut_map(func, raw_data, *args):
+    raw_data = numpy.asarray(raw_data)
+    if raw_data.dtype.kind not in "ui" or raw_data.size == 0:
+        return map_exact(lambda raw: func(raw, *args), raw_data)
+
+    table = numpy.frombuffer(Global.luts.table(func, *args), dtype=numpy.float64)
+    if raw_data.min() >= 0 and raw_data.max() < LUT_SIZE:
+        return table[raw_data]
+
+    in_range = (raw_data >= 0) & (raw_data < LUT_SIZE)
+    result = table[numpy.where(in_range, raw_data, 0)]
+    if not in_range.all():
+        result[~in_range] = map_exact(lambda raw: func(raw, *args), raw_data[~in_range])
+    return result
+
+def as_float(values):
+    return numpy.asarray(values, dtype=numpy.float64)
+
+def as_int(values):
+    return numpy.asarray(values, dtype=numpy.int64)
+
+# int() of each float, which truncates towards zero
+def trunc_to_int(values):
+    return numpy.trunc(values).astype(numpy.int64)
+
+
+def adc_raw_to_ch_vol_vec(raw):
+    ratio = as_float(raw) / 0x0FFF
+    voltage = ratio * ADC_V_REF
+    return voltage
+
+def adc_ch_vol_to_raw_vec(ch_vol):
+    return trunc_to_int((as_float(ch_vol) / float(ADC_V_REF)) * 0x0FFF)
+
+def adc_ch_vol_to_circ_vol_vec(ch_vol, low_res, high_res):
+    return as_float(ch_vol) / low_res * (low_res + high_res)
+
+def adc_ch_vol_to_circ_cur_vec(ch_vol, sense_res, ref_vol):
+    before_gain_voltage = (as_float(ch_vol) - ref_vol) / ADC_CUR_SENSE_AMP_GAIN
+    circ_cur = before_gain_voltage / sense_res
+    return circ_cur
+
+def adc_circ_cur_to_ch_vol_vec(circ_cur, sense_res, ref_vol):
+    before_gain_voltage = as_float(circ_cur) * sense_res
+    ch_vol = (before_gain_voltage * ADC_CUR_SENSE_AMP_GAIN) + ref_vol
+    return ch_vol
+
+def adc_ch_vol_to_efuse_cur_vec(ch_vol, sense_res):
+    return as_float(ch_vol) / (EFUSE_IMON_CUR_GAIN * sense_res)
+
+def adc_raw_to_circ_vol_vec(raw, low_res, high_res):
+    return adc_ch_vol_to_circ_vol_vec(adc_raw_to_ch_vol_vec(raw), low_res, high_res)
+
+def adc_raw_to_circ_cur_vec(raw, sense_res, ref_vol):
+    return adc_ch_vol_to_circ_cur_vec(adc_raw_to_ch_vol_vec(raw), sense_res, ref_vol)
+
+def adc_circ_cur_to_raw_vec(circ_cur, sense_res, ref_vol):
+    return adc_ch_vol_to_raw_vec(adc_circ_cur_to_ch_vol_vec(circ_cur, sense_res, ref_vol))
+
+def adc_raw_to_efuse_cur_vec(raw, sense_res):
+    return adc_ch_vol_to_efuse_cur_vec(adc_raw_to_ch_vol_vec(raw), sense_res)
+
+def adc_raw_to_therm_temp_vec(raw_data, exact=True):
+    if exact:
+        return lut_map(conversions.adc_raw_to_therm_temp, raw_data)
+    return therm_res_to_temp_vec(therm_vol_to_res_vec(adc_raw_to_ch_vol_vec(raw_data)), exact=False)
+
+def adc_therm_temp_to_raw_vec(temp, exact=True):
+    if exact:
+        return map_exact(conversions.adc_therm_temp_to_raw, temp).astype(numpy.int64)
+    return adc_ch_vol_to_raw_vec(therm_res_to_vol_vec(therm_temp_to_res_vec(temp, exact=False)))
+
+
+def dac_raw_data_to_vol_vec(raw_data):
+    ratio = as_float(raw_data) / (1 << DAC_NUM_BITS)
+    return ratio * DAC_VREF * DAC_VREF_GAIN
+
+def dac_vol_to_raw_data_vec(voltage):
+    num = as_float(voltage) * (1 << DAC_NUM_BITS)
+    denom = DAC_VREF * DAC_VREF_GAIN
+    return trunc_to_int(num / denom)
+
+def dac_raw_data_to_heater_setpoint_vec(raw_data, exact=True):
+    if exact:
+        return lut_map(conversions.dac_raw_data_to_heater_setpoint, raw_data)
+    return therm_res_to_temp_vec(therm_vol_to_res_vec(dac_raw_data_to_vol_vec(raw_data)), exact=False)
+
+def heater_setpoint_to_dac_raw_data_vec(temp, exact=True):
+    if exact:
+        return map_exact(conversions.heater_setpoint_to_dac_raw_data, temp).astype(numpy.int64)
+    return dac_vol_to_raw_data_vec(therm_res_to_vol_vec(therm_temp_to_res_vec(temp, exact=False)))
+
+
+def hum_raw_data_to_humidity_vec(raw_data):
+    return as_float(raw_data) / ((1 << 14) - 2.0) * 100.0
+
+def pres_raw_data_to_pressure_vec(raw_data):
+    mbar = as_float(raw_data) * 0.01
+    return mbar / 10.0
+
+
+def opt_adc_raw_to_ch_vol_vec(raw):
+    return (as_float(raw) / float(1 << OPT_ADC_BITS)) * OPT_ADC_VREF
+
+# Returns (voltage, current, power) arrays
+def opt_power_raw_to_conv_vec(raw):
+    raw = as_int(raw)
+    voltage = opt_adc_raw_to_ch_vol_vec((raw >> 12) & 0x3FF)
+    current = (opt_adc_raw_to_ch_vol_vec(raw & 0x3FF) / OPT_ADC_CUR_SENSE_AMP_GAIN) / OPT_ADC_CUR_SENSE
+    power = voltage * current
+    return (voltage, current, power)
+
+# Gain for each 2 bit value
+OPT_GAINS = numpy.array([1.0, 24.5, 400.0, 9200.0])
+
+def opt_gain_raw_to_conv_vec(raw):
+    raw = as_int(raw)
+    # Anything else is low gain
+    valid = (raw >= 0) & (raw <= 0b11)
+    return numpy.where(valid, OPT_GAINS[numpy.where(valid, raw, 0)], 1.0)
+
+def opt_int_time_raw_to_conv_vec(raw):
+    return (as_int(raw) + 1) * 100
+
+def opt_raw_to_light_intensity_vec(raw):
+    raw = as_int(raw)
+    gain = opt_gain_raw_to_conv_vec((raw >> 22) & 0x03)
+    int_time = opt_int_time_raw_to_conv_vec((raw >> 16) & 0x07)
+    reading = raw & 0xFFFF
+    return reading / (gain * int_time)
+
+
+def therm_res_to_temp_vec(resistance, exact=True):
+    if exact:
+        return map_exact(conversions.therm_res_to_temp, resistance)
+
+    resistance = as_float(resistance)
+    ratio = resistance / THERM_NOM_RES
+    # log() of 0 or a negative number gives the same dummy value as the scalar
+    # function
+    # (NaN stays NaN like math.log())
+    valid = (ratio > 0) | numpy.isnan(ratio)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        denom = (numpy.log(numpy.where(valid, ratio, 1.0)) / THERM_BETA) + (1.0 / THERM_NOM_TEMP)
+        temp = (1.0 / denom) - THERM_CELSIUS_TO_KELVIN
+    return numpy.where(valid, temp, -1000.0)
+
+def therm_temp_to_res_vec(temp, exact=True):
+    if exact:
+        return map_exact(conversions.therm_temp_to_res, temp)
+
+    temp_diff = (1.0 / (as_float(temp) + THERM_CELSIUS_TO_KELVIN)) - (1.0 / THERM_NOM_TEMP)
+    return THERM_NOM_RES * numpy.exp(THERM_BETA * temp_diff)
+
+def therm_res_to_vol_vec(resistance):
+    return THERM_V_REF * THERM_R_REF / (as_float(resistance) + THERM_R_REF)
+
+def therm_vol_to_res_vec(voltage):
+    voltage = as_float(voltage)
+    # Dividing by 0 V gives 0 like the scalar function
+    zero = voltage == 0
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        res = THERM_R_REF * (THERM_V_REF / voltage - 1)
+    return numpy.where(zero, 0.0, res)
+
+
+def imu_raw_data_to_double_vec(raw_data, q_point):
+    # Wrap to a signed 16 bit number like c_int16
+    signed = ((as_int(raw_data) + 0x8000) & 0xFFFF) - 0x8000
+    return signed.astype(numpy.float64) / float(1 << q_point)
+
+def imu_raw_data_to_gyro_vec(raw_data):
+    return imu_raw_data_to_double_vec(raw_data, IMU_GYRO_Q)
+
+
+# Compares every _vec function to the scalar function on all 12 bit values
+# (and other typical inputs), exits with 1 if any result is different
+if __name__ == "__main__":
+    import inspect
+    import random
+    import time
+
+    raw_12 = numpy.arange(1 << 12)
+    rand = random.Random(0)
+    # Inputs for each function, and the args after it
+    inputs = {
+        "adc_raw_to_ch_vol":                (raw_12, ()),
+        "adc_ch_vol_to_raw":                (adc_raw_to_ch_vol_vec(raw_12), ()),
+        "adc_ch_vol_to_circ_vol":           (adc_raw_to_ch_vol_vec(raw_12), (EPS_ADC_VOL_SENSE_LOW_RES, EPS_ADC_VOL_SENSE_HIGH_RES)),
+        "adc_ch_vol_to_circ_cur":           (adc_raw_to_ch_vol_vec(raw_12), (PAY_ADC1_BOOST6_SENSE_RES, PAY_ADC1_BOOST6_REF_VOL)),
+        "adc_circ_cur_to_ch_vol":           (numpy.linspace(-2, 6, 5000), (EPS_ADC_DEF_CUR_SENSE_RES, EPS_ADC_DEF_CUR_SENSE_VREF)),
+        "adc_ch_vol_to_efuse_cur":          (adc_raw_to_ch_vol_vec(raw_12), (EFUSE_IMON_SENSE_RES,)),
+        "adc_raw_to_circ_vol":              (raw_12, (PAY_ADC1_BATT_LOW_RES, PAY_ADC1_BATT_HIGH_RES)),
+        "adc_raw_to_circ_cur":              (raw_12, (EPS_ADC_BAT_CUR_SENSE_RES, EPS_ADC_BAT_CUR_SENSE_VREF)),
+        "adc_circ_cur_to_raw":              (numpy.linspace(0, 6, 5000), (EPS_ADC_DEF_CUR_SENSE_RES, EPS_ADC_DEF_CUR_SENSE_VREF)),
+        "adc_raw_to_efuse_cur":             (raw_12, (EFUSE_IMON_SENSE_RES,)),
+        "adc_raw_to_therm_temp":            (raw_12, ()),
+        "adc_therm_temp_to_raw":            (numpy.linspace(-40, 100, 5000), ()),
+        "dac_raw_data_to_vol":              (raw_12, ()),
+        "dac_vol_to_raw_data":              (numpy.linspace(0, 5, 5000), ()),
+        "dac_raw_data_to_heater_setpoint":  (raw_12, ()),
+        "heater_setpoint_to_dac_raw_data":  (numpy.linspace(-40, 100, 5000), ()),
+        "hum_raw_data_to_humidity":         (numpy.arange(1 << 14), ()),
+        "pres_raw_data_to_pressure":        (numpy.array([rand.randrange(1 << 24) for i in range(5000)]), ()),
+        "opt_adc_raw_to_ch_vol":            (numpy.arange(1 << 10), ()),
+        "opt_power_raw_to_conv":            (numpy.array([rand.randrange(1 << 24) for i in range(5000)]), ()),
+        "opt_gain_raw_to_conv":             (numpy.arange(-2, 6), ()),
+        "opt_int_time_raw_to_conv":         (numpy.arange(8), ()),
+        "opt_raw_to_light_intensity":       (numpy.array([rand.randrange(1 << 24) for i in range(5000)]), ()),
+        "therm_res_to_temp":                (numpy.concatenate([[-1.0, 0.0], numpy.linspace(0.01, 1000, 5000)]), ()),
+        "therm_temp_to_res":                (numpy.linspace(-40, 100, 5000), ()),
+        "therm_res_to_vol":                 (numpy.linspace(0, 1000, 5000), ()),
+        "therm_vol_to_res":                 (numpy.concatenate([[0.0], numpy.linspace(0.001, 2.5, 5000)]), ()),
+        "imu_raw_data_to_double":           (numpy.arange(1 << 16), (IMU_ACCEL_Q,)),
+        "imu_raw_data_to_gyro":             (numpy.arange(1 << 16), ()),
+    }
+
+    different = []
+    for (name, func) in inspect.getmembers(conversions, inspect.isfunction):
+        if func.__module__ != conversions.__name__:
+            continue
+        if name not in inputs:
+            print("%-35s no test inputs" % name)
+            different.append(name)
+            continue
+
+        (values, args) = inputs[name]
+        vec_func = globals()[name + "_vec"]
+        expected = [func(value.item(), *args) for value in values]
+        actual = vec_func(values, *args)
+        if isinstance(actual, tuple):
+            # One array per item of each scalar result
+            actual = list(zip(*[a.tolist() for a in actual]))
+        else:
+            actual = actual.tolist()
+
+        if actual != expected:
+            print("%-35s DIFFERENT" % name)
+            different.append(name)
+        else:
+            print("%-35s same" % name)
+
+    # Time one season of thermistor samples
+    raw = numpy.random.default_rng(0).integers(0, 1 << 12, 5000000)
+    start = time.time()
+    adc_raw_to_therm_temp_vec(raw)
+    print("adc_raw_to_therm_temp_vec: %d samples in %.3fs" % (len(raw), time.time() - start))
+
+    if len(different) > 0:
+        sys.exit(1)
@@ -3,107 +3,190 @@ Encoding and decoding operations for transceiver messages.
 This attempts to follow obc/src/transceiver.c as closely as possible.
 """
 
+import builtins
+import struct
 import sys
+import zlib
+
+from constants import *
 
 # Calculates the checksum for the string message.
 # Algorithm modified for python from:
 # https://stackoverflow.com/questions/21001659/crc32-algorithm-implementation-in-c-without-a-look-up-table-and-with-a-public-li
 
+# This is the standard reflected CRC-32 (polynomial 0xEDB88320, initial value
+# 0xFFFFFFFF, inverted at the end), which is exactly what zlib.crc32() computes,
+# so zlib is used as the fast path. The lookup table is only used for messages
+# that can't be turned into bytes (e.g. lists with values > 0xFF or negative).
+CRC32_POLY = 0xEDB88320
+
 # Python might have a negative number, so make sure it is in the range
 # [0, 1 << 32)
 def get_uint32(num):
-    while num < 0:
-        num += (1 << 32)
-    while num >= (1 << 32):
-        num -= (1 << 32)
-    return num
+    return num & 0xFFFFFFFF
+
+# Builds the 256-entry table by running the bit-by-bit algorithm on every
+# possible byte value
+def make_crc32_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for j in range(0, 8):
+            mask = get_uint32(-(crc & 1))
+            crc = (crc >> 1) ^ (CRC32_POLY & mask)
+        table.append(crc)
+    return table
+
+CRC32_TABLE = make_crc32_table()
+
+# Same result as the bit-by-bit algorithm, one table lookup per item instead
+# of 8 shifts
+# Used for lists with values that aren't bytes (e.g. > 0xFF or negative): the
+# whole value is XORed into the CRC like the bit-by-bit algorithm does, and the
+# 8 shifts only depend on its low 8 bits, so the bits above them are shifted
+# down with the rest of the CRC
+def crc32_table(message, len):
+    crc = 0xFFFFFFFF
+    table = CRC32_TABLE
+
+    i = 0
+    while i < len:
+        crc = crc ^ message[i]
+        crc = table[crc & 0xFF] ^ (crc >> 8)
+        i = i + 1
+
+    crc = get_uint32(~crc)
+    return crc
 
 def crc32(message, len):
-   crc = 0xFFFFFFFF
+    # Like the bit-by-bit algorithm, which would index past the end
+    if len > builtins.len(message):
+        raise IndexError("Message has %d items, not %d" % (builtins.len(message), len))
+
+    if isinstance(message, (bytes, bytearray, memoryview)):
+        return zlib.crc32(memoryview(message)[0:len])
+
+    try:
+        return zlib.crc32(bytes(message[0:len]))
+    except ValueError:
+        return crc32_table(message, len)
+
+
+# Encoded packet format (all fields big-endian):
+# 0x55, decoded length, 0x55, decoded message, 0x55, 4 byte checksum, 0x55
+TRANS_PKT_DELIMITER = 0x55
+# Number of bytes the encoding adds around the decoded message
+TRANS_ENC_OVERHEAD = 9
+# The length has to fit in one byte
+TRANS_DEC_MSG_MAX_SIZE = 0xFF
+
+# Precompiled formats for the bytes before and after the decoded message
+ENC_HEADER_STRUCT = struct.Struct(">BBB")
+ENC_FOOTER_STRUCT = struct.Struct(">BIB")
+# Checksum stored in an encoded packet (before the last delimiter)
+ENC_CSUM_STRUCT = struct.Struct(">I")
+
+# The checksum covers the length byte followed by the decoded message, so
+# precompute the running CRC after each possible length byte and continue from
+# there on the message itself (avoids building a separate checksum buffer)
+LEN_CRC32_TABLE = [zlib.crc32(bytes([i])) for i in range(256)]
+
+
+# Checks the checksum of one encoded packet (which must already have the
+# correct length and delimiters)
+def check_enc_packet_csum(enc_msg):
+    enc_len = len(enc_msg)
+    view = memoryview(enc_msg)
+    calc_csum = zlib.crc32(view[3 : enc_len - 6], LEN_CRC32_TABLE[view[1]])
+    rcvd_csum = ENC_CSUM_STRUCT.unpack_from(enc_msg, enc_len - 5)[0]
+    return calc_csum == rcvd_csum
+
+# Checks the checksums of many encoded packets in one call (e.g. all the frames
+# found in a capture of serial_read.log)
+# Returns a list of bools, one per packet, in the same order
+def check_enc_packet_csums(enc_msgs):
+    crc = zlib.crc32
+    len_crcs = LEN_CRC32_TABLE
+    unpack_from = ENC_CSUM_STRUCT.unpack_from
+
+    results = []
+    for enc_msg in enc_msgs:
+        enc_len = len(enc_msg)
+        if enc_len < TRANS_ENC_OVERHEAD:
+            results.append(False)
+            continue
+        view = memoryview(enc_msg)
+        calc_csum = crc(view[3 : enc_len - 6], len_crcs[view[1]])
+        results.append(calc_csum == unpack_from(enc_msg, enc_len - 5)[0])
+    return results
+
+
+# Encodes dec_msg directly into buf (a bytearray or writable memoryview),
+# starting at offset
+# buf must already have room for len(dec_msg) + TRANS_ENC_OVERHEAD bytes, it is
+# never resized
+# Returns the number of bytes written
+def encode_into(buf, offset, dec_msg):
+    dec_len = len(dec_msg)
+    enc_len = dec_len + TRANS_ENC_OVERHEAD
 
-   i = 0
-   while i < len:
-      byte = message[i]
-      crc = crc ^ byte
-      for j in range (0, 8):
-         mask = get_uint32(-(crc & 1))
-         crc = (crc >> 1) ^ (0xEDB88320 & mask)
-      i = i + 1
-   
-   crc = get_uint32(~crc)
-   return crc
+    if dec_len > TRANS_DEC_MSG_MAX_SIZE:
+        raise ValueError("Decoded message too long (%d bytes)" % dec_len)
+    if offset + enc_len > len(buf):
+        raise ValueError("Buffer too small for encoded message (%d bytes)" % enc_len)
 
+    checksum = zlib.crc32(dec_msg, LEN_CRC32_TABLE[dec_len])
 
-def encode_packet(dec_msg):
-    TRANS_RX_DEC_MSG_MAX_SIZE = 15 #make this some kind of constant later
-    TRANS_PKT_DELIMITER = 0x55
+    ENC_HEADER_STRUCT.pack_into(buf, offset, TRANS_PKT_DELIMITER, dec_len, TRANS_PKT_DELIMITER)
+    buf[offset + 3 : offset + 3 + dec_len] = dec_msg
+    ENC_FOOTER_STRUCT.pack_into(buf, offset + 3 + dec_len, TRANS_PKT_DELIMITER, checksum, TRANS_PKT_DELIMITER)
 
-    # Decoded length
-    dec_len = len(dec_msg)
-    enc_len = dec_len + 9
+    return enc_len
 
-    enc_msg = [0x00] * enc_len    # Convert to bytes later
+# Checks an encoded packet the same way OBC does
+# Returns the PacketACKStatus OBC would reply with (0 if the packet is valid)
+def get_enc_packet_status(enc_msg):
+    enc_len = len(enc_msg)
+    if enc_len < TRANS_ENC_OVERHEAD or \
+            enc_msg[0] != TRANS_PKT_DELIMITER or \
+            enc_msg[2] != TRANS_PKT_DELIMITER or \
+            enc_msg[enc_len - 6] != TRANS_PKT_DELIMITER or \
+            enc_msg[enc_len - 1] != TRANS_PKT_DELIMITER:
+        return PacketACKStatus.INVALID_ENC_FMT
 
-    checksum_buf = [0x00] * (TRANS_RX_DEC_MSG_MAX_SIZE + 1)
-    checksum_buf[0] = dec_len
-    i = 0
-    while i < dec_len and 1 + i < len(checksum_buf):
-        checksum_buf[1 + i] = dec_msg[i]
-        i += 1
-
-    checksum = crc32(checksum_buf, 1 + dec_len)
-
-    # All encoded messages start with 0x00
-    enc_msg[0] = TRANS_PKT_DELIMITER
-    # Next field is the length. This value will later be mapped similar to the other bytes.
-    enc_msg[1] = dec_len
-    enc_msg[2] = TRANS_PKT_DELIMITER
-    for i in range (0, dec_len):
-        enc_msg[3 + i] = dec_msg[i]
-
-    enc_msg[enc_len - 6] = TRANS_PKT_DELIMITER
-    enc_msg[enc_len - 5] = (checksum >> 24) & 0xFF
-    enc_msg[enc_len - 4] = (checksum >> 16) & 0xFF
-    enc_msg[enc_len - 3] = (checksum >> 8) & 0xFF
-    enc_msg[enc_len - 2] = (checksum >> 0) & 0xFF
-    enc_msg[enc_len - 1] = TRANS_PKT_DELIMITER
+    if enc_msg[1] != enc_len - TRANS_ENC_OVERHEAD:
+        return PacketACKStatus.INVALID_LEN
+
+    if not check_enc_packet_csum(enc_msg):
+        return PacketACKStatus.INVALID_CSUM
 
+    return PacketACKStatus.OK
+
+# Decodes one encoded packet without copying it
+# Returns a memoryview of the decoded message inside enc_msg, or None if the
+# packet is invalid
+def decode_from(enc_msg):
+    if get_enc_packet_status(enc_msg) != PacketACKStatus.OK:
+        return None
+    return memoryview(enc_msg)[3 : len(enc_msg) - 6]
+
+
+def encode_packet(dec_msg):
+    enc_msg = bytearray(len(dec_msg) + TRANS_ENC_OVERHEAD)
+    encode_into(enc_msg, 0, dec_msg)
     return bytes(enc_msg)
 
+# Unlike decode_from(), only checks the length and checksum (not the
+# delimiters)
 def decode_packet(enc_msg):
-    # Make these constants later
-    CMD_CMD_ID_UNKNOWN = [0x00, 0x00]
-    CMD_ACK_STATUS_INVALID_CSUM = [0x04]
-    TRANS_RX_DEC_MSG_MAX_SIZE = 15
-    # Easier to work with encoded message as a list of ints rather than bytes
-    enc_msg = list(enc_msg)
-
     enc_len = len(enc_msg)
-    dec_len = enc_msg[1]
-
-    dec_msg = [0x00] * dec_len
 
     # Check invalid length
-    if dec_len != enc_len - 9:
+    if enc_msg[1] != enc_len - TRANS_ENC_OVERHEAD:
         sys.exit(1)
 
-    actual_checksum = (enc_msg[enc_len - 5] << 24) | (enc_msg[enc_len - 4] << 16) | (enc_msg[enc_len - 3] << 8) | enc_msg[enc_len - 2]
-
-    # Array size to contain max number of decoded bytes plus the length byte
-    checksum_bytes = [0x00] * (dec_len + 1)
-    checksum_bytes[0] = dec_len
-    i = 0
-    while i < dec_len and 1 + i < len(checksum_bytes):
-        checksum_bytes[1 + i] = enc_msg[3 + i]
-        i += 1
-
-    expected_checksum = crc32(checksum_bytes, len(checksum_bytes))
-
     # Check invalid checksum
-    if expected_checksum != actual_checksum:
+    if not check_enc_packet_csum(enc_msg):
         sys.exit(1)
 
-    for i in range (0, dec_len):
-        dec_msg[i] = enc_msg[3 + i]
-
-    return bytes(dec_msg)
+    return bytes(enc_msg[3 : enc_len - 6])
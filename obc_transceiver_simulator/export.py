@@ -0,0 +1,169 @@
+# Exports section files with exactly one row for each block, in order of block
+# number, so analysis doesn't have to deal with duplicate rows (blocks that
+# were read more than once, from files written before duplicates were
+# detected or with the "latest" policy)
+# e.g.:
+#     $ python export.py
+#     $ python export.py -p first -o export out/2_eps_hk.csv
+# Block number rows from Simulator Actions -> Set File Block Number are not
+# exported
+# PAY_OPT is not exported by default, since it has rows for both PAY_OPT_OD
+# and PAY_OPT_FL blocks with the same block numbers
+# With --archive, the files are made from the raw blocks in the archives
+# (archive.py) instead, converted with the current conversions, e.g.:
+#     $ python export.py --archive
+
+import argparse
+import os
+import sys
+
+from blockset import *
+from command_utilities import *
+from common import *
+from sections import *
+
+
+# Reads the section file at path
+# Returns (header, rows, duplicates, conflicts):
+# header - the first line of the file
+# rows - one row for each block in order of block number, chosen with policy
+#     (one of DUPLICATE_POLICIES in sections.py)
+# duplicates - number of rows dropped because they have the same data as
+#     another row for the block
+# conflicts - rows dropped because they have different data than the row that
+#     was kept
+# Rows are bytes without the newline
+def read_export_rows(path, policy):
+    header = None
+    # Maps block numbers to (row, digest)
+    blocks = {}
+    duplicates = 0
+    conflicts = []
+
+    with open(path, 'rb') as f:
+        for line in f:
+            line = line.rstrip(b"\r\n")
+            if header is None:
+                header = line
+                continue
+
+            num = row_block_num(line)
+            if num is None:
+                continue
+            digest = row_digest(line)
+
+            if num not in blocks:
+                blocks[num] = (line, digest)
+            elif blocks[num][1] == digest:
+                duplicates += 1
+            elif policy == "latest":
+                conflicts.append(blocks[num][0])
+                blocks[num] = (line, digest)
+            else:
+                conflicts.append(line)
+
+    rows = [blocks[num][0] for num in sorted(blocks.keys())]
+    return (header, rows, duplicates, conflicts)
+
+# Writes the rows of the section file at path to export_path
+def export_file(path, export_path, policy):
+    (header, rows, duplicates, conflicts) = read_export_rows(path, policy)
+    with open(export_path, 'wb') as f:
+        if header is not None:
+            f.write(header + b"\n")
+        for row in rows:
+            f.write(row + b"\n")
+
+    if policy == "flag" and len(conflicts) > 0:
+        root, ext = os.path.splitext(export_path)
+        with open(root + "_conflicts" + ext, 'wb') as f:
+            for row in conflicts:
+                f.write(row + b"\n")
+    return (len(rows), duplicates, len(conflicts))
+
+# Returns the rows of section's file for the blocks in the archive from start
+# to end (not including end), using the last record of each block
+def archive_rows(section, start=0, end=None):
+    nums = []
+    records = []
+    for (num, record) in section.archive.scan(start, end):
+        nums.append(num)
+        records.append(record)
+    return record_rows(section, nums, records)
+
+# Returns the rows of section's file for raw blocks from its archive, with the
+# expected block numbers in nums
+def record_rows(section, nums, records):
+    rows = []
+    if section in g_all_cmd_log_sections:
+        for (num, record) in zip(nums, records):
+            (header, cmd_id, fields, converted) = parse_cmd_block(bytes(record))
+            rows.append(section.block_row(num, header, fields, converted))
+    elif len(records) > 0:
+        # Convert every block at once
+        (headers, fields) = unpack_blocks(b"".join(records), len(section.mapping))
+        for (num, record, block_fields, converted) in zip(nums, records, fields,
+                section.pipeline.convert_blocks(fields)):
+            rows.append(section.block_row(num, bytes(record[0:BLOCK_HEADER_LEN]),
+                block_fields.tolist(), converted))
+    return rows
+
+# Writes the CSV file of the last record of every block in the archive of
+# section to export_path
+# Returns the number of blocks
+def export_archive(section, export_path):
+    section.archive.open(read_only=True)
+    try:
+        rows = archive_rows(section)
+        with open(export_path, 'w') as f:
+            f.write(section.header_row())
+            f.writelines(rows)
+    finally:
+        section.archive.close()
+    return len(rows)
+
+
+if __name__ == "__main__":
+    check_python3()
+
+    parser = argparse.ArgumentParser(description=("Export section files with one row per block"))
+    parser.add_argument('files', nargs='*',
+            help='Section files to export (default: every section file in %s)' % OUT_FOLDER)
+    parser.add_argument('-p', '--policy', required=False, default="latest", choices=DUPLICATE_POLICIES,
+            help='Row to keep for a block with rows with different data')
+    parser.add_argument('-o', '--output', required=False, default=os.path.join(OUT_FOLDER, "export"),
+            metavar=('folder'), help='Folder to write the exported files to')
+    parser.add_argument('-a', '--archive', required=False, action='store_true',
+            help='Make the files from the raw block archives in %s instead of the section files' % OUT_FOLDER)
+
+    args = parser.parse_args()
+
+    if args.archive:
+        if not os.path.isdir(args.output):
+            os.makedirs(args.output)
+        sections = [section for section in g_all_read_sections
+            if section.archive is not None and os.path.exists(section.archive.path)]
+        if len(sections) == 0:
+            print("No archives to export")
+            sys.exit(1)
+        for section in sections:
+            export_path = os.path.join(args.output, section.file_name)
+            num_blocks = export_archive(section, export_path)
+            print("%s: %d blocks -> %s" % (section.archive.path, num_blocks, export_path))
+        sys.exit(0)
+    files = args.files
+    if len(files) == 0:
+        files = [os.path.join(OUT_FOLDER, section.file_name) for section in g_all_read_sections
+            if os.path.exists(os.path.join(OUT_FOLDER, section.file_name))]
+    if len(files) == 0:
+        print("No section files to export")
+        sys.exit(1)
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    for path in files:
+        export_path = os.path.join(args.output, os.path.basename(path))
+        (num_rows, duplicates, conflicts) = export_file(path, export_path, args.policy)
+        print("%s: %d blocks, %d duplicate rows, %d conflicting rows -> %s" % (path,
+            num_rows, duplicates, conflicts, export_path))
@@ -0,0 +1,149 @@
+"""
+Lookup tables for the conversions of 12 bit raw ADC and DAC data.
+A raw field can only have 4096 values, so instead of running the conversion
+(e.g. the log() in adc_raw_to_therm_temp()) for every field of every block,
+each conversion is run once for every raw value the first time it is used and
+the results are looked up after that. The results are exactly the same as
+calling the conversion.
+Tables are kept for each conversion and set of constants (e.g. the resistor
+values passed to adc_raw_to_circ_vol()), and can be saved to a file so they
+don't need to be computed again the next time the simulator starts.
+"""
+
+import array
+import hashlib
+import json
+import os
+
+import conversions
+from common import *
+from conversions import *
+
+
+# Number of values of 12 bit raw data
+LUT_SIZE = 1 << 12
+
+# Version of the file format, increase it when it changes
+LUT_FILE_VERSION = 1
+
+# Conversions of 12 bit raw data, which are looked up in tables instead of
+# being called
+LUT_CONVERSIONS = [
+    adc_raw_to_circ_vol,
+    adc_raw_to_circ_cur,
+    adc_raw_to_efuse_cur,
+    adc_raw_to_therm_temp,
+    dac_raw_data_to_heater_setpoint,
+]
+
+
+# Identifies the code of conversions.py, so saved tables are thrown away if any
+# conversion changes
+def conversions_fingerprint():
+    with open(conversions.__file__, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class LUTCache(object):
+    def __init__(self):
+        # Maps (function name, constants...) to an array.array('d') with the
+        # result for every raw value
+        self.tables = {}
+        # True if a table was added since the last load() or save()
+        self.changed = False
+        # File the tables were loaded from, and are saved to by default
+        self.path = None
+
+        self.out_of_range = 0
+
+    def __str__(self):
+        return "LUT cache: tables = %d, out of range values = %d" \
+            % (len(self.tables), self.out_of_range)
+
+    # Returns the table for func with the constants args
+    def table(self, func, *args):
+        key = (func.__name__,) + args
+        table = self.tables.get(key)
+        if table is None:
+            table = array.array('d', [func(raw, *args) for raw in range(LUT_SIZE)])
+            self.tables[key] = table
+            self.changed = True
+        return table
+
+    # Returns a function that is the same as func(raw, *args), but looks raw up
+    # in the table
+    # args must be the constants (e.g. resistor values), not other data
+    def get(self, func, *args):
+        values = self.table(func, *args)
+
+        def convert(raw):
+            if 0 <= raw < LUT_SIZE:
+                return values[raw]
+            # Not 12 bit data (e.g. a corrupted field)
+            self.out_of_range += 1
+            return func(raw, *args)
+        return convert
+
+    def clear(self):
+        self.tables = {}
+        self.changed = False
+
+    # Adds the tables saved in a file, if it exists and was saved with the same
+    # conversions
+    # Returns True if tables were loaded
+    def load(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            return False
+
+        with open(path, 'r') as f:
+            saved = json.load(f)
+        if saved.get("version") != LUT_FILE_VERSION or saved.get("conversions") != conversions_fingerprint():
+            print("Lookup tables in %s are out of date, not using them" % path)
+            return False
+
+        for item in saved["tables"]:
+            key = (item["function"],) + tuple(item["args"])
+            self.tables[key] = array.array('d', item["values"])
+        self.changed = False
+        return True
+
+    def save(self, path=None):
+        if path is None:
+            path = self.path
+
+        tables = []
+        for (key, table) in sorted(self.tables.items(), key=lambda item: repr(item[0])):
+            # repr() of a float (which json uses) reads back as the same float
+            tables.append({"function": key[0], "args": list(key[1:]), "values": table.tolist()})
+
+        with open(path, 'w') as f:
+            json.dump({
+                "version": LUT_FILE_VERSION,
+                "conversions": conversions_fingerprint(),
+                "tables": tables,
+            }, f)
+        self.changed = False
+
+Global.luts = LUTCache()
+
+
+# Builds and saves the tables used by process_data_block(), e.g.
+#     $ python lut.py out/luts.json
+if __name__ == "__main__":
+    import sys
+    import time
+
+    from sections import *
+
+    if len(sys.argv) != 2:
+        print("Usage: python lut.py <file>")
+        sys.exit(1)
+
+    start = time.time()
+    for section in g_all_read_data_sections:
+        # Builds the table for every field that uses one
+        section.pipeline.converters()
+
+    Global.luts.save(sys.argv[1])
+    print("Saved %d tables to %s in %.3fs" % (len(Global.luts.tables), sys.argv[1], time.time() - start))
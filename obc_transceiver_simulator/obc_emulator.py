@@ -0,0 +1,432 @@
+# Emulates the OBC side of the transceiver protocol, so the simulator can be
+# run (and load tested) without a flight board
+# Attach it to the simulator with a pty or TCP, e.g.:
+#     $ python obc_transceiver_simulator.py --pty
+#     Created pseudo-terminal /dev/pts/5
+#     $ python obc_emulator.py -u /dev/pts/5
+#
+# Data blocks are generated from a synthetic flash memory with a configurable
+# number of blocks in each section, so the download throughput of
+# read_missing_blocks() can be measured at different baud rates.
+#
+# This follows obc/src/transceiver.c and obc/src/commands.c, but it is not an
+# exact copy (e.g. CAN commands are answered by OBC itself instead of EPS/PAY)
+
+import argparse
+import collections
+import threading
+import time
+
+from common import *
+from constants import *
+from encoding import *
+from packets import *
+from sections import *
+from transport import *
+
+
+# Decoded length of every command sent to OBC:
+# command ID (2), opcode (1), argument 1 (4), argument 2 (4), password (4)
+CMD_DEC_LEN = 15
+# Number of command blocks READ_PRIM_CMD_BLOCKS/READ_SEC_CMD_BLOCKS can return
+CMD_BLOCKS_MAX_COUNT = 5
+# Folder of the pseudo-terminals created by --pty (on Linux)
+PTY_PATH_PREFIX = "/dev/pts/"
+
+# Number of fields in a data block of each type
+BLOCK_NUM_FIELDS = {
+    BlockType.OBC_HK:       len(OBC_HK_MAPPING),
+    BlockType.EPS_HK:       len(EPS_HK_MAPPING),
+    BlockType.PAY_HK:       len(PAY_HK_MAPPING),
+    BlockType.PAY_OPT:      len(PAY_OPT_MAPPING),
+    BlockType.PAY_OPT_OD:   len(PAY_OPT_MAPPING),
+    BlockType.PAY_OPT_FL:   len(PAY_OPT_MAPPING),
+}
+
+# PAY_OPT_OD and PAY_OPT_FL are read from the PAY_OPT section
+DATA_BLOCK_SECTIONS = {
+    BlockType.OBC_HK:       BlockType.OBC_HK,
+    BlockType.EPS_HK:       BlockType.EPS_HK,
+    BlockType.PAY_HK:       BlockType.PAY_HK,
+    BlockType.PAY_OPT:      BlockType.PAY_OPT,
+    BlockType.PAY_OPT_OD:   BlockType.PAY_OPT,
+    BlockType.PAY_OPT_FL:   BlockType.PAY_OPT,
+}
+
+# Order of the sections in GET_CUR_BLOCK_NUMS and GET_MEM_SEC_ADDRS
+COL_SECTIONS = [
+    BlockType.OBC_HK,
+    BlockType.EPS_HK,
+    BlockType.PAY_HK,
+    BlockType.PAY_OPT,
+    BlockType.PRIM_CMD_LOG,
+    BlockType.SEC_CMD_LOG,
+]
+
+
+# Command received from the ground station
+class CommandPacket(object):
+    def __init__(self, enc_msg):
+        self.enc_msg = enc_msg
+        self.dec_msg = decode_packet(enc_msg)
+        self.valid = len(self.dec_msg) == CMD_DEC_LEN
+        if not self.valid:
+            return
+
+        self.cmd_id = bytes_to_uint15(self.dec_msg[0:2])
+        self.opcode = self.dec_msg[2]
+        self.arg1 = bytes_to_uint32(self.dec_msg[3:7])
+        self.arg2 = bytes_to_uint32(self.dec_msg[7:11])
+        self.password = self.dec_msg[11:15]
+
+
+def encode_ack(cmd_id, status):
+    return encode_packet(uint15_to_bytes(cmd_id) + bytes([status]))
+
+def encode_resp(cmd_id, status, data=b''):
+    # The top bit of the command ID is set for responses
+    return encode_packet(bytes([0x80 | ((cmd_id >> 8) & 0x7F), cmd_id & 0xFF, status]) + data)
+
+
+# Synthetic contents of OBC's flash memory
+# Block fields are a function of the block type, block number and field number,
+# so the same block always reads back the same
+class SyntheticFlash(object):
+    # block_counts maps the BlockType of each section in COL_SECTIONS to its
+    # current block number
+    def __init__(self, block_counts):
+        self.block_counts = dict(block_counts)
+
+    def block_header(self, block_num):
+        # Date and time counts up by one minute per block from 2020-01-01
+        minutes = block_num % (28 * 24 * 60)
+        date = bytes([20, 1, 1 + minutes // (24 * 60)])
+        time_bytes = bytes([(minutes // 60) % 24, minutes % 60, 0])
+        return uint24_to_bytes(block_num) + date + time_bytes + bytes([0x00])
+
+    def field(self, block_type, block_num, index):
+        # Keep values in range for the 12 bit ADC conversions
+        return (block_num * 37 + index * 101 + block_type * 7) & 0xFFF
+
+    # Returns the data for the block, or None if it hasn't been written yet
+    def read_data_block(self, block_type, block_num):
+        if block_type not in DATA_BLOCK_SECTIONS:
+            return None
+        if block_num >= self.block_counts[DATA_BLOCK_SECTIONS[block_type]]:
+            return None
+
+        data = bytearray(self.block_header(block_num))
+        for i in range(BLOCK_NUM_FIELDS[block_type]):
+            data += uint24_to_bytes(self.field(block_type, block_num, i))
+        return bytes(data)
+
+    # Returns the data for the command log blocks, or None if any of them
+    # haven't been written yet
+    def read_cmd_blocks(self, block_type, start, count):
+        if start + count > self.block_counts[block_type]:
+            return None
+
+        data = bytearray()
+        for block_num in range(start, start + count):
+            data += self.block_header(block_num)
+            data += uint16_to_bytes(block_num & 0x7FFF)
+            data += bytes([CommandOpcode.READ_DATA_BLOCK])
+            data += uint32_to_bytes(BlockType.OBC_HK)
+            data += uint32_to_bytes(block_num)
+        return bytes(data)
+
+    # Adds a new block to a data section, returns its block number
+    def col_data_block(self, block_type):
+        section = DATA_BLOCK_SECTIONS[block_type]
+        block_num = self.block_counts[section]
+        self.block_counts[section] += 1
+        return block_num
+
+
+class OBCEmulator(object):
+    # transport - link to the ground station
+    # block_counts - number of blocks in each section (see SyntheticFlash)
+    # cmd_queue_size - commands that can be waiting to run before OBC replies
+    #     with FULL_CMD_QUEUE
+    # resp_delay - seconds to run each command
+    # baud - limits how fast bytes are sent back, like the UART would (None for
+    #     no limit)
+    def __init__(self, transport, block_counts, password=None, cmd_queue_size=8,
+            resp_delay=0.0, baud=None):
+        if password is None:
+            password = Global.password
+
+        self.transport = transport
+        self.flash = SyntheticFlash(block_counts)
+        self.password = password
+        self.cmd_queue_size = cmd_queue_size
+        self.resp_delay = resp_delay
+        self.baud = baud
+
+        self.deframer = Deframer(CommandPacket)
+        # Commands that were ACKed but haven't run yet
+        self.cmd_queue = collections.deque()
+        # Last command ID accepted (0 after a reset)
+        self.last_cmd_id = 0
+        # The last command accepted and its response (if it ran), so a repeated
+        # command can be answered again without running it twice
+        self.last_cmd = None
+        self.last_resp = None
+
+        self.running = False
+        self.thread = None
+
+        self.num_cmds = 0
+        self.num_acks = 0
+        self.num_resps = 0
+        self.tx_bytes = 0
+
+    def __str__(self):
+        return "OBC emulator: commands = %d, ACKs = %d, responses = %d, TX bytes = %d, %s" \
+            % (self.num_cmds, self.num_acks, self.num_resps, self.tx_bytes, self.deframer)
+
+    def send(self, enc_pkt):
+        self.transport.write(enc_pkt)
+        self.tx_bytes += len(enc_pkt)
+        if self.baud is not None:
+            # 10 bits per byte with the start and stop bits
+            time.sleep(len(enc_pkt) * 10.0 / self.baud)
+
+    def send_ack(self, cmd_id, status):
+        self.send(encode_ack(cmd_id, status))
+        self.num_acks += 1
+
+    # Checks a command the same way OBC does before adding it to the queue
+    # Returns the PacketACKStatus to reply with
+    def check_cmd(self, cmd):
+        if not cmd.valid:
+            return PacketACKStatus.INVALID_DEC_FMT
+        if cmd.password != self.password:
+            return PacketACKStatus.INVALID_PWD
+        if cmd.cmd_id == 0:
+            return PacketACKStatus.RESET_CMD_ID
+        if cmd.opcode not in list(map(int, CommandOpcode)):
+            return PacketACKStatus.INVALID_OPCODE
+
+        # Compare as 15 bit serial numbers so the command ID can wrap around
+        diff = (cmd.cmd_id - self.last_cmd_id) & CMD_ID_MASK
+        if self.last_cmd_id != 0 and diff == 0:
+            return PacketACKStatus.REPEATED_CMD_ID
+        if self.last_cmd_id != 0 and diff >= CMD_ID_COUNT // 2:
+            return PacketACKStatus.DECREMENTED_CMD_ID
+
+        if len(self.cmd_queue) >= self.cmd_queue_size:
+            return PacketACKStatus.FULL_CMD_QUEUE
+        return PacketACKStatus.OK
+
+    def receive_cmd(self, cmd):
+        self.num_cmds += 1
+        status = self.check_cmd(cmd)
+
+        if status == PacketACKStatus.REPEATED_CMD_ID and cmd.dec_msg == self.last_cmd.dec_msg:
+            # The ground station didn't get our ACK (or response) and sent the
+            # same command again, so just answer it again
+            self.send_ack(cmd.cmd_id, PacketACKStatus.OK)
+            if self.last_resp is not None:
+                self.send(self.last_resp)
+            return
+
+        if status == PacketACKStatus.RESET_CMD_ID:
+            self.last_cmd_id = 0
+            self.last_cmd = None
+            self.last_resp = None
+        elif status == PacketACKStatus.OK:
+            self.last_cmd_id = cmd.cmd_id
+            self.last_cmd = cmd
+            self.last_resp = None
+            self.cmd_queue.append((time.time() + self.resp_delay, cmd))
+
+        cmd_id = cmd.cmd_id if cmd.valid else 0
+        self.send_ack(cmd_id, status)
+
+    # Returns (status, data) for the response to the command
+    def run_cmd(self, cmd):
+        opcode = cmd.opcode
+        arg1 = cmd.arg1
+        arg2 = cmd.arg2
+        flash = self.flash
+
+        if opcode == CommandOpcode.GET_RTC:
+            return (PacketRespStatus.OK, bytes([20, 1, 1, 0, 0, 0]))
+
+        elif opcode == CommandOpcode.READ_OBC_EEPROM:
+            return (PacketRespStatus.OK, uint32_to_bytes(0xFFFFFFFF))
+
+        elif opcode == CommandOpcode.READ_OBC_RAM_BYTE:
+            return (PacketRespStatus.OK, bytes([0x00]))
+
+        elif opcode == CommandOpcode.READ_DATA_BLOCK:
+            data = flash.read_data_block(arg1, arg2)
+            if data is None:
+                return (PacketRespStatus.INVALID_ARGS, b'')
+            return (PacketRespStatus.OK, data)
+
+        elif opcode == CommandOpcode.READ_PRIM_CMD_BLOCKS or opcode == CommandOpcode.READ_SEC_CMD_BLOCKS:
+            block_type = BlockType.PRIM_CMD_LOG if opcode == CommandOpcode.READ_PRIM_CMD_BLOCKS else BlockType.SEC_CMD_LOG
+            if arg2 > CMD_BLOCKS_MAX_COUNT:
+                return (PacketRespStatus.INVALID_ARGS, b'')
+            data = flash.read_cmd_blocks(block_type, arg1, arg2)
+            if data is None:
+                return (PacketRespStatus.INVALID_ARGS, b'')
+            return (PacketRespStatus.OK, data)
+
+        elif opcode == CommandOpcode.READ_REC_STATUS_INFO:
+            return (PacketRespStatus.OK, bytes(33))
+
+        elif opcode == CommandOpcode.READ_REC_LOC_DATA_BLOCK:
+            if arg1 not in DATA_BLOCK_SECTIONS:
+                return (PacketRespStatus.INVALID_ARGS, b'')
+            block_num = max(flash.block_counts[DATA_BLOCK_SECTIONS[arg1]] - 1, 0)
+            return (PacketRespStatus.OK, flash.read_data_block(arg1, block_num) or b'')
+
+        elif opcode == CommandOpcode.COL_DATA_BLOCK:
+            if arg1 not in DATA_BLOCK_SECTIONS:
+                return (PacketRespStatus.INVALID_ARGS, b'')
+            return (PacketRespStatus.OK, uint32_to_bytes(flash.col_data_block(arg1)))
+
+        elif opcode == CommandOpcode.GET_AUTO_DATA_COL_SETTINGS:
+            data = uint32_to_bytes(0)
+            for i in range(4):
+                data += bytes([0]) + uint32_to_bytes(60) + uint32_to_bytes(0)
+            return (PacketRespStatus.OK, data)
+
+        elif opcode == CommandOpcode.GET_CUR_BLOCK_NUMS:
+            data = b''
+            for section in COL_SECTIONS:
+                data += uint32_to_bytes(flash.block_counts[section])
+            return (PacketRespStatus.OK, data)
+
+        elif opcode == CommandOpcode.SET_CUR_BLOCK_NUM:
+            if arg1 not in flash.block_counts:
+                return (PacketRespStatus.INVALID_ARGS, b'')
+            flash.block_counts[arg1] = arg2
+            return (PacketRespStatus.OK, b'')
+
+        elif opcode == CommandOpcode.GET_MEM_SEC_ADDRS:
+            data = b''
+            for i in range(len(COL_SECTIONS)):
+                data += uint32_to_bytes(i * 0x100000) + uint32_to_bytes((i + 1) * 0x100000 - 1)
+            return (PacketRespStatus.OK, data)
+
+        elif opcode == CommandOpcode.SEND_EPS_CAN_MSG or opcode == CommandOpcode.SEND_PAY_CAN_MSG:
+            # Answer as if the subsystem echoed the message back with no data
+            data = bytes([(arg1 >> 24) & 0xFF, (arg1 >> 16) & 0xFF, 0x00, 0x00]) + uint32_to_bytes(0)
+            return (PacketRespStatus.OK, data)
+
+        # All other commands have no response data
+        return (PacketRespStatus.OK, b'')
+
+    # Receives and runs commands until timeout seconds have passed (or forever)
+    def run(self, timeout=None):
+        end_time = None if timeout is None else time.time() + timeout
+        self.running = True
+
+        while self.running and (end_time is None or time.time() < end_time):
+            # Don't wait to read if a command is ready to run
+            if len(self.cmd_queue) > 0:
+                self.transport.timeout = max(min(self.cmd_queue[0][0] - time.time(), 0.1), 0)
+            else:
+                self.transport.timeout = 0.1
+            data = self.transport.read(max(self.transport.in_waiting, 1))
+
+            csum_errors = self.deframer.csum_errors
+            for cmd in self.deframer.feed(data):
+                self.receive_cmd(cmd)
+            # OBC doesn't know the command ID of a corrupted packet
+            for i in range(self.deframer.csum_errors - csum_errors):
+                self.send_ack(0, PacketACKStatus.INVALID_CSUM)
+
+            if len(self.cmd_queue) > 0 and self.cmd_queue[0][0] <= time.time():
+                (ready_time, cmd) = self.cmd_queue.popleft()
+                (status, data) = self.run_cmd(cmd)
+                resp = encode_resp(cmd.cmd_id, status, data)
+                if cmd is self.last_cmd:
+                    self.last_resp = resp
+                self.send(resp)
+                self.num_resps += 1
+
+    # Runs in a background thread (e.g. with one end of a loopback transport)
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+
+# Parses a string like "OBC_HK=100,PAY_OPT=20" into a dict of block counts
+# Sections that are not listed get the default count
+def parse_block_counts(string, default):
+    block_counts = {}
+    for section in COL_SECTIONS:
+        block_counts[section] = default
+
+    if string is not None and len(string) > 0:
+        for item in string.split(","):
+            (name, count) = item.split("=")
+            block_counts[BlockType[name.strip().upper()]] = int(count)
+    return block_counts
+
+
+if __name__ == "__main__":
+    check_python3()
+
+    parser = argparse.ArgumentParser(description=("OBC emulator"))
+    link = parser.add_mutually_exclusive_group(required=True)
+    link.add_argument('-u', '--uart',
+            metavar=('uart'), help='Serial port, or pty to attach to (e.g. the %s... path printed by the simulator with --pty)' % PTY_PATH_PREFIX)
+    link.add_argument('--pty', action='store_true',
+            help='Create a pseudo-terminal for the simulator to attach to with --uart')
+    link.add_argument('-l', '--tcp-listen',
+            metavar=('host:port'), help='Wait for the simulator to connect with --tcp')
+    parser.add_argument('-b', '--baud', required=False, default=None,
+            metavar=('baud'), help='Baud rate of the serial port (default: 9600), and limit the downlink to it (default: no limit)')
+    parser.add_argument('-n', '--num-blocks', required=False, default=100,
+            metavar=('num_blocks'), help='Number of blocks in every section')
+    parser.add_argument('-s', '--sections', required=False, default=None,
+            metavar=('sections'), help='Number of blocks in specific sections (e.g. OBC_HK=1000,PAY_OPT=50)')
+    parser.add_argument('-q', '--queue-size', required=False, default=8,
+            metavar=('queue_size'), help='Command queue size')
+    parser.add_argument('-d', '--resp-delay', required=False, default=0.0,
+            metavar=('resp_delay'), help='Seconds to run each command')
+
+    args = parser.parse_args()
+    baud = None if args.baud is None else int(args.baud)
+
+    if args.uart is not None:
+        # A pty (e.g. from the simulator with --pty) has no baud rate, but a
+        # real serial port has to be opened at the right one
+        if args.uart.startswith(PTY_PATH_PREFIX):
+            transport = PtyTransport(args.uart)
+        else:
+            transport = SerialTransport(args.uart, 9600 if baud is None else baud)
+        print("Using port " + args.uart)
+    elif args.pty:
+        transport = PtyTransport()
+        print("Created pseudo-terminal " + transport.peer_name)
+    else:
+        (host, port) = args.tcp_listen.rsplit(":", 1)
+        transport = TCPTransport(host, int(port), listen=True)
+
+    emulator = OBCEmulator(transport,
+        parse_block_counts(args.sections, int(args.num_blocks)),
+        cmd_queue_size=int(args.queue_size),
+        resp_delay=float(args.resp_delay),
+        baud=baud)
+
+    print("OBC emulator running, press Ctrl-C to quit")
+    try:
+        emulator.run()
+    except KeyboardInterrupt:
+        pass
+
+    print(emulator)
+    transport.close()
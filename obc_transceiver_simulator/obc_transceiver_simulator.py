@@ -16,23 +16,17 @@ import os
 import codecs
 import argparse
 
+from capture import *
+from channel import *
 from command_utilities import *
 from commands import *
 from common import *
 from constants import *
 from conversions import *
 from encoding import *
+from lut import *
 from sections import *
-
-try:
-    import serial
-    import serial.tools.list_ports
-except ImportError:
-    print("Error: This program requires the pyserial module. To install " +
-        "pyserial,\nvisit https://pypi.org/project/pyserial/ or run\n" +
-        "    $ pip install pyserial\n" +
-        "in the command line.")
-    sys.exit(1)
+from transport import *
 
 
 # Resets for both the satellite and the simulator
@@ -49,12 +43,14 @@ def sim_data_col():
     print("a. Print File Info")
     print("b. Read Missing Blocks")
     print("c. Read Missing Secondary Command Log Blocks")
+    print("d. Write Section Files to Disk")
     
     cmd = input("Enter command: ")
 
     if cmd == "a":
         for section in g_all_sections:
             print(section)
+            print("    " + str(section.blocks))
     
     elif cmd == "b":  # Read missing blocks
         read_missing_blocks()
@@ -62,6 +58,10 @@ def sim_data_col():
     elif cmd == "c":  # Read missing secondary command log blocks
         read_missing_sec_cmd_log_blocks()
 
+    elif cmd == "d":  # Checkpoint
+        checkpoint_all_sections()
+        print("Wrote section files to disk")
+
 
 def sim_actions():
     print("a. Set File Block Number")
@@ -117,15 +117,17 @@ def sim_actions():
         send_and_receive_packet(CommandOpcode.SET_AUTO_DATA_COL_ENABLE, BlockType.PAY_OPT, 0)
     
     elif cmd == "d":
-        uplink_pct = 0.0 if Global.total_uplink_packets == 0 else Global.dropped_uplink_packets / Global.total_uplink_packets * 100.0
-        downlink_pct = 0.0 if Global.total_downlink_packets == 0 else Global.dropped_downlink_packets / Global.total_downlink_packets * 100.0
-
         print_div()
-        print("Dropped packets:")
-        print("Uplink: %d/%d (%.1f%%)" % (
-            Global.dropped_uplink_packets, Global.total_uplink_packets, uplink_pct))
-        print("Downlink: %d/%d (%.1f%%)" % (
-            Global.dropped_downlink_packets, Global.total_downlink_packets, downlink_pct))
+        print("TX packets = %d, retransmissions = %d" % (Global.tx_packets, Global.retransmissions))
+        if Global.channel is not None:
+            print(Global.channel)
+        print(Global.deframer)
+        print(Global.pending)
+        print(Global.rtt)
+        print(Global.luts)
+        print(Global.sent_packets)
+        if Global.reader is not None:
+            print(Global.reader)
         print_div()
 
     elif cmd == "e":  # Change password
@@ -173,15 +175,18 @@ def main_loop():
             sim_actions()
 
         elif cmd == "c":
-            read_serial()
+            flush_rx()
             print("Read serial")
 
-            # Write dummy data to force it to display the rest of serial_read.log
-            Global.serial_write_file.write("\n")
-            Global.serial_write_file.flush()
-
         elif cmd == "q":
-            Global.serial.close() # Close serial port when program done
+            if Global.reader is not None:
+                Global.reader.stop()
+            close_all_sections()
+            Global.capture.close()
+            if Global.luts.path is not None and Global.luts.changed:
+                Global.luts.save()
+                print("Saved lookup tables to " + Global.luts.path)
+            Global.transport.close() # Close serial port when program done
             print("Quitting simulator")
             sys.exit(0)
 
@@ -209,60 +214,122 @@ if __name__ == "__main__":
 
     print("Transceiver simulation starting...")
 
-    # It is necessary for the user to specify the UART port
+    # It is necessary for the user to specify the UART port (or another link)
     parser = argparse.ArgumentParser(description=("Transceiver simulator"))
     # Method arguments include (in order), expected shell text, name of that argument (used below),
     # nargs specifies the number of arguments, with '+' inserting arguments of that type into a list
     # required is self-explanatory, metavar assigns a displayed name to each argument when using the help argument
-    parser.add_argument('-u', '--uart', required=True,
+    link = parser.add_mutually_exclusive_group(required=True)
+    link.add_argument('-u', '--uart',
             metavar=('uart'), help='UART port on programmer')
+    link.add_argument('-t', '--tcp',
+            metavar=('host:port'), help='TCP serial bridge to connect to instead of a UART port')
+    link.add_argument('--pty', action='store_true',
+            help='Create a pseudo-terminal for another program (e.g. the OBC emulator) to attach to')
     parser.add_argument('-b', '--baud', required=False, default=9600,
             metavar=('baud'), help='Baud rate (e.g. 1200, 9600, 19200, 115200')
-    parser.add_argument('-ud', '--uplink-drop', required=False, default=0,
+    parser.add_argument('-ud', '--uplink-drop', required=False, default=None,
             metavar=('uplink'), help='Package drop rate from ground to satellite (0-1)')
-    parser.add_argument('-dd', '--downlink-drop', required=False, default=0,
+    parser.add_argument('-dd', '--downlink-drop', required=False, default=None,
             metavar=('downlink'), help='Package drop rate from satellite to ground (0-1)')
+    parser.add_argument('-uc', '--uplink-channel', required=False, default=None,
+            metavar=('uplink'), help='Simulated uplink channel (e.g. loss=0.1,burst_len=4,ber=1e-5,latency=0.1,jitter=0.05,rate=9600), see channel.py')
+    parser.add_argument('-dc', '--downlink-channel', required=False, default=None,
+            metavar=('downlink'), help='Simulated downlink channel, same format as --uplink-channel')
+    parser.add_argument('-s', '--seed', required=False, default=None,
+            metavar=('seed'), help='Random seed for the simulated channels (default: random)')
+    parser.add_argument('-w', '--window', required=False, default=1,
+            metavar=('window'), help='Number of commands to send without waiting for responses when reading blocks')
+    parser.add_argument('-p', '--poll', required=False, action='store_true',
+            help='Poll the serial port instead of reading it in a background thread')
+    parser.add_argument('-l', '--lut-file', required=False, default=None,
+            metavar=('lut_file'), help='File to load conversion lookup tables from and save them to (e.g. out/luts.json)')
+    parser.add_argument('-f', '--fixed-timeouts', required=False, action='store_true',
+            help='Always wait the full wait time instead of adapting to the measured round trip times')
+    parser.add_argument('--flush-rows', required=False, default=Global.flush_rows,
+            metavar=('rows'), help='Number of rows to write to the section files at once')
+    parser.add_argument('--flush-ms', required=False, default=Global.flush_ms,
+            metavar=('ms'), help='Longest time (in ms) a row waits to be written to its section file (0 to write every row right away)')
+    parser.add_argument('--duplicates', required=False, default=Global.duplicates, choices=DUPLICATE_POLICIES,
+            help='What to do with a block that is already in its section file with different data: write it too (latest), skip it (first), or write it to a conflicts file (flag)')
 
     # Converts strings to objects, which are then assigned to variables below
     args = parser.parse_args()
     uart = args.uart
     baud = args.baud
-    Global.uplink_drop = float(args.uplink_drop)
-    print("Uplink packet drop rate: %.1f%%" % (Global.uplink_drop * 100.0))
-    Global.downlink_drop = float(args.downlink_drop)
-    print("Downlink packet drop rate: %.1f%%" % (Global.downlink_drop * 100.0))
+    # The drop rates are shorthand for channels with independent losses
+    uplink_spec = args.uplink_channel
+    if args.uplink_drop is not None:
+        uplink_spec = "loss=" + args.uplink_drop + ("," + uplink_spec if uplink_spec else "")
+    downlink_spec = args.downlink_channel
+    if args.downlink_drop is not None:
+        downlink_spec = "loss=" + args.downlink_drop + ("," + downlink_spec if downlink_spec else "")
+    # Use different (but reproducible) random numbers for the two directions
+    seed = None if args.seed is None else int(args.seed)
+    uplink = parse_channel(uplink_spec, seed)
+    downlink = parse_channel(downlink_spec, None if seed is None else seed + 1)
+    Global.window_size = int(args.window)
+    print("Command window size: %d" % Global.window_size)
+    Global.adaptive_timeouts = not args.fixed_timeouts
+    Global.flush_rows = int(args.flush_rows)
+    Global.flush_ms = float(args.flush_ms)
+    Global.duplicates = args.duplicates
+
+    if uart is not None:
+        try:
+            Global.transport = SerialTransport(uart, baud, timeout=0.1)
+            print("Using port " + uart + " for UART")
+        except OSError as e:
+            print("ERROR: Port " + uart + " is in use")
+            sys.exit(1)
+    elif args.tcp is not None:
+        (host, port) = args.tcp.rsplit(":", 1)
+        try:
+            Global.transport = TCPTransport(host, int(port), timeout=0.1)
+            print("Connected to " + args.tcp)
+        except OSError as e:
+            print("ERROR: Could not connect to " + args.tcp)
+            sys.exit(1)
+    else:
+        Global.transport = PtyTransport(timeout=0.1)
+        print("Created pseudo-terminal " + Global.transport.peer_name)
 
-    try:
-        Global.serial = serial.Serial(uart, baud, timeout=0.1)
-        print("Using port " + uart + " for UART")
-    except serial.SerialException as e:
-        print("ERROR: Port " + uart + " is in use")
-        sys.exit(1)
+    if not uplink.is_ideal() or not downlink.is_ideal():
+        Global.channel = ChannelTransport(Global.transport, uplink, downlink)
+        Global.transport = Global.channel
+        print("Simulating uplink channel: " + uplink_spec if uplink_spec else "Ideal uplink channel")
+        print("Simulating downlink channel: " + downlink_spec if downlink_spec else "Ideal downlink channel")
 
     for section in g_all_sections:
         section.load_file()
-    
-    # https://stackoverflow.com/questions/2757887/file-mode-for-creatingreadingappendingbinary
 
-    write_path = OUT_FOLDER + "/" + "serial_write.log"
-    if os.path.exists(write_path):
-        print("Found existing file %s, appending to file" % write_path)
-    else:
-        print("Did not find existing file %s, creating new file" % write_path)
-    Global.serial_write_file = open(write_path, 'a+')
+    if args.lut_file is not None:
+        if Global.luts.load(args.lut_file):
+            print("Loaded %d lookup tables from %s" % (len(Global.luts.tables), args.lut_file))
+        else:
+            print("Lookup tables will be saved to " + args.lut_file)
     
-    read_path = OUT_FOLDER + "/" + "serial_read.log"
-    if os.path.exists(read_path):
-        print("Found existing file %s, appending to file" % read_path)
+    capture_path = OUT_FOLDER + "/" + "serial.cap"
+    if os.path.exists(capture_path):
+        print("Found existing file %s, appending to file" % capture_path)
     else:
-        print("Did not find existing file %s, creating new file" % read_path)
-    Global.serial_read_file = open(read_path, 'a+')
+        print("Did not find existing file %s, creating new file" % capture_path)
+    Global.capture = CaptureWriter(capture_path)
+    try:
+        Global.capture.open()
+    except ValueError as e:
+        print("ERROR: %s: %s" % (capture_path, e))
+        sys.exit(1)
+
+    if not args.poll:
+        Global.reader = SerialReader(Global.transport, Global.deframer)
+        Global.reader.start()
+        print("Reading serial port in the background")
 
-    print("To view these files live, run:")
-    print("tail -f out/serial*.log")
-    # Command from https://serverfault.com/questions/126407/display-n-characters-as-newlines-when-using-tail
-    print("To view them with newlines, run:")
-    print(r"tail -f out/serial*.log | sed 's/\\n/\n/g'")
+    print("To view the sent and received bytes live, run:")
+    print("python capture.py -f " + capture_path)
+    print("To convert them to out/serial_write.log and out/serial_read.log, run:")
+    print("python capture.py " + capture_path)
 
     # Just do this at the beginning
     # If we restart the simulator it won't restart OBC, so just sync them up
@@ -270,8 +337,8 @@ if __name__ == "__main__":
 
     main_loop()
     
-    for section in g_all_sections:
-        section.data_file.close()
+    close_all_sections()
+    Global.capture.close()
 
-    Global.serial.close() # Close serial port when program done
+    Global.transport.close() # Close serial port when program done
     print("Quit Transceiver Simulator")
@@ -1,5 +1,3 @@
-import random
-
 from common import *
 from encoding import *
 
@@ -36,11 +34,220 @@ class RXPacket(object):
         self.data = self.dec_msg[3:]
 
 
+# Finds encoded packets in a stream of received bytes
+# Bytes can be fed in chunks of any size (e.g. whatever read_serial() returns),
+# and any partial packet is kept until the rest of it arrives
+# Note that there might be 0x55 bytes in the decoded message data, so a 0x55
+# byte is only treated as the start of a packet if the length byte, the other
+# delimiters and the checksum all match
+class Deframer(object):
+    # packet_class is created from each encoded packet found
+    def __init__(self, packet_class=RXPacket):
+        self.packet_class = packet_class
+        self.buf = bytearray()
+        # Every 0x55 byte before this index in buf has already been checked
+        self.scan_pos = 0
+        # Indices in buf of 0x55 bytes that could still start a packet once
+        # more bytes arrive
+        self.waiting = []
+
+        self.num_packets = 0
+        # 0x55 bytes that turned out not to start a packet
+        self.framing_errors = 0
+        # Packets with correct delimiters but the wrong checksum
+        self.csum_errors = 0
+        # Bytes thrown away because they were not part of any packet
+        self.discarded_bytes = 0
+
+    def __str__(self):
+        return "Deframer: packets = %d, framing errors = %d, checksum errors = %d, discarded bytes = %d, buffered bytes = %d" \
+            % (self.num_packets, self.framing_errors, self.csum_errors, self.discarded_bytes, len(self.buf))
+
+    # Throws away any buffered bytes (e.g. to flush stale data before sending a
+    # new packet)
+    def reset(self):
+        self.discarded_bytes += len(self.buf)
+        self.buf = bytearray()
+        self.scan_pos = 0
+        self.waiting = []
+
+    # Returns the index after the end of the packet starting at start, None if
+    # more bytes are needed to tell, or -1 if it is not a packet
+    def check_start(self, start):
+        buf = self.buf
+
+        # Need the length byte and the second delimiter
+        if start + 3 > len(buf):
+            return None
+        if buf[start + 2] != TRANS_PKT_DELIMITER:
+            self.framing_errors += 1
+            return -1
+
+        end = start + buf[start + 1] + TRANS_ENC_OVERHEAD
+        if end > len(buf):
+            return None
+        if buf[end - 6] != TRANS_PKT_DELIMITER or buf[end - 1] != TRANS_PKT_DELIMITER:
+            self.framing_errors += 1
+            return -1
+
+        if not check_enc_packet_csum(memoryview(buf)[start : end]):
+            self.csum_errors += 1
+            return -1
+
+        return end
+
+    # Possible packet starts in order: the ones still waiting for more bytes,
+    # then any 0x55 bytes that have not been checked yet
+    # Each 0x55 byte is only returned by find() once, so the scan is linear in
+    # the number of bytes received
+    def candidate_starts(self):
+        for start in self.waiting:
+            yield start
+        while True:
+            start = self.buf.find(TRANS_PKT_DELIMITER, self.scan_pos)
+            if start < 0:
+                self.scan_pos = len(self.buf)
+                return
+            self.scan_pos = start + 1
+            yield start
+
+    # Adds new bytes and returns an iterator over all the complete packets found
+    # so far
+    # If the iterator is not used until the end, the remaining bytes stay
+    # buffered and are checked on the next call
+    def feed(self, data=b''):
+        buf = self.buf
+        buf += data
+
+        while True:
+            still_waiting = []
+            start = end = -1
+            for candidate in self.candidate_starts():
+                end = self.check_start(candidate)
+                if end is None:
+                    still_waiting.append(candidate)
+                elif end >= 0:
+                    start = candidate
+                    break
+
+            if start < 0:
+                break
+
+            # Any earlier possible starts were not real packets
+            self.framing_errors += len(still_waiting)
+            # Starts after this packet (already found before) are still valid
+            self.waiting = [i - end for i in self.waiting if i >= end]
+            self.scan_pos = max(self.scan_pos - end, 0)
+
+            enc_pkt = bytes(buf[start : end])
+            # Remove the packet before returning it so stopping the iterator
+            # here leaves the buffer in a consistent state
+            self.discarded_bytes += start
+            del buf[:end]
+            self.num_packets += 1
+            yield self.packet_class(enc_pkt)
+
+        # Keep only the bytes from the first possible start of a packet onwards
+        first = still_waiting[0] if len(still_waiting) > 0 else len(buf)
+        self.discarded_bytes += first
+        del buf[:first]
+        self.waiting = [i - first for i in still_waiting]
+        self.scan_pos = len(buf)
+
+Global.deframer = Deframer()
+
+
+# Received packets that arrived while waiting for a different packet (e.g. a
+# response that arrived before its ACK), so they can still be matched to their
+# TXPacket later instead of being thrown away
+class PendingPackets(object):
+    def __init__(self, max_packets=256):
+        # Maps (command ID, is_resp) to RXPacket, oldest first
+        self.packets = {}
+        self.max_packets = max_packets
+
+        # Packets that arrived after we stopped waiting for them but were still
+        # matched to their command
+        self.late_packets = 0
+        # Attempts that were not sent again because a pending packet showed the
+        # command had already reached OBC
+        self.avoided_retransmissions = 0
+
+    def __str__(self):
+        return "Pending packets: %d, late packets = %d, avoided retransmissions = %d" \
+            % (len(self.packets), self.late_packets, self.avoided_retransmissions)
+
+    def add(self, rx_packet):
+        key = (rx_packet.command_id, rx_packet.is_resp)
+        # Re-insert so a duplicate counts as the newest
+        self.packets.pop(key, None)
+        self.packets[key] = rx_packet
+
+        # Evict the oldest
+        while len(self.packets) > self.max_packets:
+            del self.packets[next(iter(self.packets))]
+
+    # Returns True if there is a pending packet for the command ID
+    def contains(self, cmd_id, is_resp):
+        return (cmd_id & CMD_ID_MASK, is_resp) in self.packets
+
+    # Removes and returns the pending packet, or None if there isn't one
+    def take(self, cmd_id, is_resp):
+        return self.packets.pop((cmd_id & CMD_ID_MASK, is_resp), None)
+
+    # Forgets any pending packets for the command ID
+    def remove(self, cmd_id):
+        self.packets.pop((cmd_id & CMD_ID_MASK, False), None)
+        self.packets.pop((cmd_id & CMD_ID_MASK, True), None)
+
+Global.pending = PendingPackets()
+
+
+# Throws away anything received so far (e.g. before sending a new packet)
+def flush_rx():
+    if Global.reader is not None:
+        Global.reader.flush()
+    else:
+        read_serial()
+        Global.deframer.reset()
+
+# Waits for the next RXPacket, up to about timeout seconds
+# (defaults to one serial timeout)
+# Without the background reader, this reads from the transport once
+# Returns the RXPacket (which could have been buffered from an earlier read),
+# or None if there isn't one
+def poll_rx_packet(timeout=None):
+    if timeout is None:
+        timeout = Global.transport.timeout
+
+    if Global.reader is not None:
+        return Global.reader.get_packet(timeout)
+
+    deframer = Global.deframer
+    csum_errors = deframer.csum_errors
+
+    rx_packet = None
+    for packet in deframer.feed(read_serial()):
+        rx_packet = packet
+        break
+
+    if deframer.csum_errors > csum_errors:
+        print("WRONG CHECKSUM (%d packets discarded)" % (deframer.csum_errors - csum_errors))
+    return rx_packet
+
 # wait_time is in seconds
 def receive_rx_packet(wait_time=5):
     print("Waiting for RX packet...")
 
-    uart_rx_buf = bytes(0)
+    if Global.reader is not None:
+        rx_packet = Global.reader.get_packet(wait_time)
+        if rx_packet is None:
+            print("No RX packet found")
+            return None
+        print("Successfully received RX packet")
+        return rx_packet
+
+    deframer = Global.deframer
 
     # Read from serial to bytes
     # DO NOT DECODE IT WITH UTF-8, IT DISCARDS ANY CHARACTERS > 127
@@ -49,78 +256,17 @@ def receive_rx_packet(wait_time=5):
     
     # Make sure to delay for longer than 2 seconds
     # (OBC needs to clear its UART RX buffer after 2 seconds)
-    for i in range(int(wait_time / Global.serial.timeout)):
-        new = read_serial()
-        # print("%d new bytes" % len(new))
-        uart_rx_buf += new
-
-        # Get indices of all delimiter (0x55) bytes
-        delim_indices = [i for i in range(len(uart_rx_buf)) if uart_rx_buf[i] == 0x55]
-        # print("cr_indices =", cr_indices)
-
-        # Note that there might be 0x55 bytes in the decoded message data, so this can be tricky to detect
-
-        # Need at least 4 delimiter bytes to form packet, but note this might include 0x55 data bytes
-        if len(delim_indices) >= 4:
-            # print("Detected 4 delim characters")
-            # print("Received UART (raw):", bytes_to_string(uart_rx_buf))
-
-            start = delim_indices[0]
-            dec_len = uart_rx_buf[start + 1]
-            end = start + dec_len + 9 - 1   # should be index of ending 0x55 if it's a valid packet
-
-            # If the delimiters are in the right places and the length byte
-            # matches the number of bytes in the decoded section
-            # Also need to have enough bytes in the buffer
-            if uart_rx_buf[start] == 0x55 and \
-                    uart_rx_buf[start + 2] == 0x55 and \
-                    end < len(uart_rx_buf):
-
-                if uart_rx_buf[end + 1 - 6] == 0x55 and \
-                        uart_rx_buf[end + 1 - 1] == 0x55:
-                    
-                    enc_pkt = uart_rx_buf[start : end + 1]
-                    enc_len = len(enc_pkt)
-
-                    # print("Received encoded packet (%d bytes):" % len(enc_pkt), bytes_to_string(enc_pkt))
-
-                    # Bytes to calculate the checksum on
-                    csum_bytes = bytes([enc_pkt[1]]) + enc_pkt[3 : enc_len - 6]
-                    # Calculate expected checksum
-                    calc_csum = crc32(csum_bytes, len(csum_bytes))
-                    # print("Calculated checksum is 0x%x" % calc_csum)
-
-                    rcvd_csum = bytes_to_uint32(enc_pkt[enc_len - 5 : enc_len - 1])
-                    # print("Received checksum is 0x%x" % rcvd_csum)
-
-                    # See if checksum is correct
-                    if rcvd_csum == calc_csum:
-                        print("Correct checksum")
-                    else:
-                        print("WRONG CHECKSUM")
-                        print("Encoded packet (%d bytes): %s" % (enc_len, bytes_to_string(enc_pkt)))
-                        print("received 0x%.8lx, should be 0x%.8lx" % (rcvd_csum, calc_csum))
-                        sys.exit(1)
-
-                    # Drop packet?
-                    if (random.uniform(0,1) < Global.downlink_drop):
-                        print_div()
-                        print("Downlink Packet Dropped")
-                        Global.dropped_downlink_packets += 1
-                        Global.total_downlink_packets += 1
-                        return None
-
-                    # If did not drop packet
-                    print("Successfully received RX packet")
-                    Global.total_downlink_packets += 1
-                    return RXPacket(enc_pkt)
-
-                # If we received enough bytes but it is not in packet format,
-                # discard some bytes so it will check again on the next loop iteration
-                else:
-                    uart_rx_buf = uart_rx_buf[delim_indices[1] : ]
-
-    # print("Received UART (raw):", bytes_to_string(uart_rx_buf))
+    for i in range(int(wait_time / Global.transport.timeout)):
+        csum_errors = deframer.csum_errors
+
+        # Packets already buffered from an earlier read are returned first
+        for rx_packet in deframer.feed(read_serial()):
+            print("Successfully received RX packet")
+            return rx_packet
+
+        if deframer.csum_errors > csum_errors:
+            print("WRONG CHECKSUM (%d packets discarded)" % (deframer.csum_errors - csum_errors))
+
     print("No RX packet found")
     return None
 
@@ -157,18 +303,12 @@ def send_tx_packet(packet):
     print("Decoded (%d bytes):" % len(packet.dec_pkt), bytes_to_string(packet.dec_pkt))
     print("Encoded (%d bytes):" % len(packet.enc_pkt), bytes_to_string(packet.enc_pkt))
 
-    # Drop packets?
-    if (random.uniform(0,1) < Global.uplink_drop):
-        print_div()
-        print("Uplink Packet Dropped")
-        Global.dropped_uplink_packets += 1
-    else:
-        send_raw_uart(packet.enc_pkt)
-    
-    # Whether the send actually worked or dropped, we still think we sent it so
-    # add it to our dictionary mapping command IDs to send packets
-    Global.sent_packets[packet.cmd_id] = packet
-    
-    Global.total_uplink_packets += 1
+    # Losses and errors on the link are simulated by the transport (see
+    # channel.py)
+    send_raw_uart(packet.enc_pkt)
+    Global.tx_packets += 1
+
+    # Add it to our table mapping command IDs to sent packets
+    Global.sent_packets.add(packet)
 
     print_div()
@@ -0,0 +1,149 @@
+"""
+Converters for the fields of data blocks, compiled from the section mappings
+(sections.py).
+Every field in a mapping has a conversion spec, which is either None (the raw
+number is used as it is) or a tuple of a function from conversions.py or
+common.py and the constants it takes after the raw number, e.g.
+(adc_raw_to_circ_vol, low_res, high_res). A BlockPipeline turns the specs of a
+mapping into one converter per field once, and everything that converts blocks
+uses it, so a new field only needs a new line in its mapping:
+- process_data_block() converts each received block with convert()
+- Saved blocks (e.g. from common.unpack_blocks()) are converted all at once with
+  convert_columns() or convert_blocks(), which use the array versions of the
+  conversions in conversions_vec.py if numpy is installed
+Both give exactly the same values.
+"""
+
+from common import *
+from lut import *
+
+
+# Returns the conversion spec of a field in a mapping
+# (the command log mappings don't have one)
+def field_conversion(field):
+    if len(field) > 3:
+        return field[3]
+    return None
+
+# Returns a function that converts one raw field with the spec
+def compile_field(spec):
+    if spec is None:
+        return lambda raw: raw
+
+    (func, args) = (spec[0], tuple(spec[1:]))
+    if func in LUT_CONVERSIONS:
+        return Global.luts.get(func, *args)
+    if len(args) == 0:
+        return func
+    return lambda raw: func(raw, *args)
+
+# Returns a function that converts a numpy array of raw fields with the spec,
+# or None if there is no array version of the conversion (e.g. conversions to
+# strings)
+def compile_field_vec(spec):
+    import conversions_vec
+
+    if spec is None:
+        return lambda raw: raw.astype(numpy.int64)
+
+    (func, args) = (spec[0], tuple(spec[1:]))
+    func_vec = getattr(conversions_vec, func.__name__ + "_vec", None)
+    if func_vec is None:
+        return None
+    return lambda raw: func_vec(raw, *args)
+
+
+class BlockPipeline(object):
+    def __init__(self, mapping):
+        self.mapping = mapping
+        # Compiled the first time they are used, so the lookup tables are only
+        # built for blocks that are received (and after they are loaded from
+        # a file)
+        self.scalar = None
+        self.vec = None
+
+    def __str__(self):
+        return "Pipeline: fields = %d, lookup table fields = %d" % (len(self.mapping),
+            len([field for field in self.mapping
+                if field_conversion(field) is not None and field_conversion(field)[0] in LUT_CONVERSIONS]))
+
+    def converters(self):
+        if self.scalar is None:
+            self.scalar = [compile_field(field_conversion(field)) for field in self.mapping]
+        return self.scalar
+
+    def vec_converters(self):
+        if self.vec is None:
+            self.vec = [compile_field_vec(field_conversion(field)) for field in self.mapping]
+        return self.vec
+
+    # Converts the fields of one block
+    # Returns a list of the converted values (float, int, or str)
+    def convert(self, fields):
+        return [convert(raw) for (convert, raw) in zip(self.converters(), fields)]
+
+    # Converts the fields of many blocks (one row per block, like the fields
+    # from common.unpack_blocks())
+    # Returns a list with the converted values of each field (column)
+    # With numpy, each column is a numpy array, or a list for conversions to
+    # strings
+    # Without numpy, each column is a list
+    def convert_columns(self, fields):
+        if numpy is None:
+            columns = [[] for field in self.mapping]
+            for row in fields:
+                for (column, value) in zip(columns, self.convert(row)):
+                    column.append(value)
+            return columns
+
+        fields = numpy.asarray(fields, dtype=numpy.uint32).reshape(-1, len(self.mapping))
+        columns = []
+        for (i, (convert, convert_vec)) in enumerate(zip(self.converters(), self.vec_converters())):
+            if convert_vec is not None:
+                columns.append(convert_vec(fields[:, i]))
+            else:
+                columns.append([convert(raw) for raw in fields[:, i].tolist()])
+        return columns
+
+    # Same as convert_columns(), but returns a list with the converted values
+    # of each block (row), the same as calling convert() for each one
+    def convert_blocks(self, fields):
+        columns = [column if isinstance(column, list) else column.tolist()
+            for column in self.convert_columns(fields)]
+        return [list(row) for row in zip(*columns)]
+
+
+# Checks that convert_blocks() gives the same values as convert() for random
+# blocks of every data section, exits with 1 if any are different
+if __name__ == "__main__":
+    import random
+    import sys
+    import time
+
+    from sections import *
+
+    rand = random.Random(1)
+    failed = False
+    for section in g_all_read_data_sections:
+        num_fields = len(section.mapping)
+        # 12 bit values for most blocks, any 24 bit value for the rest
+        fields = [[rand.randrange(1 << 12 if i % 4 else 1 << 24) for j in range(num_fields)]
+            for i in range(2000)]
+
+        start = time.time()
+        expected = [section.pipeline.convert(row) for row in fields]
+        scalar_time = time.time() - start
+
+        start = time.time()
+        actual = section.pipeline.convert_blocks(fields)
+        batch_time = time.time() - start
+
+        ok = expected == actual and all(type(a) == type(b)
+            for (expected_row, actual_row) in zip(expected, actual)
+            for (a, b) in zip(expected_row, actual_row))
+        print("%-12s %s  convert() %.4fs  convert_blocks() %.4fs" % (section.name,
+            "OK  " if ok else "FAIL", scalar_time, batch_time))
+        failed = failed or not ok
+
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,151 @@
+# Converts every block in the raw block archives (archive.py) again with the
+# current conversions and writes new section files, e.g. after a constant in
+# conversions.py changes (this doesn't communicate with the satellite at all)
+# e.g.:
+#     $ python reconvert.py
+#     $ python reconvert.py -v bat_cur_sense_fix -j 4
+# Each section's blocks are split into shards of consecutive block numbers,
+# which are converted in parallel by a pool of processes
+# Every run writes a new version folder (out/reconvert/<version>) with a file
+# for each section and manifest.json, which only appears once everything is
+# written, so a version folder is never incomplete
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+
+from common import *
+from export import *
+from lut import *
+from sections import *
+
+
+# Default number of blocks in each shard
+RECONVERT_SHARD_BLOCKS = 4096
+
+
+# Returns the section in g_all_read_sections with the number
+def section_by_number(number):
+    for section in g_all_read_sections:
+        if section.number == number:
+            return section
+    return None
+
+# Returns a list of (block numbers, record numbers) for every shard of
+# shard_blocks blocks in the archive of section, in order of block number
+# The archive is only opened (and its index loaded) here, so the workers just
+# read their records
+def make_shards(section, shard_blocks):
+    section.archive.open(read_only=True)
+    try:
+        nums = section.archive.block_nums()
+        records = section.archive.records
+        return [(nums[i : i + shard_blocks], [records[num] for num in nums[i : i + shard_blocks]])
+            for i in range(0, len(nums), shard_blocks)]
+    finally:
+        section.archive.close()
+
+# Converts the blocks of one shard and writes their rows to part_path
+# Runs in a worker process, so it takes one tuple of
+# (section number, block numbers, record numbers, part_path)
+# Returns the number of blocks
+def reconvert_shard(shard):
+    (number, nums, indices, part_path) = shard
+    section = section_by_number(number)
+    try:
+        rows = record_rows(section, nums, section.archive.read_records(indices))
+    finally:
+        # Releases the map of the data file
+        section.archive.close()
+    with open(part_path, 'w') as f:
+        f.writelines(rows)
+    return len(rows)
+
+# Converts the archives of sections with a pool of processes and writes the
+# section files to version_path
+# Returns a dict of the number of blocks in each section file
+def reconvert(sections, version_path, processes=None, shard_blocks=RECONVERT_SHARD_BLOCKS):
+    tmp_path = version_path + ".tmp"
+    if os.path.exists(tmp_path):
+        # Left behind by a run that didn't finish
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    # (section, part paths) for every section
+    parts = []
+    shards = []
+    for section in sections:
+        section_parts = []
+        for (i, (nums, indices)) in enumerate(make_shards(section, shard_blocks)):
+            part_path = os.path.join(tmp_path, "%s.part%d" % (section.file_name, i))
+            section_parts.append(part_path)
+            shards.append((section.number, nums, indices, part_path))
+        parts.append((section, section_parts))
+
+    with multiprocessing.Pool(processes) as pool:
+        counts = pool.map(reconvert_shard, shards, chunksize=1)
+    counts = iter(counts)
+
+    num_blocks = {}
+    for (section, section_parts) in parts:
+        num_blocks[section.file_name] = 0
+        with open(os.path.join(tmp_path, section.file_name), 'w') as f:
+            f.write(section.header_row())
+            for part_path in section_parts:
+                with open(part_path, 'r') as part:
+                    shutil.copyfileobj(part, f)
+                os.remove(part_path)
+                num_blocks[section.file_name] += next(counts)
+
+    with open(os.path.join(tmp_path, "manifest.json"), 'w') as f:
+        json.dump({
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "conversions": conversions_fingerprint(),
+            "blocks": num_blocks,
+        }, f, indent=4)
+
+    # Only the finished folder is ever at version_path
+    os.rename(tmp_path, version_path)
+    return num_blocks
+
+
+if __name__ == "__main__":
+    check_python3()
+
+    parser = argparse.ArgumentParser(description=("Convert the raw block archives again with the current conversions"))
+    parser.add_argument('sections', nargs='*',
+            help='Names of the sections to convert (default: every section with an archive in %s)' % OUT_FOLDER)
+    parser.add_argument('-v', '--version', required=False, default=time.strftime("%Y%m%d_%H%M%S"),
+            metavar=('name'), help='Name of the version folder (default: the current date and time)')
+    parser.add_argument('-o', '--output', required=False, default=os.path.join(OUT_FOLDER, "reconvert"),
+            metavar=('folder'), help='Folder to write the version folder to')
+    parser.add_argument('-j', '--processes', required=False, default=None, type=int,
+            metavar=('processes'), help='Number of processes (default: the number of CPUs)')
+    parser.add_argument('-s', '--shard-blocks', required=False, default=RECONVERT_SHARD_BLOCKS, type=int,
+            metavar=('blocks'), help='Number of blocks converted by a process at a time')
+
+    args = parser.parse_args()
+
+    sections = [section for section in g_all_read_sections
+        if section.archive is not None and os.path.exists(section.archive.path)]
+    if len(args.sections) > 0:
+        names = [name.lower() for name in args.sections]
+        sections = [section for section in sections if section.name.lower() in names]
+    if len(sections) == 0:
+        print("No archives to convert")
+        sys.exit(1)
+
+    version_path = os.path.join(args.output, args.version)
+    if os.path.exists(version_path):
+        print("%s already exists" % version_path)
+        sys.exit(1)
+
+    start = time.time()
+    num_blocks = reconvert(sections, version_path, args.processes, args.shard_blocks)
+    for section in sections:
+        print("%s: %d blocks" % (section.file_name, num_blocks[section.file_name]))
+    print("Wrote %s in %.3fs" % (version_path, time.time() - start))
@@ -0,0 +1,162 @@
+# Replays a serial capture (capture.py) through the same code that handles
+# received bytes in the simulator (Deframer, RXPacket, process_rx_packet() and
+# the section files), without OBC or a radio
+# The commands are decoded from the sent bytes in the capture, so every
+# response is matched to its command the same way as in the original session
+# e.g.:
+#     $ python replay.py                              (as fast as possible)
+#     $ python replay.py -s 1 out/serial.cap          (original timing)
+#     $ python replay.py -s 10 -v out/serial.cap      (10x faster, print every packet)
+# The section files are written to <output>/out (default: out/replay/out), so
+# the original ones aren't changed
+# The replay time and throughput are printed at the end, so it can also be used
+# as a benchmark of the receive path
+
+import argparse
+import contextlib
+import os
+import sys
+import time
+
+from capture import *
+from command_utilities import *
+from common import *
+from obc_emulator import *
+from packets import *
+from sections import *
+
+
+class Replay(object):
+    # speed - how many times faster than the original session to replay
+    #     (0 for as fast as possible)
+    def __init__(self, speed=0.0):
+        self.speed = speed
+        # Finds the commands in the sent bytes
+        self.tx_deframer = Deframer(CommandPacket)
+        # Monotonic time (ns) of the start of the current session in the
+        # capture, and the time.time() it was replayed at
+        self.session_start = None
+        self.replay_start = None
+        # RX deframer of every session, since each session has a new one
+        self.rx_deframers = []
+
+        self.num_sessions = 0
+        self.num_records = 0
+        self.num_bytes = 0
+        self.num_tx_packets = 0
+        self.num_rx_packets = 0
+
+    def __str__(self):
+        return "Replay: sessions = %d, records = %d, bytes = %d, TX packets = %d, RX packets = %d" \
+            % (self.num_sessions, self.num_records, self.num_bytes, self.num_tx_packets, self.num_rx_packets)
+
+    # Returns the counters of the RX deframers added up over every session
+    def rx_deframer_str(self):
+        def total(name):
+            return sum(getattr(deframer, name) for deframer in self.rx_deframers)
+        return "RX deframers: packets = %d, framing errors = %d, checksum errors = %d, discarded bytes = %d, buffered bytes = %d" \
+            % (total("num_packets"), total("framing_errors"), total("csum_errors"),
+            total("discarded_bytes"), sum(len(deframer.buf) for deframer in self.rx_deframers))
+
+    # Every time the simulator starts it resets OBC's command ID, so commands
+    # from the previous session are forgotten
+    def start_session(self, timestamp):
+        Global.cmd_id = 1
+        Global.sent_packets = SentPacketTable()
+        Global.deframer = Deframer()
+        self.rx_deframers.append(Global.deframer)
+        Global.pending = PendingPackets()
+        self.tx_deframer = Deframer(CommandPacket)
+
+        self.session_start = timestamp
+        self.replay_start = time.time()
+        self.num_sessions += 1
+
+    # Waits until the time of a record at the replay speed
+    def wait_until(self, timestamp):
+        if self.speed <= 0:
+            return
+        delay = self.replay_start + (timestamp - self.session_start) / 1e9 / self.speed - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    # Returns the full command ID for a 15 bit command ID that was sent, the
+    # same as the simulator's Global.cmd_id when it was sent (a command that
+    # was sent again gets the same one)
+    def full_cmd_id(self, cmd_id):
+        latest = Global.sent_packets.latest_cmd_id
+        return latest + ((cmd_id - latest) & CMD_ID_MASK)
+
+    def replay_record(self, timestamp, direction, data):
+        self.num_records += 1
+        if direction == CAPTURE_SESSION or self.session_start is None:
+            self.start_session(timestamp)
+        if direction == CAPTURE_SESSION:
+            return
+
+        self.wait_until(timestamp)
+        self.num_bytes += len(data)
+
+        if direction == CAPTURE_TX:
+            for cmd in self.tx_deframer.feed(data):
+                if not cmd.valid:
+                    continue
+                Global.sent_packets.add(TXPacket(self.full_cmd_id(cmd.cmd_id), cmd.opcode,
+                    cmd.arg1, cmd.arg2, cmd.password))
+                self.num_tx_packets += 1
+
+        elif direction == CAPTURE_RX:
+            for rx_packet in Global.deframer.feed(data):
+                process_rx_packet(rx_packet)
+                self.num_rx_packets += 1
+
+    # Replays (timestamp, direction, data) records, e.g. from read_capture()
+    def run(self, records):
+        for (timestamp, direction, data) in records:
+            self.replay_record(timestamp, direction, data)
+
+
+if __name__ == "__main__":
+    check_python3()
+
+    parser = argparse.ArgumentParser(description=("Replay a serial capture through the packet decoding and section files"))
+    parser.add_argument('file', nargs='?', default=os.path.join(OUT_FOLDER, "serial.cap"),
+            help='Capture file (default: %s)' % os.path.join(OUT_FOLDER, "serial.cap"))
+    parser.add_argument('-s', '--speed', required=False, default=0,
+            metavar=('speed'), help='How many times faster than the original session to replay (1 for the original timing, 0 for as fast as possible)')
+    parser.add_argument('-o', '--output', required=False, default=os.path.join(OUT_FOLDER, "replay"),
+            metavar=('folder'), help='Folder to write the section files to (in %s in it)' % OUT_FOLDER)
+    parser.add_argument('-v', '--verbose', required=False, action='store_true',
+            help='Print every packet and block, like the simulator')
+
+    args = parser.parse_args()
+
+    capture_path = os.path.abspath(args.file)
+    if not os.path.exists(capture_path):
+        print("Did not find capture file %s" % capture_path)
+        sys.exit(1)
+
+    # Section files are written to OUT_FOLDER in the current folder
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    os.chdir(args.output)
+
+    replay = Replay(float(args.speed))
+    with contextlib.ExitStack() as stack:
+        if not args.verbose:
+            # Hide the simulator's output for every packet
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, 'w'))))
+        for section in g_all_sections:
+            section.load_file()
+
+        start_time = time.time()
+        replay.run(read_capture(capture_path))
+        close_all_sections()
+        elapsed = time.time() - start_time
+
+    print(replay)
+    print(replay.rx_deframer_str())
+    for section in g_all_read_sections:
+        print("%s: %d blocks" % (os.path.join(args.output, OUT_FOLDER, section.file_name), len(section.blocks)))
+    print("Replayed in %.3fs (%.0f RX packets/s, %.3f MB/s)" % (elapsed,
+        replay.num_rx_packets / max(elapsed, 1e-9), replay.num_bytes / max(elapsed, 1e-9) / 1e6))
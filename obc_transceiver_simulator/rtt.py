@@ -0,0 +1,103 @@
+"""
+Round trip time estimation for commands, used to pick how long to wait for the
+ACK and response of each command instead of a fixed wait time.
+This follows the TCP retransmission timer (RFC 6298), with separate estimates
+for each opcode since e.g. flash reads and CAN commands take much longer than
+PING_OBC.
+"""
+
+from common import *
+
+
+# Gains for the smoothed RTT and RTT variation
+RTT_ALPHA = 1.0 / 8.0
+RTT_BETA = 1.0 / 4.0
+# Number of RTT variations to add to the smoothed RTT
+RTT_K = 4
+# Smallest RTT variation used (in s), so a very steady link doesn't give a
+# timeout too close to the smoothed RTT
+RTT_GRANULARITY = 0.1
+
+# OBC clears its UART RX buffer 2 seconds after the last byte it received, so
+# sending a command again before then could get appended to a partial one
+OBC_RX_BUF_CLEAR_TIME = 2.0
+# Never wait for the response for less than this (in s)
+RESP_TIMEOUT_MIN = 0.5
+# Never wait for longer than this (in s), even after backing off
+TIMEOUT_MAX = 60.0
+
+
+# Smoothed RTT and RTT variation for one type of round trip
+class RTTEstimator(object):
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.num_samples = 0
+
+    def __str__(self):
+        if self.srtt is None:
+            return "no samples"
+        return "srtt = %.3fs, rttvar = %.3fs, %d samples" % (self.srtt, self.rttvar, self.num_samples)
+
+    # rtt is in seconds
+    def add_sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2.0
+        else:
+            self.rttvar = (1.0 - RTT_BETA) * self.rttvar + RTT_BETA * abs(self.srtt - rtt)
+            self.srtt = (1.0 - RTT_ALPHA) * self.srtt + RTT_ALPHA * rtt
+        self.num_samples += 1
+
+    # Returns the timeout (in s), or default if there are no samples yet
+    def timeout(self, default):
+        if self.srtt is None:
+            return default
+        return self.srtt + max(RTT_GRANULARITY, RTT_K * self.rttvar)
+
+
+# RTT estimates for every opcode, separately for the time from sending a
+# command to its ACK and from the ACK to its response
+class RTTTable(object):
+    def __init__(self):
+        # Maps opcode to RTTEstimator
+        self.ack_rtts = {}
+        self.resp_rtts = {}
+
+    def __str__(self):
+        lines = ["RTT estimates:"]
+        for opcode in sorted(set(self.ack_rtts.keys()) | set(self.resp_rtts.keys())):
+            lines.append("Opcode 0x%.2x: ACK %s; response %s" % (opcode,
+                self.ack_rtts.get(opcode, RTTEstimator()),
+                self.resp_rtts.get(opcode, RTTEstimator())))
+        return "\n".join(lines)
+
+    # Only sample the ACK time for the first attempt of a command, since an ACK
+    # after sending it again could be for either attempt (Karn's algorithm)
+    def add_ack_sample(self, opcode, rtt):
+        self.ack_rtts.setdefault(opcode, RTTEstimator()).add_sample(rtt)
+
+    def add_resp_sample(self, opcode, rtt):
+        self.resp_rtts.setdefault(opcode, RTTEstimator()).add_sample(rtt)
+
+    # Time to wait for an ACK before sending the command again (in s)
+    # default is used until there are samples for the opcode
+    # attempt is the number of times the command has already been sent again,
+    # the timeout doubles for each one
+    def ack_timeout(self, opcode, default, attempt=0):
+        if not Global.adaptive_timeouts:
+            return default
+
+        timeout = self.ack_rtts.get(opcode, RTTEstimator()).timeout(default)
+        timeout = max(timeout, OBC_RX_BUF_CLEAR_TIME) * (2 ** attempt)
+        return min(timeout, max(TIMEOUT_MAX, default))
+
+    # Time to wait for the response after the ACK (in s)
+    def resp_timeout(self, opcode, default):
+        if not Global.adaptive_timeouts:
+            return default
+
+        timeout = self.resp_rtts.get(opcode, RTTEstimator()).timeout(default)
+        return min(max(timeout, RESP_TIMEOUT_MIN), max(TIMEOUT_MAX, default))
+
+Global.rtt = RTTTable()
@@ -1,6 +1,14 @@
+import atexit
+import hashlib
 import os
+import threading
+import time
 
+from archive import *
+from blockset import *
 from common import *
+from conversions import *
+from pipeline import *
 
 OUT_FOLDER = "out"
 
@@ -12,80 +20,92 @@ COMMON_HEADER = [
     "Status",
 ]
 
-# Name, unit, mapping for reordering measurements
+# Conversion specs shared by several fields (see pipeline.py)
+RESTART_REASON      = (restart_reason_to_str,)
+DATE_TIME           = (uint24_to_date_time_str,)
+THERM_TEMP          = (adc_raw_to_therm_temp,)
+HEATER_SETPOINT     = (dac_raw_data_to_heater_setpoint,)
+EPS_CIRC_VOL        = (adc_raw_to_circ_vol, EPS_ADC_VOL_SENSE_LOW_RES, EPS_ADC_VOL_SENSE_HIGH_RES)
+EPS_BAT_CUR         = (adc_raw_to_circ_cur, EPS_ADC_BAT_CUR_SENSE_RES, EPS_ADC_BAT_CUR_SENSE_VREF)
+EPS_DEF_CUR         = (adc_raw_to_circ_cur, EPS_ADC_DEF_CUR_SENSE_RES, EPS_ADC_DEF_CUR_SENSE_VREF)
+EPS_EFUSE_CUR       = (adc_raw_to_efuse_cur, EFUSE_IMON_SENSE_RES)
+GYRO                = (imu_raw_data_to_gyro,)
+
+# Name, unit, mapping for reordering measurements, conversion spec (None to
+# keep the raw number)
 OBC_HK_MAPPING = [
-    ("Uptime",                  "s",        0x00    ),
-    ("Restart count",           "",         0x01    ),
-    ("Restart reason",          "",         0x02    ),
-    ("Restart date",            "",         0x03    ),
-    ("Restart time",            "",         0x04    ),
+    ("Uptime",                  "s",        0x00,    None),
+    ("Restart count",           "",         0x01,    None),
+    ("Restart reason",          "",         0x02,    RESTART_REASON),
+    ("Restart date",            "",         0x03,    DATE_TIME),
+    ("Restart time",            "",         0x04,    DATE_TIME),
 ]
 
 EPS_HK_MAPPING = [
-    ("Uptime",                  "s",        0x00    ),
-    ("Restart count",           "",         0x01    ),
-    ("Restart reason",          "",         0x02    ),
-    ("Bat Vol",                 "V",        0x03    ),
-    ("Bat Cur",                 "A",        0x04    ),
-    ("X+ Cur",                  "A",        0x05    ),
-    ("X- Cur",                  "A",        0x06    ),
-    ("Y+ Cur",                  "A",        0x07    ),
-    ("Y- Cur",                  "A",        0x08    ),
-    ("3V3 Vol",                 "V",        0x09    ),
-    ("3V3 Cur",                 "A",        0x0A    ),
-    ("5V Vol",                  "V",        0x0B    ),
-    ("5V Cur",                  "A",        0x0C    ),
-    ("PAY Cur",                 "A",        0x0D    ),
-    ("3V3 Temp",                "C",        0x0E    ),
-    ("5V Temp",                 "C",        0x0F    ),
-    ("PAY Conn Temp",           "C",        0x10    ),
-    ("Bat Temp 1",              "C",        0x11    ),
-    ("Bat Temp 2",              "C",        0x12    ),
-    ("Heater Setpoint 1",       "C",        0x13    ),
-    ("Heater Setpoint 2",       "C",        0x14    ),
-    ("Gyroscope (Uncal) X",     "rad/s",    0x15    ),
-    ("Gyroscope (Uncal) Y",     "rad/s",    0x16    ),
-    ("Gyroscope (Uncal) Z",     "rad/s",    0x17    ),
-    ("Gyroscope (Cal) X",       "rad/s",    0x18    ),
-    ("Gyroscope (Cal) Y",       "rad/s",    0x19    ),
-    ("Gyroscope (Cal) Z",       "rad/s",    0x1A    ),
+    ("Uptime",                  "s",        0x00,    None),
+    ("Restart count",           "",         0x01,    None),
+    ("Restart reason",          "",         0x02,    RESTART_REASON),
+    ("Bat Vol",                 "V",        0x03,    EPS_CIRC_VOL),
+    ("Bat Cur",                 "A",        0x04,    EPS_BAT_CUR),
+    ("X+ Cur",                  "A",        0x05,    EPS_DEF_CUR),
+    ("X- Cur",                  "A",        0x06,    EPS_DEF_CUR),
+    ("Y+ Cur",                  "A",        0x07,    EPS_DEF_CUR),
+    ("Y- Cur",                  "A",        0x08,    EPS_DEF_CUR),
+    ("3V3 Vol",                 "V",        0x09,    EPS_CIRC_VOL),
+    ("3V3 Cur",                 "A",        0x0A,    EPS_DEF_CUR),
+    ("5V Vol",                  "V",        0x0B,    EPS_CIRC_VOL),
+    ("5V Cur",                  "A",        0x0C,    EPS_DEF_CUR),
+    ("PAY Cur",                 "A",        0x0D,    EPS_EFUSE_CUR),
+    ("3V3 Temp",                "C",        0x0E,    THERM_TEMP),
+    ("5V Temp",                 "C",        0x0F,    THERM_TEMP),
+    ("PAY Conn Temp",           "C",        0x10,    THERM_TEMP),
+    ("Bat Temp 1",              "C",        0x11,    THERM_TEMP),
+    ("Bat Temp 2",              "C",        0x12,    THERM_TEMP),
+    ("Heater Setpoint 1",       "C",        0x13,    HEATER_SETPOINT),
+    ("Heater Setpoint 2",       "C",        0x14,    HEATER_SETPOINT),
+    ("Gyroscope (Uncal) X",     "rad/s",    0x15,    GYRO),
+    ("Gyroscope (Uncal) Y",     "rad/s",    0x16,    GYRO),
+    ("Gyroscope (Uncal) Z",     "rad/s",    0x17,    GYRO),
+    ("Gyroscope (Cal) X",       "rad/s",    0x18,    GYRO),
+    ("Gyroscope (Cal) Y",       "rad/s",    0x19,    GYRO),
+    ("Gyroscope (Cal) Z",       "rad/s",    0x1A,    GYRO),
 ]
 
 PAY_HK_MAPPING = [
-    ("Uptime",                  "s",    0x00    ),
-    ("Restart count",           "",     0x01    ),
-    ("Restart reason",          "",     0x02    ),
-    ("Humidity",                "%RH",  0x03    ),
-    ("Pressure",                "kPa",  0x04    ),
-    ("Ambient Temp",            "C",    0x05    ),
-    ("6V Temp",                 "C",    0x06    ),
-    ("10V Temp",                "C",    0x07    ),
-    ("Motor Driver 1 Temp",     "C",    0x08    ),
-    ("Motor Driver 2 Temp",     "C",    0x09    ),
-    ("MF Temp 1",               "C",    0x0A    ),
-    ("MF Temp 2",               "C",    0x0B    ),
-    ("MF Temp 3",               "C",    0x0C    ),
-    ("MF Temp 4",               "C",    0x0D    ),
-    ("MF Temp 5",               "C",    0x0E    ),
-    ("MF Temp 6",               "C",    0x0F    ),
-    ("MF Temp 7",               "C",    0x10    ),
-    ("MF Temp 8",               "C",    0x11    ),
-    ("MF Temp 9",               "C",    0x12    ),
-    ("MF Temp 10",              "C",    0x13    ),
-    ("MF Temp 11",              "C",    0x14    ),
-    ("MF Temp 12",              "C",    0x15    ),
-    ("Heater Setpoint",         "C",    0x16    ),
-    ("Def Invalid Therm Temp",  "C",    0x17    ),
-    ("Thermistor Enables",      "",     0x18    ),
-    ("Heater Enables",          "",     0x19    ),
-    ("Batt Vol",                "V",    0x1A    ),
-    ("6V Vol",                  "V",    0x1B    ),
-    ("6V Cur",                  "A",    0x1C    ),
-    ("10V Vol",                 "V",    0x1D    ),
-    ("10V Cur",                 "A",    0x1E    ),
+    ("Uptime",                  "s",    0x00,    None),
+    ("Restart count",           "",     0x01,    None),
+    ("Restart reason",          "",     0x02,    RESTART_REASON),
+    ("Humidity",                "%RH",  0x03,    (hum_raw_data_to_humidity,)),
+    ("Pressure",                "kPa",  0x04,    (pres_raw_data_to_pressure,)),
+    ("Ambient Temp",            "C",    0x05,    THERM_TEMP),
+    ("6V Temp",                 "C",    0x06,    THERM_TEMP),
+    ("10V Temp",                "C",    0x07,    THERM_TEMP),
+    ("Motor Driver 1 Temp",     "C",    0x08,    THERM_TEMP),
+    ("Motor Driver 2 Temp",     "C",    0x09,    THERM_TEMP),
+    ("MF Temp 1",               "C",    0x0A,    THERM_TEMP),
+    ("MF Temp 2",               "C",    0x0B,    THERM_TEMP),
+    ("MF Temp 3",               "C",    0x0C,    THERM_TEMP),
+    ("MF Temp 4",               "C",    0x0D,    THERM_TEMP),
+    ("MF Temp 5",               "C",    0x0E,    THERM_TEMP),
+    ("MF Temp 6",               "C",    0x0F,    THERM_TEMP),
+    ("MF Temp 7",               "C",    0x10,    THERM_TEMP),
+    ("MF Temp 8",               "C",    0x11,    THERM_TEMP),
+    ("MF Temp 9",               "C",    0x12,    THERM_TEMP),
+    ("MF Temp 10",              "C",    0x13,    THERM_TEMP),
+    ("MF Temp 11",              "C",    0x14,    THERM_TEMP),
+    ("MF Temp 12",              "C",    0x15,    THERM_TEMP),
+    ("Heater Setpoint",         "C",    0x16,    HEATER_SETPOINT),
+    ("Def Invalid Therm Temp",  "C",    0x17,    THERM_TEMP),
+    ("Thermistor Enables",      "",     0x18,    (enable_states_to_str, 12)),
+    ("Heater Enables",          "",     0x19,    (enable_states_to_str, 5)),
+    ("Batt Vol",                "V",    0x1A,    (adc_raw_to_circ_vol, PAY_ADC1_BATT_LOW_RES, PAY_ADC1_BATT_HIGH_RES)),
+    ("6V Vol",                  "V",    0x1B,    (adc_raw_to_circ_vol, PAY_ADC1_BOOST6_LOW_RES, PAY_ADC1_BOOST6_HIGH_RES)),
+    ("6V Cur",                  "A",    0x1C,    (adc_raw_to_circ_cur, PAY_ADC1_BOOST6_SENSE_RES, PAY_ADC1_BOOST6_REF_VOL)),
+    ("10V Vol",                 "V",    0x1D,    (adc_raw_to_circ_vol, PAY_ADC1_BOOST10_LOW_RES, PAY_ADC1_BOOST10_HIGH_RES)),
+    ("10V Cur",                 "A",    0x1E,    (adc_raw_to_circ_cur, PAY_ADC1_BOOST10_SENSE_RES, PAY_ADC1_BOOST10_REF_VOL)),
 ]
 
-PAY_OPT_MAPPING = [("Well %d" % i, "counts/ms", i) for i in range(0, 32)]
+PAY_OPT_MAPPING = [("Well %d" % i, "counts/ms", i, (opt_raw_to_light_intensity,)) for i in range(0, 32)]
 
 # The command log mappings have a different format
 # Same for primary and secondary
@@ -96,25 +116,155 @@ CMD_LOG_MAPPING = [
 ]
 
 
+# Number of bytes read at a time when reading a file backwards
+READ_BACK_SIZE = 4096
+
+# Yields the lines of a binary file from the last one to the first (without
+# newlines), reading READ_BACK_SIZE bytes at a time from the end
+def read_lines_backwards(f):
+    pos = f.seek(0, 2)
+    rest = b""
+    while pos > 0:
+        size = min(READ_BACK_SIZE, pos)
+        pos -= size
+        f.seek(pos)
+        lines = (f.read(size) + rest).split(b"\n")
+        # The first line may start before pos
+        rest = lines[0]
+        for line in reversed(lines[1:]):
+            yield line
+    yield rest
+
+# Returns the block number at the start of the last row of a section file, or
+# None if it doesn't have any rows
+# Only the end of the file is read, so this takes the same time for any size
+# of file
+# Rows are either a whole block or just a block number (from
+# Section.set_file_block_num()). Lines that don't start with a number (the
+# header, or a corrupted row) are skipped. If the last line doesn't end with a
+# newline (it was only partly written), it is removed from the file so new rows
+# start on their own line.
+def read_last_block_num(file_path):
+    with open(file_path, 'rb+') as f:
+        end = f.seek(0, 2)
+        if end > 0:
+            f.seek(end - 1)
+            if f.read(1) != b"\n":
+                partial_line = next(read_lines_backwards(f))
+                print("Removing incomplete last line from %s" % file_path)
+                f.truncate(end - len(partial_line))
+
+        for line in read_lines_backwards(f):
+            try:
+                return int(line.split(b",")[0].strip())
+            except ValueError:
+                continue
+    return None
+
+
+# What to do with a block that is already in a section file (e.g. the last
+# block re-read by read_missing_blocks(), or a block received twice because of a
+# retry) but has different data
+# A block with the same data is never written again
+# latest - write the new row too, readers use the last row for each block
+# first - don't write the new row
+# flag - don't write the new row, write it to a separate conflicts file
+DUPLICATE_POLICIES = ["latest", "first", "flag"]
+
+# Returns a digest of everything in a row except the expected block number (as
+# bytes, without the newline), which is the same for rows with the same data
+def row_digest(row):
+    return hashlib.blake2b(row.split(b",", 1)[1].strip(), digest_size=16).digest()
+
+
+# Number of bytes in a data block with the fields in mapping
+def data_block_len(mapping):
+    return BLOCK_HEADER_LEN + BLOCK_FIELD_LEN * len(mapping)
+
+
 # Represents one section in flash memory
 # Mostly used to track and update the data output files
+# Every block received is also saved in its raw form in a BlockArchive
+# (archive.py) of blocks of record_len bytes, which the CSV file can be made
+# again from (None for a section without its own blocks)
+# Rows are written to the file in groups (group commit) instead of one at a
+# time: they are buffered until Global.flush_rows rows are waiting or
+# Global.flush_ms ms have passed since the first one, and only go to disk
+# (fsync) at a checkpoint() or close(). Before each group is written, the
+# length of the file is saved in a marker file next to it (<file>.wal), and
+# cleared once the whole group is written. If the simulator stops in the middle
+# of writing a group, the marker is still set and load_file() cuts the file
+# back to the last complete group (read_missing_blocks() reads those blocks
+# again).
 class Section(object):
-    def __init__(self, number, name, mapping):
+    def __init__(self, number, name, mapping, record_len=None):
         self.number = number
         self.name = name
         self.file_name = "%d_%s.csv" % (self.number, self.name.lower())
         self.mapping = mapping
+        self.archive = None
+        if record_len is not None:
+            self.archive = BlockArchive(OUT_FOLDER + "/" + "%d_%s.blk" % (self.number, self.name.lower()), record_len)
+        self.pipeline = BlockPipeline(mapping)
         self.data_file = None
         self.file_block_num = 0
         self.sat_block_num = 0
+        # Blocks in the file (BlockSet from blockset.py)
+        self.blocks = BlockSet()
+        # Maps block numbers to the row_digest() of their last row in the
+        # file, for blocks written or looked up since the file was loaded
+        self.digests = {}
+
+        self.marker_file = None
+        # Rows (strings ending in a newline) waiting to be written
+        self.pending_rows = []
+        # time.time() of the first pending row
+        self.pending_time = None
+        # Rows are also flushed by the flush thread
+        self.lock = threading.RLock()
     
     def __str__(self):
         return "%s: file_name = %s, file_block_num = %d, sat_block_num = %d" \
             % (self.name, self.file_name, self.file_block_num, self.sat_block_num)
 
+    def marker_path(self):
+        return OUT_FOLDER + "/" + self.file_name + ".wal"
+
+    def block_set_path(self):
+        return OUT_FOLDER + "/" + self.file_name + ".blocks"
+
+    # Offset is the length of the data file before the group of rows being
+    # written, or -1 if no group is being written
+    # Fixed width, so it is always overwritten completely
+    def write_marker(self, offset):
+        self.marker_file.seek(0)
+        self.marker_file.write("%20d\n" % offset)
+        self.marker_file.flush()
+
+    # Cuts the data file back to the length in the marker, if a group of rows
+    # was not completely written
+    def recover(self, file_path):
+        marker_path = self.marker_path()
+        if not os.path.exists(marker_path):
+            return
+
+        with open(marker_path, 'r') as f:
+            try:
+                offset = int(f.read().strip() or -1)
+            except ValueError:
+                # The marker itself was not completely written, so the group
+                # wasn't started
+                offset = -1
+
+        if offset >= 0 and os.path.exists(file_path) and os.path.getsize(file_path) > offset:
+            print("Removing %d bytes of incomplete rows from %s" % (os.path.getsize(file_path) - offset, file_path))
+            with open(file_path, 'r+') as f:
+                f.truncate(offset)
+
     # Create or append to file
     # Adapted from https://stackoverflow.com/questions/20432912/writing-to-a-new-file-if-it-doesnt-exist-and-appending-to-a-file-if-it-does
     def load_file(self):
+        self.close()
         if os.path.isdir(OUT_FOLDER):
             print("Found existing folder", OUT_FOLDER)
         else:
@@ -122,38 +272,101 @@ class Section(object):
             print("Created new folder", OUT_FOLDER)
 
         file_path = OUT_FOLDER + "/" + self.file_name
+        self.recover(file_path)
+        self.marker_file = open(self.marker_path(), 'w')
+        self.write_marker(-1)
+        self.pending_rows = []
+        if self.archive is not None:
+            self.archive.open()
 
+        # Read last block number stored in file (only the end of the file is
+        # read, so this doesn't take longer as the file grows)
+        block_num = None
         if os.path.exists(file_path):
+            block_num = read_last_block_num(file_path)
+        self.blocks = load_block_set(self.block_set_path(), file_path)
+        self.digests = {}
+
+        # The file could be empty if only part of the header was written
+        if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
             print("Found existing file %s, appending to file" % file_path)
 
+            if block_num is not None:
+                self.file_block_num = block_num + 1
+
             # https://stackoverflow.com/questions/2757887/file-mode-for-creatingreadingappendingbinary
             self.data_file = open(file_path, 'a+')
 
-            # Read last block number stored in file
-            # Change pointer to beginning of file
-            self.data_file.seek(0, 0)
-            all_lines = self.data_file.readlines()
-            #print("all_lines =", all_lines)
-            if len(all_lines) > 1:
-                last_line = all_lines[-1]
-                if len(last_line) > 0:
-                    self.file_block_num = int(last_line.split(",")[0].strip()) + 1
-            # Change pointer back to end of file
-            self.data_file.seek(0, 2)
-
         else:
             print("Did not find existing file %s, creating new file" % file_path)
 
             print("Writing header")
             self.data_file = open(file_path, 'a+')
             # Write header
-            values = []
-            values.extend(COMMON_HEADER)
-            values.extend(map(lambda x : x[0] + (" (" + x[1] + ")" if len(x[1]) > 0 else ""), self.mapping))
-            self.data_file.write(", ".join(values) + "\n")
-            self.data_file.flush()
+            self.add_row(self.header_row())
+            self.checkpoint()
         
         print(self)
+
+    # Adds a row to write to the file
+    def add_row(self, row):
+        with self.lock:
+            self.pending_rows.append(row)
+            if len(self.pending_rows) == 1:
+                self.pending_time = time.time()
+                # With flush_ms = 0, rows are written right away below
+                if Global.flush_ms > 0:
+                    start_flush_thread()
+                    with g_flush_cond:
+                        g_flush_cond.notify()
+            if len(self.pending_rows) >= Global.flush_rows:
+                self.flush()
+            else:
+                self.flush_if_due()
+
+    # Flushes the pending rows if the first one has waited Global.flush_ms
+    def flush_if_due(self):
+        with self.lock:
+            if self.pending_time is not None and time.time() - self.pending_time >= Global.flush_ms / 1000.0:
+                self.flush()
+
+    # Writes the pending rows to the file (without waiting for the disk)
+    def flush(self):
+        with self.lock:
+            if self.archive is not None:
+                self.archive.flush()
+            if len(self.pending_rows) == 0 or self.data_file is None:
+                return
+
+            self.write_marker(os.fstat(self.data_file.fileno()).st_size)
+            self.data_file.write("".join(self.pending_rows))
+            self.data_file.flush()
+            self.write_marker(-1)
+            self.pending_rows = []
+            self.pending_time = None
+
+    # Writes the pending rows and waits for the file to be on disk
+    def checkpoint(self):
+        with self.lock:
+            self.flush()
+            if self.archive is not None:
+                self.archive.sync()
+            if self.data_file is not None:
+                os.fsync(self.data_file.fileno())
+                os.fsync(self.marker_file.fileno())
+                save_block_set(self.blocks, self.block_set_path(), os.fstat(self.data_file.fileno()).st_size)
+
+    def close(self):
+        with self.lock:
+            if self.data_file is None:
+                return
+            self.checkpoint()
+            if self.archive is not None:
+                self.archive.close()
+            self.data_file.close()
+            self.marker_file.close()
+            self.data_file = None
+            self.marker_file = None
     
     def print_fields(self, fields, converted):
         print(self.name)
@@ -166,8 +379,44 @@ class Section(object):
                 out_str += " " + self.mapping[i][1]
             print(out_str)
     
-    def write_block_to_file(self, expected_block_num, header, fields, converted):
-        # Write row
+    # Returns the row_digest() of the last row for block_num in the file, or
+    # None if it isn't in the file
+    def block_digest(self, block_num):
+        if block_num not in self.digests and block_num in self.blocks:
+            # Written before the file was loaded, it is usually one of the last
+            # rows (e.g. the one re-read by read_missing_blocks())
+            with open(OUT_FOLDER + "/" + self.file_name, 'rb') as f:
+                for line in read_lines_backwards(f):
+                    if row_block_num(line) == block_num:
+                        self.digests[block_num] = row_digest(line)
+                        break
+        return self.digests.get(block_num)
+
+    # Saves the raw data of a block (header and data) in the archive, unless
+    # it is already there (see DUPLICATE_POLICIES and Global.duplicates)
+    # Returns True if it was saved
+    def archive_block(self, expected_block_num, data):
+        if self.archive is None:
+            return False
+        if len(data) != self.archive.record_len:
+            print("Block %d has %d bytes instead of %d, not saving it in %s" % (expected_block_num,
+                len(data), self.archive.record_len, os.path.basename(self.archive.path)))
+            return False
+        with self.lock:
+            return self.archive.append(expected_block_num, bytes(data), Global.duplicates)
+
+    def conflicts_file_name(self):
+        return "%d_%s_conflicts.csv" % (self.number, self.name.lower())
+
+    # Returns the first row of the file
+    def header_row(self):
+        values = []
+        values.extend(COMMON_HEADER)
+        values.extend(map(lambda x : x[0] + (" (" + x[1] + ")" if len(x[1]) > 0 else ""), self.mapping))
+        return ", ".join(values) + "\n"
+
+    # Returns the row of the file for a block
+    def block_row(self, expected_block_num, header, fields, converted):
         values = []
         # Add header
         values.extend(map(str, [expected_block_num, bytes_to_uint24(header[0:3]),  date_time_to_str(header[3:6]), date_time_to_str(header[6:9]), "0x%.2x (%s)" % (header[9], packet_resp_status_to_str(header[9]))]))
@@ -177,33 +426,76 @@ class Section(object):
         for i in range(len(fields)):
             values.append("0x%.6x (%s)" % (fields[i], conv_value_to_str(converted[i])))
 
-        self.data_file.write(", ".join(values) + "\n")
-        self.data_file.flush()
-        print("Added block row to file", self.file_name)
+        return ", ".join(values) + "\n"
+
+    # Writes a block to the file, unless it is already in the file (see
+    # DUPLICATE_POLICIES and Global.duplicates)
+    # With upsert=False, it is always written (e.g. for PAY_OPT, which has a
+    # copy of every PAY_OPT_OD and PAY_OPT_FL row that was written)
+    # Returns True if the block was written
+    def write_block_to_file(self, expected_block_num, header, fields, converted, upsert=True):
+        # Write row
+        row = self.block_row(expected_block_num, header, fields, converted)
+
+        if upsert:
+            digest = row_digest(row.encode())
+            old_digest = self.block_digest(expected_block_num)
+            if old_digest == digest:
+                print("Block %d is already in file %s" % (expected_block_num, self.file_name))
+                self.file_block_num = expected_block_num + 1
+                return False
+
+            if old_digest is not None and Global.duplicates != "latest":
+                print("Block %d is already in file %s with different data" % (expected_block_num, self.file_name))
+                if Global.duplicates == "flag":
+                    with open(OUT_FOLDER + "/" + self.conflicts_file_name(), 'a') as f:
+                        f.write(row)
+                    print("Added block %d row to file %s" % (expected_block_num, self.conflicts_file_name()))
+                self.file_block_num = expected_block_num + 1
+                return False
+
+            self.digests[expected_block_num] = digest
+
+        self.add_row(row)
+        self.blocks.add(expected_block_num)
+        print("Added block %d row to file %s" % (expected_block_num, self.file_name))
 
         # Update file_block_num
         self.file_block_num = expected_block_num + 1
-        print(self)
+        return True
+    
+    # Returns the list of [start, end) ranges of blocks to read to have every
+    # block up to (not including) sat_block_num: every block from the first one
+    # in the file that isn't in the file, and the last block in the file again
+    # if reread_last is True (in case it was incomplete)
+    def download_plan(self, sat_block_num, reread_last=True):
+        start = self.blocks.first()
+        if start is None:
+            start = max(self.file_block_num - 1, 0)
+        plan = BlockSet(self.blocks.missing(start, sat_block_num))
+        if reread_last and 0 < self.file_block_num <= sat_block_num:
+            plan.add(self.file_block_num - 1)
+        return plan.ranges
     
     # Just writes a single number to keep track of manually changing the expected block number in the file
     def set_file_block_num(self, block_num):
         self.file_block_num = block_num
-        self.data_file.write("%d\n" % (self.file_block_num - 1))
-        self.data_file.flush()
+        self.add_row("%d\n" % (self.file_block_num - 1))
+        self.checkpoint()
         print("Wrote block number to file:", self.file_block_num - 1)
         print(self)
 
 
 # Data sections
-obc_hk_section          = Section(BlockType.OBC_HK,         "OBC_HK",       OBC_HK_MAPPING)
-eps_hk_section          = Section(BlockType.EPS_HK,         "EPS_HK",       EPS_HK_MAPPING)
-pay_hk_section          = Section(BlockType.PAY_HK,         "PAY_HK",       PAY_HK_MAPPING)
+obc_hk_section          = Section(BlockType.OBC_HK,         "OBC_HK",       OBC_HK_MAPPING,     data_block_len(OBC_HK_MAPPING))
+eps_hk_section          = Section(BlockType.EPS_HK,         "EPS_HK",       EPS_HK_MAPPING,     data_block_len(EPS_HK_MAPPING))
+pay_hk_section          = Section(BlockType.PAY_HK,         "PAY_HK",       PAY_HK_MAPPING,     data_block_len(PAY_HK_MAPPING))
 pay_opt_section         = Section(BlockType.PAY_OPT,        "PAY_OPT",      PAY_OPT_MAPPING)  # won't be used for reading data blocks
-pay_opt_od_section      = Section(BlockType.PAY_OPT_OD,     "PAY_OPT_OD",   PAY_OPT_MAPPING)
-pay_opt_fl_section      = Section(BlockType.PAY_OPT_FL,     "PAY_OPT_FL",   PAY_OPT_MAPPING)
+pay_opt_od_section      = Section(BlockType.PAY_OPT_OD,     "PAY_OPT_OD",   PAY_OPT_MAPPING,    data_block_len(PAY_OPT_MAPPING))
+pay_opt_fl_section      = Section(BlockType.PAY_OPT_FL,     "PAY_OPT_FL",   PAY_OPT_MAPPING,    data_block_len(PAY_OPT_MAPPING))
 # Command log sections
-prim_cmd_log_section    = Section(BlockType.PRIM_CMD_LOG,   "PRIM_CMD_LOG", CMD_LOG_MAPPING)
-sec_cmd_log_section     = Section(BlockType.SEC_CMD_LOG,    "SEC_CMD_LOG",  CMD_LOG_MAPPING)
+prim_cmd_log_section    = Section(BlockType.PRIM_CMD_LOG,   "PRIM_CMD_LOG", CMD_LOG_MAPPING,    CMD_BLOCK_LEN)
+sec_cmd_log_section     = Section(BlockType.SEC_CMD_LOG,    "SEC_CMD_LOG",  CMD_LOG_MAPPING,    CMD_BLOCK_LEN)
 
 g_all_col_data_sections = [
     obc_hk_section,
@@ -251,3 +543,41 @@ g_all_sections = [
     prim_cmd_log_section,
     sec_cmd_log_section,
 ]
+
+
+# Flushes the rows of sections that are waiting longer than Global.flush_ms,
+# since no more rows may be added to them for a while
+# Sleeps until the first pending row is due, or until a row is added if none
+# are pending
+def flush_loop():
+    while True:
+        with g_flush_cond:
+            pending_times = [section.pending_time for section in g_all_sections
+                if section.pending_time is not None]
+            if len(pending_times) == 0:
+                g_flush_cond.wait()
+            else:
+                g_flush_cond.wait(max(min(pending_times) + Global.flush_ms / 1000.0 - time.time(), 0))
+        for section in g_all_sections:
+            section.flush_if_due()
+
+g_flush_thread = None
+# Notified when a section gets its first pending row
+g_flush_cond = threading.Condition()
+
+def start_flush_thread():
+    global g_flush_thread
+    if g_flush_thread is None:
+        g_flush_thread = threading.Thread(target=flush_loop, daemon=True)
+        g_flush_thread.start()
+
+def checkpoint_all_sections():
+    for section in g_all_sections:
+        section.checkpoint()
+
+def close_all_sections():
+    for section in g_all_sections:
+        section.close()
+
+# Don't lose the pending rows if the simulator exits without closing them
+atexit.register(close_all_sections)
@@ -0,0 +1,42 @@
+import os
+import sys
+
+import pytest
+
+# The simulator's modules import each other by name, so they have to be found
+# from the folder above this one
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import *
+from packets import *
+from rtt import *
+from sections import *
+
+
+# Runs the test in an empty folder (section files and archives are written to
+# OUT_FOLDER in the current folder) with the simulator's state reset
+@pytest.fixture
+def sim(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    Global.transport = None
+    Global.channel = None
+    Global.capture = None
+    Global.reader = None
+    Global.cmd_id = 1
+    Global.sent_packets = SentPacketTable()
+    Global.rtt = RTTTable()
+    Global.adaptive_timeouts = True
+    Global.window_size = 1
+    Global.deframer = Deframer()
+    Global.pending = PendingPackets()
+    Global.tx_packets = 0
+    Global.retransmissions = 0
+    Global.flush_rows = 32
+    Global.flush_ms = 1000
+    Global.duplicates = "latest"
+    yield tmp_path
+    if Global.reader is not None:
+        Global.reader.stop()
+        Global.reader = None
+    close_all_sections()
+    Global.transport = None
@@ -0,0 +1,72 @@
+import os
+
+from archive import *
+
+
+RECORD_LEN = 16
+
+
+def record(num, version=0):
+    return bytes([num & 0xFF, version]) + bytes(RECORD_LEN - 2)
+
+
+def test_append_and_get(tmp_path):
+    archive = BlockArchive(str(tmp_path / "1_obc_hk.blk"), RECORD_LEN)
+    archive.open()
+    for num in [3, 1, 2]:
+        assert archive.append(num, record(num))
+
+    assert bytes(archive.get(1)) == record(1)
+    assert archive.get(4) is None
+    assert archive.block_nums() == [1, 2, 3]
+    assert [(num, bytes(data)) for (num, data) in archive.scan(2)] == [(2, record(2)), (3, record(3))]
+    archive.close()
+
+    # Read back from the files
+    archive = BlockArchive(archive.path, RECORD_LEN)
+    archive.open(read_only=True)
+    assert len(archive) == 3
+    assert bytes(archive.get(3)) == record(3)
+    assert [bytes(data) for data in archive.read_records([2, 0])] == [record(2), record(3)]
+    archive.close()
+
+
+def test_duplicate_policies(tmp_path):
+    archive = BlockArchive(str(tmp_path / "1_obc_hk.blk"), RECORD_LEN)
+    archive.open()
+    assert archive.append(5, record(5))
+
+    # The same data is never added again
+    assert not archive.append(5, record(5))
+    assert not archive.append(5, record(5, 1), "first")
+    assert not archive.append(5, record(5, 1), "flag")
+    assert bytes(archive.get(5)) == record(5)
+
+    # With "latest" the new data is added, and replaces the old in lookups
+    assert archive.append(5, record(5, 1), "latest")
+    assert bytes(archive.get(5)) == record(5, 1)
+    assert len(archive) == 2
+    archive.close()
+
+
+def test_incomplete_records_are_removed(tmp_path):
+    archive = BlockArchive(str(tmp_path / "1_obc_hk.blk"), RECORD_LEN)
+    archive.open()
+    archive.append(0, record(0))
+    archive.append(1, record(1))
+    archive.close()
+
+    # The simulator stopped in the middle of writing a record and its index
+    # entry
+    with open(archive.path, 'ab') as f:
+        f.write(record(2)[:5])
+    with open(archive.index_path, 'ab') as f:
+        f.write(b"\x02\x00")
+
+    archive.open()
+    assert len(archive) == 2
+    assert os.path.getsize(archive.path) == 2 * RECORD_LEN
+    assert os.path.getsize(archive.index_path) == 2 * ARCHIVE_INDEX_ITEM_LEN
+    assert archive.append(2, record(2))
+    assert bytes(archive.get(2)) == record(2)
+    archive.close()
@@ -0,0 +1,79 @@
+import os
+
+from blockset import *
+
+
+def test_add_merges_ranges():
+    blocks = BlockSet()
+    for num in [0, 1, 2, 5, 6, 9]:
+        blocks.add(num)
+    assert blocks.ranges == [[0, 3], [5, 7], [9, 10]]
+
+    # Out of order, touching both neighbours
+    blocks.add(4)
+    blocks.add(3)
+    assert blocks.ranges == [[0, 7], [9, 10]]
+    assert len(blocks) == 8
+    assert 6 in blocks
+    assert 7 not in blocks
+    assert blocks.first() == 0
+
+
+def test_add_range_merges_overlaps():
+    blocks = BlockSet([[10, 12], [14, 16], [20, 22]])
+    blocks.add_range(11, 20)
+    assert blocks.ranges == [[10, 22]]
+    blocks.add_range(0, 0)
+    assert blocks.ranges == [[10, 22]]
+
+
+def test_missing():
+    blocks = BlockSet([[2, 4], [6, 8]])
+    assert blocks.missing(0, 10) == [[0, 2], [4, 6], [8, 10]]
+    assert blocks.missing(3, 7) == [[4, 6]]
+    assert blocks.missing(2, 4) == []
+    assert BlockSet().missing(0, 3) == [[0, 3]]
+
+
+def write_rows(path, nums, mode='w'):
+    with open(path, mode) as f:
+        if mode == 'w':
+            f.write("Expected Block Number, Actual Block Number\n")
+        for num in nums:
+            f.write("%d, %d\n" % (num, num))
+
+
+def test_load_block_set_from_file(tmp_path):
+    data_path = str(tmp_path / "1_obc_hk.csv")
+    set_path = data_path + ".blocks"
+    write_rows(data_path, [0, 1, 2, 4])
+
+    blocks = load_block_set(set_path, data_path)
+    assert blocks.ranges == [[0, 3], [4, 5]]
+
+
+def test_saved_block_set_only_reads_new_rows(tmp_path):
+    data_path = str(tmp_path / "1_obc_hk.csv")
+    set_path = data_path + ".blocks"
+    write_rows(data_path, [0, 1])
+    save_block_set(BlockSet([[0, 2]]), set_path, os.path.getsize(data_path))
+    write_rows(data_path, [5], 'a')
+
+    # The saved set says block 100 is in the file, which shows it was used
+    # instead of reading the whole file again
+    save_block_set(BlockSet([[0, 2], [100, 101]]), set_path, os.path.getsize(data_path) - len("5, 5\n"))
+    assert load_block_set(set_path, data_path).ranges == [[0, 2], [5, 6], [100, 101]]
+
+
+def test_stale_block_set_is_rebuilt(tmp_path):
+    data_path = str(tmp_path / "1_obc_hk.csv")
+    set_path = data_path + ".blocks"
+    write_rows(data_path, [0, 1, 2])
+    # Saved from a longer file, e.g. before the file was cut back
+    save_block_set(BlockSet([[0, 10]]), set_path, os.path.getsize(data_path) + 100)
+    assert load_block_set(set_path, data_path).ranges == [[0, 3]]
+
+    # Half written
+    with open(set_path, 'w') as f:
+        f.write('{"version": 1, "si')
+    assert load_block_set(set_path, data_path).ranges == [[0, 3]]
@@ -0,0 +1,82 @@
+import os
+import subprocess
+import sys
+
+from capture import *
+
+
+SIMULATOR_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def write_capture(path):
+    writer = CaptureWriter(path)
+    writer.open()
+    writer.write_tx(b"U\x0fU")
+    writer.write_rx(b"")
+    writer.write_rx(b"\x00\x01")
+    writer.close()
+    return writer
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "serial.cap")
+    writer = write_capture(path)
+    assert writer.num_records == 3
+
+    records = list(read_capture(path))
+    assert [(direction, data) for (timestamp, direction, data) in records][1:] == \
+        [(CAPTURE_TX, b"U\x0fU"), (CAPTURE_RX, b"\x00\x01")]
+    assert records[0][1] == CAPTURE_SESSION
+    assert [timestamp for (timestamp, direction, data) in records] == \
+        sorted(timestamp for (timestamp, direction, data) in records)
+
+    # A second session is added to the end of the same file
+    write_capture(path)
+    assert [direction for (timestamp, direction, data) in read_capture(path)].count(CAPTURE_SESSION) == 2
+
+
+def test_incomplete_record_is_removed(tmp_path):
+    path = str(tmp_path / "serial.cap")
+    write_capture(path)
+    size = os.path.getsize(path)
+    with open(path, 'ab') as f:
+        f.write(CAPTURE_RECORD_HEADER.pack(0, CAPTURE_TX, 100) + b"abc")
+
+    # Readers stop before it
+    assert len(list(read_capture(path))) == 3
+    write_capture(path)
+    with open(path, 'rb') as f:
+        read_capture_header(f)
+        (end, count) = capture_end(f)
+    assert count == 6
+    assert end == os.path.getsize(path) > size
+
+
+def test_capture_to_text(tmp_path):
+    path = str(tmp_path / "serial.cap")
+    write_capture(path)
+    write_path = str(tmp_path / "serial_write.log")
+    read_path = str(tmp_path / "serial_read.log")
+    assert capture_to_text(path, write_path, read_path) == 3
+    with open(write_path) as f:
+        assert f.read() == "U\\x0fU"
+    with open(read_path) as f:
+        assert f.read() == "\\x00\\x01"
+
+
+def run_script(cwd, *args):
+    return subprocess.run([sys.executable, os.path.join(SIMULATOR_FOLDER, "capture.py")] + list(args),
+        cwd=cwd, capture_output=True, text=True, timeout=60)
+
+
+def test_command_line(tmp_path):
+    result = run_script(tmp_path, "--help")
+    assert result.returncode == 0, result.stderr
+    assert "serial.cap" in result.stdout
+
+    os.mkdir(str(tmp_path / "out"))
+    write_capture(str(tmp_path / "out" / "serial.cap"))
+    result = run_script(tmp_path)
+    assert result.returncode == 0, result.stderr
+    assert "Converted 3 records" in result.stdout
+    assert os.path.exists(str(tmp_path / "out" / "serial_write.log"))
@@ -0,0 +1,188 @@
+import threading
+import time
+
+import pytest
+
+import command_utilities
+from command_utilities import *
+from common import *
+from constants import *
+from obc_emulator import *
+from packets import *
+from sections import *
+from transport import *
+
+
+# Stands in for OBC on one end of a loopback transport, replying to each
+# command with the packets from reply(n, cmd), where n counts the commands
+# received from 0
+class ScriptedOBC(object):
+    def __init__(self, transport, reply):
+        self.transport = transport
+        self.reply = reply
+        self.cmds = []
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        deframer = Deframer(CommandPacket)
+        while self.running:
+            for cmd in deframer.feed(self.transport.recv(0.01)):
+                self.cmds.append(cmd)
+                for packet in self.reply(len(self.cmds) - 1, cmd):
+                    self.transport.send(packet)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def cmd_ids(self):
+        return [cmd.cmd_id for cmd in self.cmds]
+
+
+def ack_and_resp(cmd):
+    return [encode_ack(cmd.cmd_id, PacketACKStatus.OK), encode_resp(cmd.cmd_id, PacketRespStatus.OK)]
+
+
+@pytest.fixture
+def link(sim):
+    (ground, obc) = make_loopback_pair(0.01)
+    Global.transport = ground
+    yield obc
+    ground.close()
+
+
+@pytest.fixture
+def emulator(link):
+    emulator = OBCEmulator(link, parse_block_counts("", 30), cmd_queue_size=2, resp_delay=0.02)
+    emulator.start()
+    Global.reader = SerialReader(Global.transport, Global.deframer)
+    Global.reader.start()
+    yield emulator
+    Global.reader.stop()
+    Global.reader = None
+    emulator.stop()
+
+
+def test_read_missing_blocks_with_full_cmd_queue(emulator):
+    # The window is bigger than OBC's command queue, so some commands get
+    # FULL_CMD_QUEUE and have to be held
+    Global.window_size = 8
+    for section in g_all_sections:
+        section.load_file()
+
+    read_missing_blocks()
+
+    for section in g_all_read_data_sections + [prim_cmd_log_section]:
+        assert section.blocks.missing(0, 30) == [], section.name
+    assert Global.retransmissions == 0
+
+
+def test_window_of_pings(emulator):
+    cmds = [(CommandOpcode.PING_OBC, 0, 0)] * 20
+    assert send_and_receive_packets(cmds, window_size=4)
+    assert emulator.num_resps == 20
+    assert Global.retransmissions == 0
+
+
+def test_late_response_for_held_command(link):
+    Global.adaptive_timeouts = False
+
+    def reply(n, cmd):
+        if n == 0:
+            # The first attempt times out
+            return []
+        if n == 1:
+            # The second attempt doesn't fit in OBC's queue, then the response
+            # to the first attempt arrives
+            first = obc.cmds[0].cmd_id
+            return [encode_ack(cmd.cmd_id, PacketACKStatus.FULL_CMD_QUEUE),
+                encode_ack(cmd.cmd_id, PacketACKStatus.FULL_CMD_QUEUE),
+                encode_ack(first, PacketACKStatus.OK), encode_resp(first, PacketRespStatus.OK)]
+        return ack_and_resp(cmd)
+
+    obc = ScriptedOBC(link, reply)
+    assert send_and_receive_packets([(CommandOpcode.PING_OBC, 0, 0)], window_size=4, wait_time=0.2)
+    time.sleep(0.1)
+    obc.stop()
+    # The held command is finished, so it is never sent a third time
+    assert obc.cmd_ids() == [1, 2]
+
+
+def test_window_grows_back_after_full_cmd_queue(link):
+    Global.adaptive_timeouts = False
+    lock = threading.Lock()
+    counts = {"accepted": 0, "resps": 0}
+    # Commands without a response yet when each command was accepted
+    in_flight = []
+
+    def send_resp(cmd):
+        with lock:
+            counts["resps"] += 1
+        link.send(encode_resp(cmd.cmd_id, PacketRespStatus.OK))
+
+    def reply(n, cmd):
+        if n == 2:
+            return [encode_ack(cmd.cmd_id, PacketACKStatus.FULL_CMD_QUEUE)]
+        with lock:
+            counts["accepted"] += 1
+            in_flight.append(counts["accepted"] - counts["resps"])
+        threading.Timer(0.05, send_resp, [cmd]).start()
+        return [encode_ack(cmd.cmd_id, PacketACKStatus.OK)]
+
+    obc = ScriptedOBC(link, reply)
+    cmds = [(CommandOpcode.PING_OBC, 0, 0)] * 30
+    assert send_and_receive_packets(cmds, window_size=4, wait_time=1)
+    obc.stop()
+    assert len(obc.cmds) == 31
+    assert Global.retransmissions == 0
+    # The window went back to its full size after the FULL_CMD_QUEUE ACK
+    assert max(in_flight[-10:]) == 4
+
+
+def test_late_failed_ack_is_sent_again(link, monkeypatch):
+    Global.adaptive_timeouts = False
+    obc = ScriptedOBC(link, lambda n, cmd: [] if n == 0 else ack_and_resp(cmd))
+
+    # The failed ACK for the first attempt arrives just after it times out
+    receive = command_utilities.receive_rx_packet_for
+    def late_receive(cmd_id, is_resp, wait_time=5):
+        if wait_time == 0 and not is_resp:
+            link.send(encode_ack(cmd_id, PacketACKStatus.INVALID_CSUM))
+        return receive(cmd_id, is_resp, wait_time)
+    monkeypatch.setattr(command_utilities, "receive_rx_packet_for", late_receive)
+
+    assert send_and_receive_packet(CommandOpcode.PING_OBC, wait_time=0.2, attempts=2)
+    obc.stop()
+    assert obc.cmd_ids() == [1, 1]
+    assert Global.pending.avoided_retransmissions == 0
+    assert Global.retransmissions == 1
+
+
+def test_late_ack_avoids_retransmission(link, monkeypatch):
+    Global.adaptive_timeouts = False
+    obc = ScriptedOBC(link, lambda n, cmd: [])
+
+    receive = command_utilities.receive_rx_packet_for
+    def late_receive(cmd_id, is_resp, wait_time=5):
+        if wait_time == 0 and not is_resp:
+            link.send(encode_ack(cmd_id, PacketACKStatus.OK))
+        return receive(cmd_id, is_resp, wait_time)
+    monkeypatch.setattr(command_utilities, "receive_rx_packet_for", late_receive)
+
+    assert send_and_receive_packet(CommandOpcode.PING_OBC, wait_time=0.2, attempts=2)
+    obc.stop()
+    assert obc.cmd_ids() == [1]
+    assert Global.pending.avoided_retransmissions == 1
+
+
+def test_no_ack_sample_after_retransmission(link):
+    Global.adaptive_timeouts = False
+    obc = ScriptedOBC(link, lambda n, cmd: [] if n == 0 else ack_and_resp(cmd))
+
+    assert send_and_receive_packet(CommandOpcode.PING_OBC, wait_time=0.2)
+    obc.stop()
+    # The ACK could have been for either attempt (Karn's algorithm)
+    assert CommandOpcode.PING_OBC not in Global.rtt.ack_rtts
+    assert Global.rtt.resp_rtts[CommandOpcode.PING_OBC].num_samples == 1
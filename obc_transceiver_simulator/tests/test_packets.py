@@ -0,0 +1,134 @@
+import pytest
+
+from common import *
+from constants import *
+from encoding import *
+from obc_emulator import *
+from packets import *
+
+
+def test_encode_decode_round_trip():
+    dec_msg = bytes(range(20)) + bytes([TRANS_PKT_DELIMITER] * 3)
+    enc_msg = encode_packet(dec_msg)
+    assert len(enc_msg) == len(dec_msg) + TRANS_ENC_OVERHEAD
+    assert get_enc_packet_status(enc_msg) == PacketACKStatus.OK
+    assert decode_packet(enc_msg) == dec_msg
+    assert bytes(decode_from(enc_msg)) == dec_msg
+
+
+def test_decode_packet_exits_on_bad_length_or_checksum():
+    enc_msg = encode_packet(b"\x00\x01\x00abc")
+    with pytest.raises(SystemExit):
+        decode_packet(enc_msg[:1] + bytes([enc_msg[1] + 1]) + enc_msg[2:])
+    with pytest.raises(SystemExit):
+        decode_packet(enc_msg[:3] + b"x" + enc_msg[4:])
+
+
+def test_decode_packet_does_not_check_delimiters():
+    enc_msg = encode_packet(b"\x00\x01\x00abc")
+    bad_start = b"\x00" + enc_msg[1:]
+    assert decode_packet(bad_start) == b"\x00\x01\x00abc"
+    assert get_enc_packet_status(bad_start) == PacketACKStatus.INVALID_ENC_FMT
+    assert decode_from(bad_start) is None
+
+
+def test_deframer_finds_packets_split_across_reads():
+    data = encode_ack(1, PacketACKStatus.OK) + encode_resp(1, PacketACKStatus.OK, b"\x55" * 8)
+    deframer = Deframer()
+    packets = []
+    for i in range(len(data)):
+        packets.extend(deframer.feed(data[i : i + 1]))
+
+    assert [(p.command_id, p.is_resp) for p in packets] == [(1, False), (1, True)]
+    assert packets[1].data == b"\x55" * 8
+    assert deframer.num_packets == 2
+    assert deframer.discarded_bytes == 0
+    assert len(deframer.buf) == 0
+
+
+def test_deframer_skips_delimiters_inside_packets():
+    data = encode_resp(1, PacketACKStatus.OK, b"\x55" * 8) + encode_ack(2, PacketACKStatus.OK)
+    deframer = Deframer()
+    packets = list(deframer.feed(data))
+
+    assert [p.command_id for p in packets] == [1, 2]
+    assert deframer.framing_errors == 0
+
+
+def test_deframer_resyncs_after_garbage():
+    ack = encode_ack(7, PacketACKStatus.OK)
+    deframer = Deframer()
+    packets = list(deframer.feed(b"\x01\x55\x02\x03" + ack))
+
+    assert [p.command_id for p in packets] == [7]
+    assert deframer.framing_errors == 1
+    assert deframer.discarded_bytes == 4
+
+
+def test_deframer_counts_checksum_errors():
+    good = encode_ack(2, PacketACKStatus.OK)
+    bad = bytearray(encode_ack(1, PacketACKStatus.OK))
+    bad[4] ^= 0xFF
+    deframer = Deframer()
+    packets = list(deframer.feed(bytes(bad) + good))
+
+    assert [p.command_id for p in packets] == [2]
+    assert deframer.csum_errors == 1
+    assert deframer.num_packets == 1
+
+
+def test_deframer_keeps_partial_packet():
+    ack = encode_ack(3, PacketACKStatus.OK)
+    deframer = Deframer()
+    assert list(deframer.feed(ack[:-1])) == []
+    assert len(deframer.buf) == len(ack) - 1
+    assert [p.command_id for p in deframer.feed(ack[-1:])] == [3]
+
+
+class FakePacket(object):
+    def __init__(self, cmd_id):
+        self.cmd_id = cmd_id
+
+
+def test_sent_packet_table_generation_wrap():
+    table = SentPacketTable()
+    old = FakePacket(5)
+    table.add(old)
+    assert table.get(5) is old
+
+    # Same 15 bit command ID in the next generation replaces the old packet
+    new = FakePacket(CMD_ID_COUNT + 5)
+    table.add(new)
+    assert table.get(5) is new
+    assert len(table) == 1
+
+    # A packet from before the latest command ID wrapped is never returned
+    table.add(FakePacket(CMD_ID_COUNT + 10))
+    table.add(FakePacket(2 * CMD_ID_COUNT + 20))
+    assert table.get(10) is None
+    assert table.get(5) is None
+    assert table.get(20) is not None
+
+
+def test_sent_packet_table_evicts_oldest_done():
+    table = SentPacketTable(keep_done=2)
+    for cmd_id in range(1, 5):
+        table.add(FakePacket(cmd_id))
+    for cmd_id in range(1, 4):
+        table.set_done(cmd_id)
+
+    assert table.get(1) is None
+    assert table.get(2) is not None
+    assert table.get(4) is not None
+    assert len(table) == 3
+
+
+def test_pending_packets_take():
+    pending = PendingPackets()
+    resp = RXPacket(encode_resp(9, PacketACKStatus.OK))
+    pending.add(resp)
+
+    assert pending.contains(9, True)
+    assert not pending.contains(9, False)
+    assert pending.take(9, True) is resp
+    assert pending.take(9, True) is None
@@ -0,0 +1,58 @@
+import pytest
+
+from common import *
+from constants import *
+from rtt import *
+
+
+def test_estimator_follows_rfc_6298():
+    estimator = RTTEstimator()
+    assert estimator.timeout(5) == 5
+
+    estimator.add_sample(1.0)
+    assert estimator.srtt == 1.0
+    assert estimator.rttvar == 0.5
+    assert estimator.timeout(5) == pytest.approx(1.0 + RTT_K * 0.5)
+
+    estimator.add_sample(2.0)
+    assert estimator.rttvar == pytest.approx(0.75 * 0.5 + 0.25 * 1.0)
+    assert estimator.srtt == pytest.approx(0.875 * 1.0 + 0.125 * 2.0)
+
+
+def test_estimator_granularity():
+    estimator = RTTEstimator()
+    for i in range(100):
+        estimator.add_sample(0.3)
+    assert estimator.timeout(5) == pytest.approx(0.3 + RTT_GRANULARITY)
+
+
+def test_ack_timeout_floor_and_backoff(sim):
+    table = RTTTable()
+    opcode = CommandOpcode.PING_OBC
+    assert table.ack_timeout(opcode, 5) == 5
+
+    for i in range(20):
+        table.add_ack_sample(opcode, 0.01)
+    # OBC only clears a partial command after OBC_RX_BUF_CLEAR_TIME
+    assert table.ack_timeout(opcode, 5) == OBC_RX_BUF_CLEAR_TIME
+    assert table.ack_timeout(opcode, 5, 1) == 2 * OBC_RX_BUF_CLEAR_TIME
+    assert table.ack_timeout(opcode, 5, 10) == TIMEOUT_MAX
+
+    # Other opcodes still use the default
+    assert table.ack_timeout(CommandOpcode.READ_DATA_BLOCK, 5) == 5
+
+
+def test_resp_timeout_floor(sim):
+    table = RTTTable()
+    opcode = CommandOpcode.PING_OBC
+    for i in range(20):
+        table.add_resp_sample(opcode, 0.01)
+    assert table.resp_timeout(opcode, 5) == RESP_TIMEOUT_MIN
+
+
+def test_fixed_timeouts(sim):
+    Global.adaptive_timeouts = False
+    table = RTTTable()
+    table.add_ack_sample(CommandOpcode.PING_OBC, 0.01)
+    assert table.ack_timeout(CommandOpcode.PING_OBC, 5, 3) == 5
+    assert table.resp_timeout(CommandOpcode.PING_OBC, 5) == 5
@@ -0,0 +1,89 @@
+import os
+
+from common import *
+from sections import *
+
+
+HEADER = bytes(BLOCK_HEADER_LEN)
+
+
+def write_block(section, block_num, value=0):
+    fields = [value] * len(section.mapping)
+    return section.write_block_to_file(block_num, HEADER, fields, fields)
+
+
+def read_rows(section):
+    with open(os.path.join(OUT_FOLDER, section.file_name), 'rb') as f:
+        return f.readlines()
+
+
+def test_rows_are_written_in_groups(sim):
+    Global.flush_rows = 3
+    section = obc_hk_section
+    section.load_file()
+    header_len = len(read_rows(section))
+
+    write_block(section, 0)
+    write_block(section, 1)
+    assert len(read_rows(section)) == header_len
+    write_block(section, 2)
+    assert len(read_rows(section)) == header_len + 3
+    section.close()
+
+
+def test_recover_cuts_incomplete_group(sim):
+    Global.flush_rows = 1
+    section = obc_hk_section
+    section.load_file()
+    write_block(section, 0)
+    write_block(section, 1)
+    section.close()
+
+    file_path = os.path.join(OUT_FOLDER, section.file_name)
+    size = os.path.getsize(file_path)
+    # The simulator stopped after the marker was set and part of a group of
+    # rows was written
+    with open(section.marker_path(), 'w') as f:
+        f.write("%20d\n" % size)
+    with open(file_path, 'a') as f:
+        f.write("2, 2, 2026-01-01, 12:")
+
+    section.load_file()
+    assert os.path.getsize(file_path) == size
+    assert section.file_block_num == 2
+    assert section.download_plan(4) == [[1, 4]]
+    section.close()
+
+
+def test_complete_group_is_kept(sim):
+    Global.flush_rows = 1
+    section = obc_hk_section
+    section.load_file()
+    write_block(section, 0)
+    section.close()
+
+    file_path = os.path.join(OUT_FOLDER, section.file_name)
+    size = os.path.getsize(file_path)
+    section.load_file()
+    assert os.path.getsize(file_path) == size
+    assert 0 in section.blocks
+    section.close()
+
+
+def test_duplicate_blocks(sim):
+    Global.flush_rows = 1
+    section = obc_hk_section
+    section.load_file()
+    assert write_block(section, 0, 1)
+    assert not write_block(section, 0, 1)
+
+    Global.duplicates = "first"
+    assert not write_block(section, 0, 2)
+    Global.duplicates = "flag"
+    assert not write_block(section, 0, 2)
+    assert os.path.exists(os.path.join(OUT_FOLDER, section.conflicts_file_name()))
+    Global.duplicates = "latest"
+    assert write_block(section, 0, 2)
+
+    assert [row_block_num(row) for row in read_rows(section)[1:]] == [0, 0]
+    section.close()
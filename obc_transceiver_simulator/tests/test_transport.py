@@ -0,0 +1,37 @@
+import pytest
+
+from transport import *
+
+
+def test_transport_is_abstract():
+    with pytest.raises(TypeError):
+        Transport()
+
+    class ReceiveOnly(Transport):
+        def recv(self, timeout):
+            return b""
+
+    with pytest.raises(TypeError):
+        ReceiveOnly()
+
+
+def test_loopback_pair():
+    (a, b) = make_loopback_pair(0.01)
+    a.write(b"abc")
+    b.write(b"x")
+    assert b.in_waiting == 3
+    assert b.read(2) == b"ab"
+    assert b.read(5) == b"c"
+    assert b.read(1) == b""
+    assert a.read(1) == b"x"
+
+
+def test_ring_buffer_overwrites_oldest():
+    ring = RingBuffer(8)
+    ring.write(b"abcdef")
+    assert ring.read(2) == b"ab"
+    ring.write(b"ghijkl")
+    assert len(ring) == 8
+    assert ring.overflow_bytes == 2
+    assert ring.read() == b"efghijkl"
+    assert len(ring) == 0
@@ -0,0 +1,411 @@
+"""
+Transports for the link to OBC (serial port, pty, TCP socket or in-process
+loopback) and the receiving side of the link.
+A background reader continuously drains the transport, so bytes are not lost
+while the simulator is waiting for user input, and decoded RX packets are
+available as soon as they arrive instead of on the next 100ms poll.
+"""
+
+import abc
+import os
+import queue
+import select
+import socket
+import threading
+import time
+
+from common import *
+from packets import *
+
+try:
+    import serial
+except ImportError:
+    serial = None
+
+# Only needed for ptys, which Windows doesn't have
+try:
+    import tty
+except ImportError:
+    tty = None
+
+
+# Seconds between checks for received bytes when SerialTransport waits less
+# than its port's timeout
+SERIAL_POLL_TIME = 0.001
+
+
+# All transports have the same interface as the parts of serial.Serial the
+# simulator uses:
+# timeout - seconds read() waits
+# read(size) - waits until size bytes have arrived or the timeout passes,
+#     returns the bytes received (possibly fewer than size, or none)
+# in_waiting - number of bytes that can be read without waiting
+# write(data)
+# close()
+# Subclasses only need to implement recv() and send()
+class Transport(abc.ABC):
+    def __init__(self, timeout=0.1):
+        self.timeout = timeout
+        # Bytes received but not read yet
+        self.rx_buf = bytearray()
+
+    # Waits up to timeout seconds for bytes to arrive
+    # Returns the bytes (empty if none arrived)
+    @abc.abstractmethod
+    def recv(self, timeout):
+        pass
+
+    @abc.abstractmethod
+    def send(self, data):
+        pass
+
+    @property
+    def in_waiting(self):
+        self.rx_buf += self.recv(0)
+        return len(self.rx_buf)
+
+    def read(self, size=1):
+        end_time = time.time() + self.timeout
+        while len(self.rx_buf) < size:
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                break
+            self.rx_buf += self.recv(remaining)
+
+        data = bytes(self.rx_buf[:size])
+        del self.rx_buf[:size]
+        return data
+
+    def write(self, data):
+        self.send(data)
+
+    def close(self):
+        pass
+
+
+# Physical serial port (e.g. the UART on a programmer connected to OBC)
+class SerialTransport(Transport):
+    def __init__(self, port, baud, timeout=0.1):
+        if serial is None:
+            print("Error: Serial ports require the pyserial module. To install " +
+                "pyserial,\nvisit https://pypi.org/project/pyserial/ or run\n" +
+                "    $ pip install pyserial\n" +
+                "in the command line.")
+            sys.exit(1)
+
+        super().__init__(timeout)
+        # Setting serial.timeout reconfigures the port (tcsetattr, or
+        # SetCommTimeouts on Windows), so it always stays at the timeout the
+        # port was opened with. Shorter waits poll in_waiting instead.
+        self.port_timeout = timeout
+        self.serial = serial.Serial(port, baud, timeout=timeout)
+
+    # Waits up to timeout seconds (less than port_timeout) for at least
+    # min_size bytes to arrive
+    # Returns the bytes that arrived, at most max_size of them (None for all)
+    def poll_read(self, min_size, timeout, max_size=None):
+        end_time = time.time() + timeout
+        while True:
+            waiting = self.serial.in_waiting
+            if waiting >= min_size or time.time() >= end_time:
+                return self.serial.read(waiting if max_size is None else min(waiting, max_size))
+            time.sleep(max(min(SERIAL_POLL_TIME, end_time - time.time()), 0))
+
+    def recv(self, timeout):
+        if timeout < self.port_timeout:
+            return self.poll_read(1, timeout)
+        return self.serial.read(max(self.serial.in_waiting, 1))
+
+    @property
+    def in_waiting(self):
+        return self.serial.in_waiting
+
+    def read(self, size=1):
+        if self.timeout < self.port_timeout:
+            return self.poll_read(size, self.timeout, size)
+        return self.serial.read(size)
+
+    def send(self, data):
+        self.serial.write(data)
+
+    def close(self):
+        self.serial.close()
+
+
+# Transport on a file descriptor (used for ptys)
+class FDTransport(Transport):
+    def __init__(self, fd, timeout=0.1):
+        super().__init__(timeout)
+        self.fd = fd
+
+    def recv(self, timeout):
+        (readable, writable, errors) = select.select([self.fd], [], [], timeout)
+        if len(readable) == 0:
+            return b''
+        try:
+            return os.read(self.fd, 2 ** 16)
+        except OSError:
+            # The other end of a pty is closed
+            return b''
+
+    def send(self, data):
+        view = memoryview(data)
+        while len(view) > 0:
+            view = view[os.write(self.fd, view):]
+
+    def close(self):
+        os.close(self.fd)
+
+
+# Linux pseudo-terminal pair
+# With no path, creates a new pty and keeps the master end. Anything that can
+# open a serial port (e.g. the OBC emulator, or another simulator with
+# --uart) can then attach to the path in peer_name.
+# With a path, opens that terminal device (e.g. the peer_name printed by
+# another process).
+class PtyTransport(FDTransport):
+    def __init__(self, path=None, timeout=0.1):
+        if tty is None:
+            print("Error: Pseudo-terminals are not supported on this platform, " +
+                "use --uart or --tcp instead.")
+            sys.exit(1)
+
+        self.slave_fd = None
+
+        if path is None:
+            (fd, self.slave_fd) = os.openpty()
+            # Pass bytes through unchanged (no echo, no newline translation)
+            tty.setraw(self.slave_fd)
+            self.peer_name = os.ttyname(self.slave_fd)
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_NOCTTY)
+            tty.setraw(fd)
+            self.peer_name = None
+
+        super().__init__(fd, timeout)
+
+    def close(self):
+        super().close()
+        if self.slave_fd is not None:
+            os.close(self.slave_fd)
+
+
+# TCP connection, e.g. to a serial-to-TCP bridge on the host the radio is
+# plugged into
+# With listen=True, waits for one connection on the port instead of connecting
+class TCPTransport(Transport):
+    def __init__(self, host, port, listen=False, timeout=0.1):
+        super().__init__(timeout)
+
+        if listen:
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind((host, port))
+            server.listen(1)
+            print("Waiting for TCP connection on %s:%d" % (host, port))
+            (self.sock, addr) = server.accept()
+            server.close()
+            print("Accepted TCP connection from %s:%d" % addr)
+        else:
+            self.sock = socket.create_connection((host, port))
+
+        # Packets are small, send them right away
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def recv(self, timeout):
+        (readable, writable, errors) = select.select([self.sock], [], [], timeout)
+        if len(readable) == 0:
+            return b''
+        try:
+            return self.sock.recv(2 ** 16)
+        except OSError:
+            return b''
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def close(self):
+        self.sock.close()
+
+
+# In-process link, for tests and benchmarks without any hardware
+# Use make_loopback_pair() to get two connected ends
+class LoopbackTransport(Transport):
+    def __init__(self, timeout=0.1):
+        super().__init__(timeout)
+        self.peer = None
+        # Bytes written by the peer
+        self.inbox = bytearray()
+        self.cond = threading.Condition()
+
+    def recv(self, timeout):
+        with self.cond:
+            if len(self.inbox) == 0 and timeout > 0:
+                self.cond.wait(timeout)
+            data = bytes(self.inbox)
+            self.inbox = bytearray()
+        return data
+
+    def send(self, data):
+        peer = self.peer
+        with peer.cond:
+            peer.inbox += data
+            peer.cond.notify()
+
+# Returns two LoopbackTransports, where bytes written to one are read from the
+# other
+def make_loopback_pair(timeout=0.1):
+    a = LoopbackTransport(timeout)
+    b = LoopbackTransport(timeout)
+    a.peer = b
+    b.peer = a
+    return (a, b)
+
+
+# Number of received bytes that can be buffered before the oldest ones are
+# overwritten (far more than can arrive between two passes of the deframer)
+RX_RING_SIZE = 2 ** 16
+
+
+# Fixed-size circular byte buffer
+# When it is full, writing overwrites the oldest bytes (counted in
+# overflow_bytes)
+# Not thread-safe by itself, SerialReader locks around it
+class RingBuffer(object):
+    def __init__(self, size=RX_RING_SIZE):
+        self.data = bytearray(size)
+        self.start = 0      # Index of the oldest byte
+        self.count = 0      # Number of bytes stored
+        self.overflow_bytes = 0
+
+    def __len__(self):
+        return self.count
+
+    def write(self, data):
+        size = len(self.data)
+        num = len(data)
+
+        # Only the newest bytes fit
+        if num > size:
+            self.overflow_bytes += num - size
+            data = data[num - size:]
+            num = size
+
+        # Make room by dropping the oldest bytes
+        free = size - self.count
+        if num > free:
+            drop = num - free
+            self.start = (self.start + drop) % size
+            self.count -= drop
+            self.overflow_bytes += drop
+
+        end = (self.start + self.count) % size
+        first = min(num, size - end)
+        self.data[end : end + first] = data[0 : first]
+        self.data[0 : num - first] = data[first : num]
+        self.count += num
+
+    # Removes and returns up to max_len bytes (all of them by default)
+    def read(self, max_len=None):
+        size = len(self.data)
+        num = self.count if max_len is None else min(max_len, self.count)
+
+        first = min(num, size - self.start)
+        ret = bytes(self.data[self.start : self.start + first]) + bytes(self.data[0 : num - first])
+        self.start = (self.start + num) % size
+        self.count -= num
+        return ret
+
+    def clear(self):
+        self.start = 0
+        self.count = 0
+
+
+# Reads the transport in a background thread
+# One thread only moves bytes from the transport into a ring buffer, so it
+# never falls behind the UART. A second thread logs them, runs them through the
+# deframer and puts the decoded RXPackets on a queue for get_packet().
+class SerialReader(object):
+    def __init__(self, transport, deframer, ring_size=RX_RING_SIZE):
+        self.transport = transport
+        self.deframer = deframer
+        self.ring = RingBuffer(ring_size)
+        self.rx_queue = queue.Queue()
+
+        # Protects ring, notified when new bytes are written to it
+        self.ring_cond = threading.Condition()
+        # Protects deframer and rx_queue (taken before ring_cond)
+        self.deframer_lock = threading.Lock()
+
+        self.running = False
+        self.read_thread = None
+        self.deframe_thread = None
+
+        self.num_bytes = 0
+
+    def __str__(self):
+        return "SerialReader: bytes = %d, buffered bytes = %d, overflowed bytes = %d, queued packets = %d" \
+            % (self.num_bytes, len(self.ring), self.ring.overflow_bytes, self.rx_queue.qsize())
+
+    def start(self):
+        self.running = True
+        # Daemon threads so they never stop the simulator from quitting
+        self.read_thread = threading.Thread(target=self.read_loop, daemon=True)
+        self.deframe_thread = threading.Thread(target=self.deframe_loop, daemon=True)
+        self.read_thread.start()
+        self.deframe_thread.start()
+
+    def stop(self):
+        self.running = False
+        with self.ring_cond:
+            self.ring_cond.notify_all()
+        self.read_thread.join()
+        self.deframe_thread.join()
+
+    def read_loop(self):
+        while self.running:
+            # Blocks until the first byte arrives (or the serial timeout), then
+            # takes everything else that is already waiting
+            data = self.transport.read(max(self.transport.in_waiting, 1))
+            if len(data) == 0:
+                continue
+            # Logged here so the capture has the time the bytes arrived
+            log_serial_read(data)
+
+            with self.ring_cond:
+                self.ring.write(data)
+                self.num_bytes += len(data)
+                self.ring_cond.notify()
+
+    def deframe_loop(self):
+        while self.running:
+            with self.ring_cond:
+                while self.running and len(self.ring) == 0:
+                    self.ring_cond.wait()
+
+            with self.deframer_lock:
+                with self.ring_cond:
+                    data = self.ring.read()
+                for rx_packet in self.deframer.feed(data):
+                    self.rx_queue.put(rx_packet)
+
+    # Discards all bytes and packets received so far (they are still logged)
+    def flush(self):
+        with self.deframer_lock:
+            with self.ring_cond:
+                self.ring.read()
+            self.deframer.reset()
+
+            while True:
+                try:
+                    self.rx_queue.get_nowait()
+                except queue.Empty:
+                    break
+
+    # Waits up to timeout seconds for the next RXPacket
+    # Returns None if there wasn't one
+    def get_packet(self, timeout):
+        try:
+            return self.rx_queue.get(timeout=timeout)
+        except queue.Empty:
+            return None